@@ -1,99 +1,313 @@
-from selenium import webdriver
-from selenium.webdriver.support.ui import Select
-from selenium.webdriver.common.by import By
 from bs4 import BeautifulSoup
-import pandas as pd
+import argparse
+import threading
+import queue
+import json
 import time
-from datetime import timedelta
-
-def scrape_weather_data_from_page(base_url, date):
-    # Initialize the web driver (make sure to have the appropriate driver installed, e.g., chromedriver)
-    driver = webdriver.Chrome()
-    
-    # Open the base URL
-    driver.get(base_url)
-    
-    # Convert date to the format expected by the dropdown
-    day = date.strftime('%d').lstrip('0')  # Remove leading zero
-    month = date.strftime('%B')
-    year = date.strftime('%Y')
-    
-    # Select the specific day from the dropdown
+import sys
+import os
+import re
+import math
+from weather_store import WeatherStore, STORE_FILE, parse_number
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+# Historical weather of one city from timeanddate.com, one day per page
+CITY = 'singapore/singapore'
+BASE_URL = f'https://www.timeanddate.com/weather/{CITY}/historic'
+# The day dropdown on the page loads its table from this endpoint; plain HTTP mode requests it directly.
+# Its parameters are read off the page's script and not yet checked against the live site, so the
+# Selenium driver, which uses the page as a browser does, stays the default until they are.
+DAY_URL = 'https://www.timeanddate.com/scripts/cityajax.php'
+
+CACHE_DIR = 'weather_cache'  # Fetched pages, one file per day, so re-runs and re-parses never refetch
+FIXTURE_DIR = 'scraper_fixtures'  # Saved pages with the rows they must parse to, for --check-fixtures
+CHECKPOINT_FILE = 'scraper_checkpoint.json'  # Days already scraped, for resuming
+MAX_WORKERS = 4  # Pages fetched at the same time
+REQUEST_INTERVAL = 1.0  # Minimum seconds between two requests to the site
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def parse_history_table(html, date):
+    """Return [(hour, temperature, humidity)] for the day's table in a saved page or table fragment.
+
+    Observations within the same hour are averaged. The first row belongs to
+    midnight even when the site labels it with the previous day's last time.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    table = soup.find('table', {'id': 'wt-his'}) or soup.find('table')
+    if table is None:
+        return []
+    body = table.find('tbody') or table
+    hours = {}
+    for i, row in enumerate(body.find_all('tr')):
+        header = row.find('th')
+        cells = row.find_all('td')
+        if header is None or len(cells) < 6:
+            continue
+        # Keep the 'HH:MM' and drop the day and date; the <br> before the date leaves no space in .text
+        match = re.match(r'\s*(\d{1,2}:\d{2})', header.text)
+        if match is None:
+            continue
+        hour = 0 if i == 0 else int(match.group(1).split(':')[0])
+        # '28 °C' -> 28.0, '84%' -> 84.0; 'N/A' is NaN and the observation is dropped
+        temperature = parse_number(cells[1].text)
+        humidity = parse_number(cells[5].text)
+        if math.isnan(temperature) or math.isnan(humidity):
+            continue
+        hours.setdefault(hour, []).append((temperature, humidity))
+    day = datetime(date.year, date.month, date.day)
+    return [(day + timedelta(hours=hour),
+             round(sum(t for t, _ in values) / len(values), 2),
+             round(sum(h for _, h in values) / len(values), 2))
+            for hour, values in sorted(hours.items())]
+
+
+class RateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HttpFetcher:
+    """Fetches the day's table fragment with one pooled requests session."""
+
+    def __init__(self, workers, limiter):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.limiter = limiter
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=2))
+
+    def fetch(self, date):
+        self.limiter.wait()
+        params = {'n': CITY, 'mode': 'historic', 'hd': date.strftime('%Y%m%d'),
+                  'month': date.month, 'year': date.year}
+        response = self.session.get(DAY_URL, params=params, timeout=(5, 20))
+        response.raise_for_status()
+        return response.text
+
+    def close(self):
+        self.session.close()
+
+
+class DriverFetcher:
+    """Fetches the full page with a pool of reusable Chrome drivers, one per worker."""
+
+    def __init__(self, workers, limiter):
+        self.limiter = limiter
+        self.workers = workers
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+
+    def _driver(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.drivers) < self.workers:
+                from selenium import webdriver
+                options = webdriver.ChromeOptions()
+                options.add_argument('--headless=new')
+                driver = webdriver.Chrome(options=options)
+                self.drivers.append(driver)
+                return driver
+        return self.idle.get()
+
+    def fetch(self, date):
+        from selenium.webdriver.support.ui import Select, WebDriverWait
+        from selenium.webdriver.common.by import By
+
+        driver = self._driver()
+        try:
+            self.limiter.wait()
+            driver.get(f'{BASE_URL}?month={date.month}&year={date.year}')
+            # Convert date to the format expected by the dropdown
+            day_dropdown = Select(driver.find_element(By.ID, 'wt-his-select'))
+            day_dropdown.select_by_visible_text(f"{date.day} {date.strftime('%B')} {date.year}")
+            # Wait until the table shows the selected day instead of sleeping a fixed time
+            WebDriverWait(driver, 20).until(
+                lambda d: date.strftime('%d %b').lstrip('0') in d.find_element(By.ID, 'wt-his').text)
+            return driver.page_source
+        finally:
+            self.idle.put(driver)
+
+    def close(self):
+        for driver in self.drivers:
+            driver.quit()
+
+
+def cache_path(cache_dir, date):
+    return os.path.join(cache_dir, f"{date.strftime('%Y%m%d')}.html") if cache_dir else None
+
+
+def cached_fetch(fetcher, date, cache_dir):
+    """The day's page and whether it came from the cache; fetched pages are cached by write_cache once they parse."""
+    path = cache_path(cache_dir, date)
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            return file.read(), True
+    return fetcher.fetch(date), False
+
+
+def write_cache(cache_dir, date, html):
+    path = cache_path(cache_dir, date)
+    if path:
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(html)
+        os.replace(path + '.tmp', path)
+
+
+def drop_cache(cache_dir, date):
+    # A cached page that no longer parses (an error page, a changed layout) is refetched next run
+    path = cache_path(cache_dir, date)
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def load_checkpoint(path):
     try:
-        day_dropdown = Select(driver.find_element(By.ID, 'wt-his-select'))
-        day_dropdown.select_by_visible_text(f"{day} {month} {year}")
-    except Exception as e:
-        print(f"Error selecting date from dropdown: {e}")
-        driver.quit()
-        return
-    
-    # Wait for the page to load the new data
-    time.sleep(3)
-    
-    # Fetch the HTML content of the page
-    soup = BeautifulSoup(driver.page_source, 'html.parser')
-    
-    # Find the table by its ID
-    table = soup.find('table', {'id': 'wt-his'})
-
-    if not table:
-        print(f"No data found for the specified date: {date.strftime('%d-%m-%Y')}")
-        driver.quit()
-        return
-
-    # Initialize a list to store the data
-    data = []
-
-    # Iterate over each row in the table body (skipping the header)
-    for i, row in enumerate(table.find('tbody').find_all('tr')):
-        # Extract data from each column
-        time_ = row.find('th').text.strip()
-        
-        # Reformat time to 'HH:MM' and remove day and date
-        time_ = time_.split(' ')[0]  # Split by space and take the first part, which is 'HH:MM'
-        
-        # Ensure the first time entry is '00:00'
-        if i == 0:
-            time_ = '00:00'
-        
-        temp = row.find_all('td')[1].text.strip()
-        humidity = row.find_all('td')[5].text.strip()  # Corrected column for humidity
-        
-        # Append the data as a tuple to the list
-        data.append((time_, temp, humidity))
-
-    # Create a DataFrame
-    df = pd.DataFrame(data, columns=['Time', 'Temperature', 'Humidity'])
-
-    # Convert date to DDMMYYYY format for the filename
-    date_ddmmyyyy = date.strftime('%d%m%Y')
-    filename = f'hourly_weather_data_{date_ddmmyyyy}.csv'
-    
-    # Save the DataFrame to a CSV file
-    df.to_csv(filename, index=False)
-
-    print(f"Scraping completed and data saved to '{filename}'.")
-
-    # Quit the driver
-    driver.quit()
-
-# Base URL of the manually set page
-base_url = 'https://www.timeanddate.com/weather/singapore/singapore/historic?month=4&year=2023'
-
-# Prompt the user to enter the starting and ending dates manually in DDMMYYYY format
-start_date_input = input("Enter the start date (DDMMYYYY): ")
-end_date_input = input("Enter the end date (DDMMYYYY): ")
-
-# Convert the input dates to a proper format
-try:
-    start_date = pd.to_datetime(start_date_input, format='%d%m%Y')
-    end_date = pd.to_datetime(end_date_input, format='%d%m%Y')
-except ValueError:
-    print("Invalid date format. Please enter the dates in DDMMYYYY format.")
-    exit()
-
-# Loop through the date range and scrape data for each day
-current_date = start_date
-while current_date <= end_date:
-    scrape_weather_data_from_page(base_url, current_date)
-    current_date += timedelta(days=1)
+        with open(path) as file:
+            return set(json.load(file)['done'])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+
+def save_checkpoint(path, done):
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'done': sorted(done)}, file)
+    os.replace(path + '.tmp', path)
+
+
+def scrape(start_date, end_date, mode='selenium', workers=MAX_WORKERS, cache_dir=CACHE_DIR,
+           checkpoint_file=CHECKPOINT_FILE, store_file=STORE_FILE, interval=REQUEST_INTERVAL):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    done = load_checkpoint(checkpoint_file)
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    todo = [day for day in days if day.strftime('%Y%m%d') not in done]
+    print(f"{len(days)} days requested, {len(days) - len(todo)} already scraped")
+
+    limiter = RateLimiter(interval)
+    fetcher = (HttpFetcher if mode == 'http' else DriverFetcher)(workers, limiter)
+    store = WeatherStore(store_file)
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(cached_fetch, fetcher, day, cache_dir): day for day in todo}
+            # Parsing and saving happen here, on one thread, as the pages come in
+            for future in as_completed(futures):
+                day = futures[future]
+                try:
+                    html, cached = future.result()
+                except Exception as e:
+                    print(f"Error scraping {day:%d-%m-%Y}: {e}")
+                    failed.append(day)
+                    continue
+                try:
+                    rows = parse_history_table(html, day)
+                except Exception as e:
+                    print(f"Error parsing {day:%d-%m-%Y}: {e}")
+                    rows = []
+                if not rows:
+                    print(f"No data found for the specified date: {day:%d-%m-%Y}")
+                    if cached:
+                        drop_cache(cache_dir, day)
+                    failed.append(day)
+                    continue
+                if not cached:
+                    write_cache(cache_dir, day, html)
+                store.ingest(*zip(*rows))
+                done.add(day.strftime('%Y%m%d'))
+                save_checkpoint(checkpoint_file, done)
+                print(f"Scraped {day:%d-%m-%Y}: {len(rows)} hours")
+    finally:
+        fetcher.close()
+    print(f"Scraping completed: {len(todo) - len(failed)} days saved to '{store_file}', {len(failed)} failed")
+    return failed
+
+
+def check_fixtures(fixture_dir=FIXTURE_DIR):
+    """Parse every saved page in fixture_dir (historic_YYYYMMDD*.html) and compare it with the rows in the
+    .expected.csv next to it; returns True if all match."""
+    ok = True
+    names = sorted(name for name in os.listdir(fixture_dir) if name.endswith('.html'))
+    for name in names:
+        stem = name[:-len('.html')]
+        date = datetime.strptime(re.search(r'\d{8}', stem).group(), '%Y%m%d')
+        with open(os.path.join(fixture_dir, name), encoding='utf-8') as file:
+            rows = [f"{hour:%Y-%m-%d %H:%M},{temperature},{humidity}"
+                    for hour, temperature, humidity in parse_history_table(file.read(), date)]
+        with open(os.path.join(fixture_dir, stem + '.expected.csv'), encoding='utf-8') as file:
+            expected = [line.strip() for line in file if line.strip()]
+        passed = rows == expected
+        ok = ok and passed
+        print(f"{name:<40} {len(rows):>3} hours  {'ok' if passed else 'MISMATCH'}")
+        if not passed:
+            for line in sorted(set(expected) - set(rows)):
+                print(f"  missing    {line}")
+            for line in sorted(set(rows) - set(expected)):
+                print(f"  unexpected {line}")
+    if not names:
+        print(f"No fixtures in {fixture_dir}")
+    return ok and bool(names)
+
+
+def parse_date(text):
+    return datetime.strptime(text, '%d%m%Y')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape historical hourly weather from timeanddate.com")
+    parser.add_argument('--start', type=parse_date, help="Start date, DDMMYYYY")
+    parser.add_argument('--end', type=parse_date, help="End date, DDMMYYYY")
+    parser.add_argument('--mode', choices=['http', 'selenium'], default='selenium',
+                        help="A pool of Chrome drivers (default) or plain HTTP requests to the table "
+                             "endpoint, not yet verified against the live site")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--interval', type=float, default=REQUEST_INTERVAL, help="Minimum seconds between requests")
+    parser.add_argument('--no-cache', action='store_true', help="Do not read or write the page cache")
+    parser.add_argument('--store', default=STORE_FILE, help="Weather store the days are written to")
+    parser.add_argument('--parse', metavar='HTML', help="Only parse a saved page for --start and print the rows")
+    parser.add_argument('--check-fixtures', nargs='?', const=FIXTURE_DIR, metavar='DIR',
+                        help="Check the parser against the saved pages in DIR and exit")
+    args = parser.parse_args(argv)
+
+    if args.check_fixtures:
+        return 0 if check_fixtures(args.check_fixtures) else 1
+
+    if args.parse:
+        with open(args.parse, encoding='utf-8') as file:
+            for hour, temperature, humidity in parse_history_table(file.read(), args.start or datetime.now()):
+                print(f"{hour:%Y-%m-%d %H:%M},{temperature},{humidity}")
+        return 0
+
+    # Prompt for the dates when they are not given on the command line
+    try:
+        start_date = args.start or parse_date(input("Enter the start date (DDMMYYYY): "))
+        end_date = args.end or parse_date(input("Enter the end date (DDMMYYYY): "))
+    except ValueError:
+        print("Invalid date format. Please enter the dates in DDMMYYYY format.")
+        return 1
+
+    failed = scrape(start_date, end_date, args.mode, args.workers, None if args.no_cache else CACHE_DIR,
+                    CHECKPOINT_FILE, args.store, args.interval)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import argparse
+import threading
+
+import numpy as np
+
+THRESHOLD_FILE = "best_threshold.pkl"  # The single cut-off picked offline on the labelled test losses
+DEFAULT_THRESHOLD = 0.35
+DEFAULT_MARGIN = 1.25  # The adapted threshold sits this far above the device's quantile
+LEARN_SAMPLES = 10000  # Losses a sketch learns from before it is frozen as the device's baseline
+SKETCH_FILE = "threshold_sketches.json"
+
+
+class P2Quantile:
+    """Streaming estimate of one quantile in constant memory (Jain & Chlamtac's P² algorithm).
+
+    Keeps five markers (min, p/2, p, (1+p)/2, max) whose heights are nudged
+    with a piecewise-parabolic fit as values arrive. Until five values have
+    been seen the exact quantile of those values is returned.
+    """
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.count = 0
+        self.heights = []  # Marker heights, q
+        self.positions = [0, 1, 2, 3, 4]  # Actual marker positions, n
+        self.desired = [0, 2 * quantile, 4 * quantile, 2 + 2 * quantile, 4]  # Desired positions, n'
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, stretching the extreme markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        positions, desired = self.positions, self.desired
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            desired[i] += self.increments[i]
+
+        # Move the middle markers towards their desired positions, one step at a time
+        for i in range(1, 4):
+            offset = desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        if not self.count:
+            return None
+        if self.count <= 5:
+            return float(np.quantile(self.heights, self.quantile))
+        return self.heights[2]
+
+    def state(self):
+        return {'count': self.count, 'heights': list(self.heights), 'positions': list(self.positions),
+                'desired': list(self.desired)}
+
+    @classmethod
+    def from_state(cls, quantile, state):
+        sketch = cls(quantile)
+        sketch.count = state['count']
+        sketch.heights = [float(h) for h in state['heights']]
+        sketch.positions = [int(n) for n in state['positions']]
+        sketch.desired = [float(n) for n in state['desired']]
+        return sketch
+
+
+def load_fallback_threshold(path=THRESHOLD_FILE, default=DEFAULT_THRESHOLD):
+    """best_threshold.pkl when there is one, otherwise the old hard-coded cut-off."""
+    if not os.path.exists(path):
+        return default
+    import joblib
+
+    try:
+        return float(joblib.load(path))
+    except Exception as e:
+        print(f"Could not read {path}, using {default}: {e}")
+        return default
+
+
+class AdaptiveThresholds:
+    """Per-device anomaly thresholds: a high quantile of each device's own reconstruction losses.
+
+    Losses go into a P² sketch for their device and, with per_hour, into one
+    for their device and hour of day. The threshold is margin times the
+    quantile of the most specific sketch that has seen min_samples losses
+    (device and hour, then device), and never below the fallback
+    (best_threshold.pkl): a noisy device gets a higher cut-off, a quiet one
+    keeps the global one instead of flagging its own top 1% forever.
+
+    A sketch learns from the first learn_samples losses and is then frozen as
+    the device's baseline, and once it is in use losses over the threshold are
+    not added: a sustained rise keeps being flagged instead of becoming the
+    device's new normal. Leaving anomalies out trims the top of the sketch, but
+    only above margin times the quantile, so the quantile settles slightly
+    lower instead of drifting down; the floor bounds it either way. After a
+    legitimate change (a sensor moved or replaced) `reset` drops the device's
+    sketches so it learns again.
+
+    The sketches are written to path by save() and read back on start, so a
+    restarted monitor keeps its thresholds.
+    """
+
+    def __init__(self, quantile=0.99, per_hour=False, min_samples=500, fallback=DEFAULT_THRESHOLD,
+                 path=SKETCH_FILE, margin=DEFAULT_MARGIN, learn_samples=LEARN_SAMPLES):
+        self.quantile = quantile
+        self.margin = margin
+        self.learn_samples = learn_samples
+        self.per_hour = per_hour
+        self.min_samples = min_samples
+        self.fallback = fallback
+        self.path = path
+        self.sketches = {}  # device, or (device, hour) -> P2Quantile
+        self.lock = threading.Lock()
+        # Held for a whole save(), so two savers never share the temp file or set saved_updates out of order;
+        # observe() only waits for the in-memory snapshot, never for the disk
+        self.save_lock = threading.Lock()
+        self.updates = 0
+        self.saved_updates = 0
+        self.load()
+
+    def _sketch(self, key):
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = P2Quantile(self.quantile)
+        return sketch
+
+    def _threshold(self, device, hour):
+        keys = ((device, hour), device) if self.per_hour else (device,)
+        for key in keys:
+            sketch = self.sketches.get(key)
+            if sketch is not None and sketch.count >= self.min_samples:
+                return max(self.fallback, self.margin * sketch.value())
+        return self.fallback
+
+    def threshold(self, device, hour=None):
+        with self.lock:
+            return self._threshold(device, hour)
+
+    def observe(self, device, hour, loss):
+        """The device's current threshold, then a normal loss is added to its sketches; returns
+        (threshold, is_anomaly)."""
+        with self.lock:
+            threshold = self._threshold(device, hour)
+            is_anomaly = loss > threshold
+            for key in ((device, (device, hour)) if self.per_hour else (device,)):
+                sketch = self._sketch(key)
+                # Until it has min_samples the sketch takes every loss: the fallback says nothing yet about
+                # what is normal for this device
+                if sketch.count < self.learn_samples and (not is_anomaly or sketch.count < self.min_samples):
+                    sketch.add(loss)
+                    self.updates += 1
+        return threshold, is_anomaly
+
+    def reset(self, devices):
+        """Forget the sketches of the given devices, so they learn their baseline again."""
+        with self.lock:
+            for key in [key for key in self.sketches if (key[0] if isinstance(key, tuple) else key) in devices]:
+                del self.sketches[key]
+            self.updates += 1
+
+    def stats(self):
+        with self.lock:
+            devices = [key for key in self.sketches if not isinstance(key, tuple)]
+            adapted = sum(1 for key in devices if self.sketches[key].count >= self.min_samples)
+        return {'devices': len(devices), 'adapted': adapted, 'sketches': len(self.sketches), 'updates': self.updates}
+
+    def save(self):
+        """Checkpoint the sketches if anything changed; written next to the file and swapped in."""
+        if not self.path:
+            return False
+        with self.save_lock:
+            with self.lock:
+                if self.updates == self.saved_updates:
+                    return False
+                updates = self.updates
+                sketches = [{'device': key[0] if isinstance(key, tuple) else key,
+                             'hour': key[1] if isinstance(key, tuple) else None, **sketch.state()}
+                            for key, sketch in self.sketches.items()]
+                data = {'quantile': self.quantile, 'sketches': sketches}
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.path)
+            self.saved_updates = updates
+        return True
+
+    def load(self):
+        if not self.path:
+            return False
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            if data['quantile'] != self.quantile:
+                print(f"Ignoring {self.path}: its sketches track the {data['quantile']} quantile, not {self.quantile}")
+                return False
+            sketches = {}
+            for entry in data['sketches']:
+                key = entry['device'] if entry['hour'] is None else (entry['device'], entry['hour'])
+                sketches[key] = P2Quantile.from_state(self.quantile, entry)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Could not read {self.path}, starting without adapted thresholds: {e}")
+            return False
+        with self.lock:
+            self.sketches = sketches
+        return True
+
+
+def simulate(min_samples=500, seed=2):
+    """Fraction of readings flagged for a quiet device, a noisy one, and the noisy one after its losses rise."""
+    rng = np.random.default_rng(seed)
+    thresholds = AdaptiveThresholds(min_samples=min_samples, path=None)
+    streams = (('quiet', 'quiet', rng.lognormal(-3.0, 0.3, 20000)),
+               ('noisy', 'noisy', rng.lognormal(-1.2, 0.3, 20000)),
+               ('noisy, then 1.5x', 'noisy', 1.5 * rng.lognormal(-1.2, 0.3, 20000)))
+    for name, device, losses in streams:
+        flagged = sum(thresholds.observe(device, None, loss)[1] for loss in losses)
+        print(f"{name:<18} threshold {thresholds.threshold(device):.4f}  flagged {flagged / len(losses):.2%}")
+
+
+def check(losses, quantiles=(0.9, 0.95, 0.99)):
+    """P² estimates against the exact quantiles of the losses, fed in their order and shuffled."""
+    losses = np.asarray(losses, dtype=np.float64)
+    shuffled = np.random.default_rng(0).permutation(losses)
+    for quantile in quantiles:
+        exact = float(np.quantile(losses, quantile))
+        for name, stream in (('in order', losses), ('shuffled', shuffled)):
+            sketch = P2Quantile(quantile)
+            for loss in stream:
+                sketch.add(loss)
+            print(f"q{quantile:<5} {name:<9} exact {exact:.4f}  P2 {sketch.value():.4f}  "
+                  f"relative error {abs(sketch.value() - exact) / exact:.2%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-device adaptive anomaly thresholds")
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('show', help="Print the thresholds in a sketch checkpoint")
+    show.add_argument('path', nargs='?', default=SKETCH_FILE)
+    show.add_argument('--quantile', type=float, default=0.99)
+    verify = commands.add_parser('check', help="Compare P² with exact quantiles on saved or synthetic losses")
+    verify.add_argument('losses', nargs='?', help="A pickled (losses, labels) file, e.g. test_mae_loss_and_labels.pkl")
+    verify.add_argument('--samples', type=int, default=100000, help="Synthetic losses when no file is given")
+    forget = commands.add_parser('reset', help="Drop devices' sketches so they learn again (stop the monitor first)")
+    forget.add_argument('devices', nargs='+')
+    forget.add_argument('--path', default=SKETCH_FILE)
+    forget.add_argument('--quantile', type=float, default=0.99)
+    args = parser.parse_args(argv)
+
+    if args.command == 'check':
+        if args.losses:
+            import joblib
+            losses = np.ravel(joblib.load(args.losses)[0])
+        else:
+            losses = np.random.default_rng(1).lognormal(-1.5, 0.5, args.samples)
+        check(losses)
+        simulate()
+        return 0
+
+    thresholds = AdaptiveThresholds(args.quantile, path=args.path, fallback=load_fallback_threshold())
+    if args.command == 'reset':
+        thresholds.reset(set(args.devices))
+        thresholds.save()
+        return 0
+    for key, sketch in sorted(thresholds.sketches.items(), key=lambda item: str(item[0])):
+        device, hour = key if isinstance(key, tuple) else (key, None)
+        print(f"{key!s:<40} {sketch.count:>10} losses  q{args.quantile} = {sketch.value():.4f}  "
+              f"threshold {thresholds.threshold(device, hour):.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
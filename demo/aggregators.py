@@ -0,0 +1,113 @@
+import math
+
+
+class RunningStats:
+    """Constant-memory count/sum/min/max/variance of a stream of values (Welford)."""
+
+    __slots__ = ('count', 'total', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            for name in self.__slots__:
+                setattr(self, name, getattr(other, name))
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else None
+
+    def mean_and_count(self):
+        # Same (mean, count) pair the hourly store keeps per column
+        return (self.mean if self.count else None), self.count
+
+    def to_dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'total': self.total, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        if data.get('count'):
+            for name in cls.__slots__:
+                setattr(stats, name, data[name])
+        return stats
+
+
+class ReadingAggregate:
+    """Running temperature and humidity stats, for a device's hour or for the climate samples."""
+
+    __slots__ = ('temperature', 'humidity')
+
+    def __init__(self):
+        self.temperature = RunningStats()
+        self.humidity = RunningStats()
+
+    def add(self, temperature, humidity):
+        self.temperature.add(temperature)
+        self.humidity.add(humidity)
+
+    def merge(self, other):
+        self.temperature.merge(other.temperature)
+        self.humidity.merge(other.humidity)
+
+    def clear(self):
+        self.temperature.clear()
+        self.humidity.clear()
+
+    def is_empty(self):
+        return self.temperature.count == 0 and self.humidity.count == 0
+
+    def __repr__(self):
+        return (f"ReadingAggregate(n={self.temperature.count}, temperature={self.temperature.mean_and_count()[0]}, "
+                f"humidity={self.humidity.mean_and_count()[0]})")
+
+    def to_dict(self):
+        return {'temperature': self.temperature.to_dict(), 'humidity': self.humidity.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregate = cls()
+        # Older devices.json files kept every reading as a list of {'temperature', 'humidity'} dicts
+        if isinstance(data, list):
+            for reading in data:
+                aggregate.add(reading.get('temperature'), reading.get('humidity'))
+        elif data:
+            aggregate.temperature = RunningStats.from_dict(data.get('temperature', {}))
+            aggregate.humidity = RunningStats.from_dict(data.get('humidity', {}))
+        return aggregate
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import deque
+
+
+class MicroBatcher:
+    """Collects submitted items and hands them to process(items) in batches, on one worker thread.
+
+    A batch is started by the first pending item and closed when it holds
+    max_batch items or max_delay_ms has passed since that item arrived, so a
+    lone reading waits at most max_delay_ms and a burst shares one call. At
+    most maxsize items wait; beyond that the oldest are dropped and counted.
+    """
+
+    def __init__(self, process, max_batch=64, max_delay_ms=20, maxsize=10000, name="micro-batcher",
+                 recent=1000):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.maxsize = maxsize
+        self.name = name
+        self.items = deque()  # (enqueued_at, item)
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # Counters
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_batch_seen = 0
+        self.queue_times = deque(maxlen=recent)  # Seconds from submit() to process() of the latest items
+        self.batch_times = deque(maxlen=recent)  # Seconds spent in process() for the latest batches
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append((time.monotonic(), item))
+            self.submitted += 1
+            self.condition.notify()
+
+    def _take_batch(self):
+        with self.condition:
+            while self.running and not self.items:
+                self.condition.wait()
+            if not self.items:
+                return []
+            # The oldest pending item decides how much longer the batch may wait
+            deadline = self.items[0][0] + self.max_delay
+            while self.running and len(self.items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            count = min(len(self.items), self.max_batch)
+            return [self.items.popleft() for _ in range(count)]
+
+    def _run(self):
+        while self.running or self.items:
+            batch = self._take_batch()
+            if not batch:
+                continue
+            started = time.monotonic()
+            for enqueued_at, _ in batch:
+                self.queue_times.append(started - enqueued_at)
+            try:
+                self.process([item for _, item in batch])
+            except Exception as e:
+                self.errors += 1
+                print(f"Error processing a batch of {len(batch)} in {self.name}: {e}")
+            self.batch_times.append(time.monotonic() - started)
+            self.batches += 1
+            self.processed += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+    def stats(self):
+        def percentile(values, fraction):
+            values = sorted(values)
+            return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+        with self.condition:
+            depth = len(self.items)
+        queue_times = list(self.queue_times)
+        return {'depth': depth, 'submitted': self.submitted, 'processed': self.processed, 'dropped': self.dropped,
+                'errors': self.errors, 'batches': self.batches,
+                'mean_batch': self.processed / self.batches if self.batches else None,
+                'max_batch': self.max_batch_seen,
+                'queue_ms_p50': _ms(percentile(queue_times, 0.5)), 'queue_ms_p99': _ms(percentile(queue_times, 0.99)),
+                'batch_ms_p50': _ms(percentile(list(self.batch_times), 0.5))}
+
+    def stop(self, timeout=5.0):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
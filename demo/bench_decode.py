@@ -0,0 +1,64 @@
+import json
+import random
+import time
+
+from zigbee_decode import decode_reading, JSON_BACKEND
+
+# Micro-benchmark of the MQTT payload decode path, old (stdlib json on every message) vs zigbee_decode.
+# Messages mimic device_simul.py sensor payloads mixed with zigbee2mqtt bridge traffic.
+
+DEVICE_IDS = [f"0x{random.getrandbits(56):014x}" for _ in range(200)]
+MESSAGES = 200000
+SENSOR_FRACTION = 0.7
+
+
+def make_sensor_message(device_name):
+    data = {
+        "co2": random.randint(400, 1000),
+        "formaldehyd": random.randint(10, 100),
+        "humidity": round(random.uniform(30, 60), 1),
+        "linkquality": 255,
+        "pm25": random.randint(0, 50),
+        "temperature": round(random.uniform(20, 30), 1),
+        "voc": random.randint(100, 500)
+    }
+    return f"zigbee2mqtt/{device_name}", json.dumps(data).encode('utf-8')
+
+
+def make_bridge_message():
+    if random.random() < 0.5:
+        data = {"level": "info", "message": f"MQTT publish: topic 'zigbee2mqtt/{random.choice(DEVICE_IDS)}', payload '...'"}
+        return "zigbee2mqtt/bridge/logging", json.dumps(data).encode('utf-8')
+    data = {"linkquality": random.randint(0, 255), "battery": random.randint(0, 100)}
+    return f"zigbee2mqtt/{random.choice(DEVICE_IDS)}", json.dumps(data).encode('utf-8')
+
+
+# The decode steps the capture script used to run for every message
+def old_decode(topic, payload):
+    device_name = topic.split('/')[1]
+    if device_name == 'bridge':
+        return None
+    data = json.loads(payload.decode('utf-8'))
+    if 'temperature' in data and 'humidity' in data:
+        return device_name, data['temperature'], data['humidity']
+    return None
+
+
+def run(decode, messages):
+    start = time.perf_counter()
+    decoded = 0
+    for topic, payload in messages:
+        if decode(topic, payload) is not None:
+            decoded += 1
+    return time.perf_counter() - start, decoded
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    messages = [make_sensor_message(random.choice(DEVICE_IDS)) if random.random() < SENSOR_FRACTION
+                else make_bridge_message() for _ in range(MESSAGES)]
+    print(f"{MESSAGES} messages, {SENSOR_FRACTION:.0%} sensor readings, JSON backend: {JSON_BACKEND}")
+    for name, decode in [("json.loads every message", old_decode), ("zigbee_decode", decode_reading)]:
+        run(decode, messages[:1000])  # Warm up
+        elapsed, decoded = run(decode, messages)
+        print(f"{name:<26} {elapsed:.3f}s  {MESSAGES / elapsed:>10,.0f} msg/s  {elapsed / MESSAGES * 1e6:.2f} us/msg  ({decoded} readings)")
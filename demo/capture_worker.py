@@ -0,0 +1,269 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+from aggregators import ReadingAggregate
+from device_registry import DeviceRegistry
+from hourly_store import HourlyStore, open_store, to_epoch_hour
+from rollups import Rollups, RollupStore, CLIMATE_SERIES
+from wal import WriteAheadLog, CLIMATE, SNAPSHOT
+from windowing import HourlyWindows, hour_of, choose_event_time, parse_device_time, DROPPED
+from zigbee_decode import decode_reading
+
+
+# Function to generate the CSV filename based on the month and device number
+def get_csv_filename(device_number, when=None):
+    when = when or datetime.now()
+    return f"device_{device_number}_temperature_data_{when.strftime('%Y-%m')}.csv"
+
+
+# The store records of a flush in progress, written before its WAL checkpoint commits; see CaptureWorker.checkpoint
+FLUSH_INTENT_FILE = "flush.intent"
+STORE_TYPES = {'hourly': HourlyStore, 'rollup': RollupStore}
+
+
+# Turn an MQTT message into record_reading()'s arguments, or None if it is not a sensor reading
+def reading_from_message(topic, payload, received_at):
+    # Bridge and command topics are rejected before the payload is looked at
+    reading = decode_reading(topic, payload)
+    if reading is None:
+        return None
+    # Extract temperature, humidity, and the time the reading was taken
+    device_name, temperature, humidity, last_seen = reading
+    timestamp = choose_event_time(parse_device_time(last_seen), received_at)
+    return device_name, round(temperature, 2), round(humidity, 2), timestamp
+
+
+class CaptureWorker:
+    """The capture state of one process: hourly windows, rollups, WAL, hourly stores and registry.
+
+    Not thread-safe; every method runs on a single thread (the ingest writer
+    thread in device_capture.py, the worker process loop in sharded_capture.py).
+    """
+
+    def __init__(self, data_dir='.', wal_dir='wal', registry_file='devices.db', devices_file=None,
+                 wal_commit_interval_ms=200, wal_segment_bytes=16 * 1024 * 1024, log=print, log_readings=True, owns=None,
+                 max_out_of_order=timedelta(minutes=2), allowed_lateness=timedelta(hours=1),
+                 rollup_dir='rollups', rollup_climate=True):
+        self.data_dir = data_dir
+        self.owns = owns  # Optional predicate on device names, for a worker that handles only some devices
+        self.log_readings = log_readings
+        self.devices_file = devices_file
+        self.log = log
+        self.hourly_stores = {}
+        # Per-hour device and climate aggregates, assigned by the time each reading was taken
+        self.windows = HourlyWindows(max_out_of_order, allowed_lateness)
+        # 1 min / 1 h / 1 day rollups of every device and of the climate samples
+        self.rollups = Rollups(rollup_dir)
+        self.rollup_climate = rollup_climate  # Only one worker may write the climate series
+        self.last_save_time = datetime.now()
+        self.wal = WriteAheadLog(wal_dir, commit_interval_ms=wal_commit_interval_ms, segment_bytes=wal_segment_bytes)
+        self.intent_path = os.path.join(wal_dir, FLUSH_INTENT_FILE)
+        self.recover_flush()
+        self.registry = DeviceRegistry(registry_file)
+        self.devices_data = self.load_devices()
+
+    def get_hourly_store(self, csv_file):
+        if csv_file not in self.hourly_stores:
+            self.hourly_stores[csv_file] = open_store(os.path.join(self.data_dir, csv_file))
+        return self.hourly_stores[csv_file]
+
+    # Build the in-memory device entry for a registered device
+    def new_device_entry(self, device_number):
+        return {'device_number': device_number, 'csv_file': get_csv_filename(device_number)}
+
+    # Look up a device's number, registering the device if it is new
+    def register_device(self, devices, device_name):
+        device_number, created = self.registry.register(device_name)
+        devices[device_name] = self.new_device_entry(device_number)
+        if created:
+            self.log(f"Device {device_name} has been added with device number {device_number}")
+        return devices[device_name]
+
+    # Load devices from the registry and rebuild the hourly windows from the write-ahead log
+    def load_devices(self):
+        legacy_hourly = {}
+        # The first start with a registry imports the old devices.json, including its in-flight readings
+        if self.devices_file and len(self.registry) == 0 and os.path.exists(self.devices_file):
+            for device_name, device_info in self.registry.import_json(self.devices_file).items():
+                if device_info.get('hourly'):
+                    legacy_hourly[device_name] = ReadingAggregate.from_dict(device_info['hourly'])
+        devices = {name: self.new_device_entry(number) for name, number in self.registry.devices().items()
+                   if self.owns is None or self.owns(name)}
+
+        # Replayed readings go back into the hour they were taken in, not the hour we restarted in
+        replayed = foreign = 0
+        for kind, device_name, timestamp, temperature, humidity in self.wal.replay():
+            replayed += 1
+            if device_name is not None and self.owns is not None and not self.owns(device_name):
+                foreign += 1  # Another worker writes this device's stores; saving it here would corrupt them
+                continue
+            if kind == CLIMATE:
+                self.windows.add_climate(timestamp, temperature, humidity)
+                if self.rollup_climate:
+                    self.rollups.add(CLIMATE_SERIES, timestamp, temperature, humidity)
+                continue
+            if device_name is not None and device_name not in devices:
+                self.register_device(devices, device_name)
+            if kind == SNAPSHOT:
+                # Older snapshots carry no hour; they hold the hour that was in progress
+                self.windows.merge(timestamp or hour_of(datetime.now()), device_name,
+                                   ReadingAggregate.from_dict(temperature))
+            else:
+                # Rollups are flushed at every checkpoint, so logged readings are not in them yet
+                self.windows.add(device_name, timestamp, temperature, humidity)
+                self.rollups.add(device_name, timestamp, temperature, humidity)
+        if replayed:
+            self.log(f"Replayed {replayed} records from the write-ahead log")
+        if foreign:
+            self.log(f"Skipped {foreign} logged records of devices this worker does not own")
+
+        # Older devices.json files carried the in-flight readings; move them into the log once
+        if legacy_hourly:
+            hour = hour_of(datetime.now())
+            for device_name, aggregate in legacy_hourly.items():
+                self.windows.merge(hour, device_name, aggregate)
+                self.wal.append_snapshot(device_name, aggregate, hour)
+            self.wal.sync()
+            self.registry.export_json(self.devices_file)
+        return devices
+
+    # The hourly store record that merges one device's aggregate for an hour, as (store, fields); checkpoint()
+    # writes it
+    def save_device_hour(self, device_name, hour, aggregate, climate):
+        if self.devices_data.get(device_name) is None:
+            self.register_device(self.devices_data, device_name)
+        device_data = self.devices_data[device_name]
+
+        # Each column is stored as (mean, count) so repeated saves of the same hour merge correctly
+        values = {
+            'device_temperature': aggregate.temperature.mean_and_count(),
+            'device_humidity': aggregate.humidity.mean_and_count(),
+            'climate_temperature': climate.temperature.mean_and_count(),
+            'climate_humidity': climate.humidity.mean_and_count(),
+        }
+
+        # The month of the hour being saved decides which file it belongs to
+        current_csv_file = get_csv_filename(device_data['device_number'], hour)
+        device_data['csv_file'] = current_csv_file
+
+        # Upsert the hour in place instead of re-reading and rewriting the month's CSV
+        store = self.get_hourly_store(current_csv_file)
+        self.log(f"Hourly average for {hour:%Y-%m-%d %H:00} saved to {store.path} for device {device_name}")
+        return store, store.merged(to_epoch_hour(hour), values)
+
+    # Save the hours the watermark has passed (or every open hour) and checkpoint the write-ahead log
+    def flush(self, everything=False):
+        due = self.windows.take(everything)
+        writes = [self.save_device_hour(device_name, hour, aggregate, climate)
+                  for hour, window, climate in due for device_name, aggregate in window.items()]
+        if due:
+            self.checkpoint(writes)
+        return sum(len(window) for _, window, _ in due)
+
+    # Apply the hourly store writes and the pending rollups, and drop what they cover from the write-ahead log.
+    # The stores merge by count, so the data must reach them exactly once, even with a crash in between: the
+    # merged records are written to the intent file first, the log checkpoint commits, and only then are the
+    # records written. A crash before the commit leaves the stores untouched and the log replays everything;
+    # after it, recover_flush() rewrites the records from the intent, which is harmless if they were written.
+    def checkpoint(self, writes=()):
+        writes = list(writes) + self.rollups.prepare()
+        if writes:
+            records = [('hourly' if isinstance(store, HourlyStore) else 'rollup', os.path.abspath(store.path), fields)
+                       for store, fields in writes]
+            with open(self.intent_path + '.tmp', 'w') as file:
+                json.dump({'wal_sequence': self.wal.sequence, 'records': records}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.intent_path + '.tmp', self.intent_path)
+        # Whatever is still unsaved in the windows is carried into the new log segment as snapshots
+        self.wal.checkpoint(self.windows.snapshot())
+        if writes:
+            for store, fields in writes:
+                store.put(fields)
+            for store in {store for store, _ in writes}:
+                store.sync()
+            os.remove(self.intent_path)
+
+    # Finish a flush that crashed after its checkpoint committed; drop one whose checkpoint never did
+    def recover_flush(self):
+        try:
+            with open(self.intent_path) as file:
+                intent = json.load(file)
+        except FileNotFoundError:
+            return
+        if self.wal.checkpointed > intent['wal_sequence']:
+            for kind, path, fields in intent['records']:
+                store = STORE_TYPES[kind](path)
+                store.put(fields)
+                store.sync()
+                store.close()
+            self.log(f"Finished writing {len(intent['records'])} store records of an interrupted flush")
+        os.remove(self.intent_path)
+
+    # Write the hourly stores back out as the monthly CSV files
+    def export_csv_files(self):
+        for csv_file, store in self.hourly_stores.items():
+            csv_path = os.path.join(self.data_dir, csv_file)
+            store.export_csv(csv_path)
+            self.log(f"Exported {store.path} to {csv_path}")
+
+    def save_all_devices(self, final_save=False, force_save=False):
+        now = datetime.now()
+        if (now - self.last_save_time).seconds < 3600 and not final_save and not force_save:
+            self.log("Skipping save: Less than an hour since last save and not final save or force save.")
+            return  # Avoid multiple saves within the same hour unless forced
+
+        self.log("Saving data for all devices...")
+        saved = self.flush(everything=True)  # Includes the hour in progress; later readings merge into it
+        if not saved:
+            self.checkpoint()
+        self.log(f"Saved {saved} device hours, windows: {self.windows.stats()}")
+        if final_save:
+            self.export_csv_files()
+            if self.devices_file:
+                self.registry.export_json(self.devices_file)  # Keep devices.json readable for other tools
+        self.last_save_time = now
+        self.log("Data saved successfully.")
+
+    def record_reading(self, device_name, temperature, humidity, timestamp):
+        # Initialize device data if not already present; the registry insert is a single row
+        device_data = self.devices_data.get(device_name)
+        if device_data is None:
+            device_data = self.register_device(self.devices_data, device_name)
+
+        if self.log_readings:
+            self.log(f"Device {device_data['device_number']} is responding")
+
+        if self.windows.add(device_name, timestamp, temperature, humidity) == DROPPED:
+            self.log(f"Dropped a reading from {device_name} taken at {timestamp}: later than the allowed lateness")
+            return
+        # Log every accepted reading; a replay after a restart has no watermark to drop them again
+        self.wal.append_reading(device_name, timestamp, temperature, humidity)
+        self.rollups.add(device_name, timestamp, temperature, humidity)
+
+        # Save an hour as soon as the watermark passes it; late deltas wait for the next tick()
+        if self.windows.has_due(include_late=False):
+            self.flush()
+
+    # Called periodically: moves the watermark on by wall-clock time, saves late data and the rollups
+    def tick(self, now=None):
+        self.windows.advance((now or datetime.now()) - self.windows.max_out_of_order)
+        if self.windows.has_due():
+            self.flush()
+        elif self.rollups.pending:
+            self.checkpoint()
+
+    def record_climate(self, climate_temperature, climate_humidity, timestamp=None):
+        timestamp = timestamp or datetime.now()
+        self.wal.append_climate(timestamp, climate_temperature, climate_humidity)
+        self.windows.add_climate(timestamp, climate_temperature, climate_humidity)
+        if self.rollup_climate:
+            self.rollups.add(CLIMATE_SERIES, timestamp, climate_temperature, climate_humidity)
+
+    def close(self):
+        self.wal.close()
+        self.rollups.close()
+        self.registry.close()
+        for store in self.hourly_stores.values():
+            store.close()
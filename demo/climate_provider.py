@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from get_climate_data import fetch_climate_data
+
+CLIMATE_SNAPSHOT_FILE = "climate_snapshot.json"
+
+# One climate observation; fetched_at is the naive local time it was fetched
+ClimateSample = namedtuple('ClimateSample', ['temperature', 'humidity', 'fetched_at'])
+
+
+class ClimateProvider:
+    """Cached OpenWeatherMap climate values shared by everything in a process.
+
+    get() returns the cached sample while it is younger than ttl. A sample that
+    is older but still younger than max_stale is returned immediately while one
+    background refresh replaces it (stale-while-revalidate). Only without any
+    usable sample does get() wait for a fetch. Concurrent refreshes collapse into
+    one request (single-flight), requests are at least min_interval apart, and
+    failures back off exponentially up to max_backoff.
+
+    Every fetched sample is written to snapshot_path. A restarted process starts
+    from it, and processes sharing the file (capture and monitor) pick up each
+    other's fetches instead of calling the API again.
+    """
+
+    def __init__(self, api_key, lat, lon, ttl=600, max_stale=6 * 3600, min_interval=60, max_backoff=1800,
+                 snapshot_path=CLIMATE_SNAPSHOT_FILE, fetch=fetch_climate_data):
+        self.api_key = api_key
+        self.lat = lat
+        self.lon = lon
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.snapshot_path = snapshot_path
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.inflight = None  # Event of the refresh in progress
+        self.sample = None
+        self.fetched_epoch = 0.0
+        self.next_attempt = 0.0
+        self.backoff = min_interval
+
+        # Counters
+        self.hits = 0
+        self.stale_hits = 0
+        self.fetches = 0
+        self.failures = 0
+
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path) as file:
+                data = json.load(file)
+            fetched_epoch = float(data['fetched_at'])
+            temperature, humidity = data['temperature'], data['humidity']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if fetched_epoch <= self.fetched_epoch:
+            return False
+        self.sample = ClimateSample(temperature, humidity, datetime.fromtimestamp(fetched_epoch))
+        self.fetched_epoch = fetched_epoch
+        return True
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        temp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump({'temperature': self.sample.temperature, 'humidity': self.sample.humidity,
+                           'fetched_at': self.fetched_epoch}, file)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"Could not write the climate snapshot: {e}")
+
+    def age(self):
+        return time.time() - self.fetched_epoch if self.sample is not None else None
+
+    def get(self):
+        """Return the current ClimateSample, or None if there has never been a successful fetch."""
+        age = self.age()
+        if age is not None and age < self.ttl:
+            self.hits += 1
+            return self.sample
+        if age is not None and age < self.max_stale:
+            self.stale_hits += 1
+            self.refresh_async()
+            return self.sample
+        return self.refresh()
+
+    def refresh_async(self):
+        with self.lock:
+            if self.inflight is not None or time.time() < self.next_attempt:
+                return
+        threading.Thread(target=self.refresh, name="climate-refresh", daemon=True).start()
+
+    def refresh(self):
+        """Fetch a new sample unless another thread already is (then wait for it); returns the current sample."""
+        with self.lock:
+            event = self.inflight
+            if event is None:
+                if time.time() < self.next_attempt:
+                    return self.sample
+                event = self.inflight = threading.Event()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            event.wait()
+            return self.sample
+        try:
+            # Another process may have fetched meanwhile
+            if self._load_snapshot() and self.age() < self.ttl:
+                return self.sample
+            self.fetches += 1
+            temperature, humidity = self.fetch(self.api_key, self.lat, self.lon)
+            now = time.time()
+            if temperature is None or humidity is None:
+                self.failures += 1
+                self.next_attempt = now + self.backoff
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+            else:
+                self.sample = ClimateSample(temperature, humidity, datetime.fromtimestamp(now))
+                self.fetched_epoch = now
+                self.next_attempt = now + self.min_interval
+                self.backoff = self.min_interval
+                self._save_snapshot()
+            return self.sample
+        finally:
+            with self.lock:
+                self.inflight = None
+            event.set()
+
+    def stats(self):
+        return {'age': self.age(), 'hits': self.hits, 'stale_hits': self.stale_hits,
+                'fetches': self.fetches, 'failures': self.failures}
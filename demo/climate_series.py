@@ -0,0 +1,182 @@
+import csv
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from hourly_store import LOCAL_TZ
+
+ASOF = 'asof'
+INTERPOLATE = 'interpolate'
+
+
+def to_epoch(timestamp):
+    # Naive datetimes are local (+08:00) times, as everywhere else in the capture pipeline
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=LOCAL_TZ)
+    return timestamp.timestamp()
+
+
+def to_epoch_array(timestamps):
+    """Epoch seconds for a pandas DatetimeIndex/Series, a datetime64 array or a sequence of datetimes/floats."""
+    if hasattr(timestamps, 'dt') or hasattr(timestamps, 'tz'):  # pandas Series or DatetimeIndex
+        accessor = timestamps.dt if hasattr(timestamps, 'dt') else timestamps
+        if accessor.tz is None:
+            timestamps = accessor.tz_localize(LOCAL_TZ)
+            accessor = timestamps.dt if hasattr(timestamps, 'dt') else timestamps
+        utc = accessor.tz_convert('UTC')
+        utc = (utc.dt if hasattr(utc, 'dt') else utc).tz_localize(None)
+        return np.asarray(utc, dtype='datetime64[ns]').astype('int64') / 1e9
+    array = np.asarray(timestamps)
+    if np.issubdtype(array.dtype, np.datetime64):
+        # datetime64 values carry no zone; like naive datetimes they are local time
+        return (array.astype('datetime64[ns]').astype('int64') / 1e9
+                - LOCAL_TZ.utcoffset(None).total_seconds())
+    if array.dtype == object:
+        return np.fromiter((to_epoch(value) for value in array), dtype=np.float64, count=len(array))
+    return array.astype(np.float64)
+
+
+class ClimateSeries:
+    """The last `capacity` climate samples, kept sorted by time, for aligning climate to readings.
+
+    Samples live in a ring buffer that writes every value twice (at i and
+    i + capacity), so the samples in time order are always one contiguous numpy
+    view. Single lookups are binary searches on it; join() aligns a whole batch
+    of timestamps with searchsorted and vectorized interpolation.
+
+    Lookups return (temperature, humidity) as stored, or None when there is no
+    sample at or before the timestamp, or the neighbouring samples are more
+    than max_gap seconds away.
+    """
+
+    def __init__(self, capacity=4096, max_gap=None):
+        self.capacity = capacity
+        self.max_gap = max_gap
+        self.times = np.zeros(2 * capacity)
+        self.values = np.zeros((2 * capacity, 2))
+        self.start = 0
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def _view(self):
+        return self.times[self.start:self.start + self.size], self.values[self.start:self.start + self.size]
+
+    def _put(self, logical, time, value):
+        slot = (self.start + logical) % self.capacity
+        self.times[slot] = self.times[slot + self.capacity] = time
+        self.values[slot] = self.values[slot + self.capacity] = value
+
+    def add(self, timestamp, temperature, humidity):
+        time = to_epoch(timestamp)
+        value = (temperature, humidity)
+        with self.lock:
+            times, _ = self._view()
+            if self.size and time <= times[-1]:
+                # Out of order (rare): replace an equal time, or shift the later samples up by one
+                position = int(np.searchsorted(times, time))
+                if position < self.size and times[position] == time:
+                    self._put(position, time, value)
+                    return
+                if self.size == self.capacity:
+                    if position == 0:
+                        return  # Older than everything kept
+                    self.start = (self.start + 1) % self.capacity
+                    self.size -= 1
+                    position -= 1
+                for logical in range(self.size, position, -1):
+                    source = (self.start + logical - 1) % self.capacity
+                    self._put(logical, self.times[source], self.values[source].copy())
+                self._put(position, time, value)
+                self.size += 1
+                return
+            if self.size == self.capacity:
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+            self._put(self.size, time, value)
+            self.size += 1
+
+    def latest(self):
+        with self.lock:
+            if not self.size:
+                return None
+            _, values = self._view()
+            return tuple(values[-1])
+
+    def asof(self, timestamp, max_gap=None):
+        """The latest sample at or before timestamp."""
+        max_gap = self.max_gap if max_gap is None else max_gap
+        time = to_epoch(timestamp)
+        with self.lock:
+            times, values = self._view()
+            index = int(np.searchsorted(times, time, side='right')) - 1
+            if index < 0 or (max_gap is not None and time - times[index] > max_gap):
+                return None
+            return tuple(values[index])
+
+    def interpolate(self, timestamp, max_gap=None):
+        """Linear interpolation between the samples around timestamp; after the last sample, that sample."""
+        max_gap = self.max_gap if max_gap is None else max_gap
+        time = to_epoch(timestamp)
+        with self.lock:
+            times, values = self._view()
+            index = int(np.searchsorted(times, time, side='right')) - 1
+            if index < 0:
+                return None
+            if index == self.size - 1 or times[index] == time:
+                if max_gap is not None and time - times[index] > max_gap:
+                    return None
+                return tuple(values[index])
+            t0, t1 = times[index], times[index + 1]
+            if max_gap is not None and t1 - t0 > max_gap:
+                return None
+            weight = (time - t0) / (t1 - t0)
+            return tuple(values[index] + (values[index + 1] - values[index]) * weight)
+
+    def join(self, timestamps, method=INTERPOLATE, max_gap=None):
+        """Climate for every timestamp as an (n, 2) array of (temperature, humidity); NaN where unavailable."""
+        max_gap = self.max_gap if max_gap is None else max_gap
+        query = to_epoch_array(timestamps)
+        with self.lock:
+            times, values = self._view()
+            times, values = times.copy(), values.copy()
+        result = np.full((len(query), 2), np.nan)
+        if not len(times):
+            return result
+        index = np.searchsorted(times, query, side='right') - 1
+        found = index >= 0
+        before = np.clip(index, 0, None)
+        if method == ASOF:
+            result[found] = values[before[found]]
+            if max_gap is not None:
+                result[found & (query - times[before] > max_gap)] = np.nan
+            return result
+        after = np.clip(index + 1, 0, len(times) - 1)
+        span = times[after] - times[before]
+        weight = np.divide(query - times[before], span, out=np.zeros_like(query), where=span > 0)
+        result[found] = (values[before] + (values[after] - values[before]) * weight[:, None])[found]
+        if max_gap is not None:
+            # Past the last sample the gap is to that sample, otherwise between the two neighbours
+            gap = np.where(index >= len(times) - 1, query - times[before], span)
+            result[found & (gap > max_gap)] = np.nan
+        return result
+
+    @classmethod
+    def from_csv(cls, paths, capacity=None, max_gap=None):
+        """Build a series from the climate columns of device CSV files (time, climate_temperature, climate_humidity)."""
+        rows = {}
+        for path in paths:
+            with open(path, newline='') as file:
+                for row in csv.DictReader(file):
+                    if row.get('climate_temperature') and row.get('climate_humidity'):
+                        time = datetime.fromisoformat(row['time'].strip()).timestamp()
+                        rows[time] = (float(row['climate_temperature']), float(row['climate_humidity']))
+        series = cls(capacity or max(len(rows), 1), max_gap)
+        for time in sorted(rows):
+            series.add(time, *rows[time])
+        return series
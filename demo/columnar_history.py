@@ -0,0 +1,168 @@
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+
+from hourly_store import LOCAL_TZ
+
+# Layout: <root>/<device>/<YYYY-MM>/time.i8 plus one <column>.f8 file per value column and a meta.json.
+# Times are int64 epoch seconds, values are float64 with NaN for missing data.
+HISTORY_ROOT = "history"
+TIME_COLUMN = "time"
+META_FILE = "meta.json"
+DEVICE_CSV_PATTERN = re.compile(r"(device_\d+)_temperature_data_\d{4}-\d{2}$")
+
+
+def _column_path(partition_dir, column, dtype):
+    return os.path.join(partition_dir, f"{column}.{'i8' if dtype == np.int64 else 'f8'}")
+
+
+def list_devices(root=HISTORY_ROOT):
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+
+
+def list_partitions(root, device):
+    device_dir = os.path.join(root, device)
+    if not os.path.isdir(device_dir):
+        return []
+    return sorted(name for name in os.listdir(device_dir) if os.path.exists(os.path.join(device_dir, name, META_FILE)))
+
+
+def read_partition(root, device, month):
+    """Memory-map one partition. Returns {column: read-only array}; nothing is parsed or copied."""
+    partition_dir = os.path.join(root, device, month)
+    with open(os.path.join(partition_dir, META_FILE)) as file:
+        meta = json.load(file)
+    columns = {}
+    if meta['rows'] == 0:
+        columns[TIME_COLUMN] = np.empty(0, dtype=np.int64)
+        columns.update({column: np.empty(0) for column in meta['columns']})
+        return columns
+    columns[TIME_COLUMN] = np.memmap(_column_path(partition_dir, TIME_COLUMN, np.int64), dtype=np.int64, mode='r',
+                                     shape=(meta['rows'],))
+    for column in meta['columns']:
+        columns[column] = np.memmap(_column_path(partition_dir, column, np.float64), dtype=np.float64, mode='r',
+                                    shape=(meta['rows'],))
+    return columns
+
+
+def write_partition(root, device, month, times, columns):
+    """Write one partition, merging with what is already there (rows with the same time are replaced)."""
+    partition_dir = os.path.join(root, device, month)
+    times = np.asarray(times, dtype=np.int64)
+    columns = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+    if os.path.exists(os.path.join(partition_dir, META_FILE)):
+        existing = read_partition(root, device, month)
+        keep = ~np.isin(existing[TIME_COLUMN], times)
+        names = list(dict.fromkeys(list(existing)[1:] + list(columns)))
+        merged = {}
+        for name in names:
+            old = np.asarray(existing[name])[keep] if name in existing else np.full(keep.sum(), np.nan)
+            new = columns[name] if name in columns else np.full(len(times), np.nan)
+            merged[name] = np.concatenate([old, new])
+        times = np.concatenate([np.asarray(existing[TIME_COLUMN])[keep], times])
+        columns = merged
+        del existing  # Release the memory maps before the files are replaced
+
+    # Rows are kept sorted and unique by time (the last row written wins) so range reads can use searchsorted
+    order = np.argsort(times, kind='stable')
+    is_last = np.append(times[order][1:] != times[order][:-1], True)
+    order = order[is_last]
+    times = times[order]
+    columns = {name: values[order] for name, values in columns.items()}
+
+    # Write every file next to its final name and swap it in, so open memory maps never see a half-written file
+    os.makedirs(partition_dir, exist_ok=True)
+    files = [(_column_path(partition_dir, TIME_COLUMN, np.int64), times)]
+    files += [(_column_path(partition_dir, name, np.float64), values) for name, values in columns.items()]
+    for path, values in files:
+        values.tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    meta_path = os.path.join(partition_dir, META_FILE)
+    with open(meta_path + ".tmp", 'w') as file:
+        json.dump({'rows': int(len(times)), 'columns': list(columns)}, file, indent=4)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def load(root, device, start=None, end=None):
+    """Read a device's history between epoch seconds start (inclusive) and end (exclusive).
+
+    A single partition comes back as memory-mapped slices; several partitions are
+    concatenated once.
+    """
+    parts = []
+    for month in list_partitions(root, device):
+        columns = read_partition(root, device, month)
+        times = columns[TIME_COLUMN]
+        lo = 0 if start is None else np.searchsorted(times, start, side='left')
+        hi = len(times) if end is None else np.searchsorted(times, end, side='left')
+        if hi > lo:
+            parts.append({name: values[lo:hi] for name, values in columns.items()})
+    if not parts:
+        return {TIME_COLUMN: np.empty(0, dtype=np.int64)}
+    if len(parts) == 1:
+        return parts[0]
+    names = list(dict.fromkeys(name for part in parts for name in part))
+    return {name: np.concatenate([part[name] if name in part else np.full(len(part[TIME_COLUMN]), np.nan)
+                                  for part in parts]) for name in names}
+
+
+def load_frame(root, device, start=None, end=None):
+    """Same as load() but as a DataFrame indexed by +08:00 time, like pd.read_csv(..., index_col='time')."""
+    import pandas as pd
+    columns = load(root, device, start, end)
+    index = pd.to_datetime(columns.pop(TIME_COLUMN), unit='s', utc=True).tz_convert(LOCAL_TZ)
+    return pd.DataFrame(columns, index=pd.Index(index, name=TIME_COLUMN))
+
+
+def device_name_for_csv(csv_path):
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    match = DEVICE_CSV_PATTERN.match(stem)
+    return match.group(1) if match else stem
+
+
+def convert_csv(csv_path, root=HISTORY_ROOT, device=None):
+    """Convert one history CSV into device x month partitions. Returns the number of rows written."""
+    import pandas as pd
+    device = device or device_name_for_csv(csv_path)
+    df = pd.read_csv(csv_path)
+    df = df[df[TIME_COLUMN] != TIME_COLUMN]  # Drop repeated header rows
+    times = pd.to_datetime(df[TIME_COLUMN], utc=True)
+    seconds = (times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    months = times.dt.tz_convert(LOCAL_TZ).dt.strftime('%Y-%m')
+    values = df.drop(columns=[TIME_COLUMN]).apply(pd.to_numeric, errors='coerce')
+    for month in sorted(months.unique()):
+        mask = (months == month).to_numpy()
+        write_partition(root, device, month, seconds.to_numpy()[mask],
+                        {name: values[name].to_numpy()[mask] for name in values.columns})
+    return len(df)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Columnar device x month history store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help="Convert history CSVs into the columnar store")
+    convert.add_argument('csv_files', nargs='+')
+    convert.add_argument('--root', default=HISTORY_ROOT)
+    convert.add_argument('--device', help="Device name to file the rows under (default: from the file name)")
+    info = subparsers.add_parser('info', help="List devices and partitions")
+    info.add_argument('--root', default=HISTORY_ROOT)
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        for csv_path in args.csv_files:
+            rows = convert_csv(csv_path, args.root, args.device)
+            print(f"Converted {rows} rows from {csv_path} into {args.root}/{args.device or device_name_for_csv(csv_path)}")
+    else:
+        for device in list_devices(args.root):
+            for month in list_partitions(args.root, device):
+                columns = read_partition(args.root, device, month)
+                print(f"{device}/{month}: {len(columns[TIME_COLUMN])} rows, columns {list(columns)[1:]}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,159 +1,60 @@
 import paho.mqtt.client as mqtt
-import pandas as pd
 from datetime import datetime, timedelta
 import time
-import os
-import json
 import threading
-import socket
 import sys
-from get_climate_data import fetch_climate_data  # Import the climate data function
+from climate_provider import ClimateProvider
+from capture_worker import CaptureWorker, reading_from_message
+from ingest import IngestPipeline
+from log_shipper import LogShipper
 
 # MQTT settings
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_TOPIC_BASE = "zigbee2mqtt/#"  # Subscribe to all topics under zigbee2mqtt
 
-DEVICES_FILE = "devices.json"  # File to save the devices' data
+DEVICES_FILE = "devices.json"  # Older device list, imported into the registry on first start
+REGISTRY_FILE = "devices.db"  # SQLite registry of device name -> device number
+
+# Write-ahead log of the readings that have not been saved to the hourly stores yet
+WAL_DIR = "wal"
+WAL_COMMIT_INTERVAL_MS = 200  # Readings are fsynced in groups at most this often
+WAL_SEGMENT_BYTES = 16 * 1024 * 1024
+
+# 1 min / 1 h / 1 day count/sum/min/max of every device, queried with `python rollups.py query <device>`
+ROLLUP_DIR = "rollups"
 
 # OpenWeatherMap settings
 API_KEY = "446e884fa8fcaf1e943c89605dac07e5"  # Replace with your OpenWeatherMap API key
 LAT = 1.38  # Replace with your latitude
 LON = 103.85  # Replace with your longitude
+CLIMATE_TTL = 180  # A new climate sample is fetched at most every 3 minutes; cached in climate_snapshot.json
 
-# Function to generate the CSV filename based on the current date and device number
-def get_csv_filename(device_number):
-    now = datetime.now()
-    return f"device_{device_number}_temperature_data_{now.strftime('%Y-%m')}.csv"
-
-# Function to load devices from the JSON file
-def load_devices():
-    if os.path.exists(DEVICES_FILE):
-        with open(DEVICES_FILE, 'r') as file:
-            return json.load(file)
-    return {}
-
-# Function to save devices to the JSON file
-def save_devices(devices_data):
-    with open(DEVICES_FILE, 'w') as file:
-        json.dump(devices_data, file, indent=4)
-
-# Initialize dictionaries to store data for each device and climate
-devices_data = load_devices()
-climate_data = []
-current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
-current_month = datetime.now().month
-last_save_time = datetime.now()
-
-# Ensure all loaded devices have the necessary keys
-for device_name, device_info in devices_data.items():
-    if 'hourly' not in device_info:
-        device_info['hourly'] = []
-    if 'csv_file' not in device_info:
-        device_info['csv_file'] = get_csv_filename(device_info['device_number'])
-
-def save_hourly_average(device_name, final_save=False):
-    global devices_data, current_hour, current_month, climate_data
-    print(f"Saving hourly average for {device_name}...")
-    device_data = devices_data[device_name]
-    # Filter out None values before calculating averages
-    hourly_temps = [x['temperature'] for x in device_data['hourly'] if x['temperature'] is not None]
-    hourly_hums = [x['humidity'] for x in device_data['hourly'] if x['humidity'] is not None]
-    
-    if not hourly_temps and not hourly_hums:
-        print(f"No data to save for {device_name} in the current hour. Skipping save.")
-        return  # Skip save if no data for the current hour
-
-    if hourly_temps:
-        avg_temperature = round(sum(hourly_temps) / len(hourly_temps), 2)
-    else:
-        avg_temperature = None  # No data for this hour
-    
-    if hourly_hums:
-        avg_humidity = round(sum(hourly_hums) / len(hourly_hums), 2)
-    else:
-        avg_humidity = None  # No data for this hour
+# Log server of the DeviceMonitorApp (main.py)
+LOG_SERVER_HOST = "localhost"
+LOG_SERVER_PORT = 9999
 
-    if climate_data:
-        climate_temps = [x['temperature'] for x in climate_data if x['temperature'] is not None]
-        climate_hums = [x['humidity'] for x in climate_data if x['humidity'] is not None]
-        if climate_temps:
-            avg_climate_temperature = round(sum(climate_temps) / len(climate_temps), 2)
-        else:
-            avg_climate_temperature = None  # No climate data for this hour
-        
-        if climate_hums:
-            avg_climate_humidity = round(sum(climate_hums) / len(climate_hums), 2)
-        else:
-            avg_climate_humidity = None  # No climate data for this hour
-    else:
-        avg_climate_temperature = None  # No climate data for this hour
-        avg_climate_humidity = None  # No climate data for this hour
-
-    formatted_timestamp = current_hour.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+08:00'
-    df = pd.DataFrame([[formatted_timestamp, avg_temperature, avg_humidity, avg_climate_temperature, avg_climate_humidity]], 
-                      columns=["time", "device_temperature", "device_humidity", "climate_temperature", "climate_humidity"])
-
-    # Generate the current CSV file name
-    current_csv_file = device_data['csv_file']
-    print(f"Current CSV file: {current_csv_file}")
-
-    # Check if the month has changed
-    if datetime.now().month != current_month:
-        current_csv_file = get_csv_filename(device_data['device_number'])
-        device_data['csv_file'] = current_csv_file
-        current_month = datetime.now().month
+# Every print also goes to the log server, through a buffered sender that never blocks the caller
+log_shipper = LogShipper(LOG_SERVER_HOST, LOG_SERVER_PORT, prefix="Capture: ")
+original_print = print
 
-    # Update the existing hour's entry instead of adding a new one
-    if os.path.exists(current_csv_file):
-        print(f"CSV file {current_csv_file} exists. Updating entry if necessary.")
-        existing_df = pd.read_csv(current_csv_file)
-        if not existing_df[existing_df['time'] == formatted_timestamp].empty:
-            print(f"Entry for {formatted_timestamp} exists. Updating entry.")
-            existing_entry = existing_df[existing_df['time'] == formatted_timestamp].iloc[0]
-            # Update the existing average values
-            if avg_temperature is not None and existing_entry['device_temperature'] is not None:
-                new_avg_temperature = round((existing_entry['device_temperature'] * len(hourly_temps) + avg_temperature) / (len(hourly_temps) + 1), 2)
-            else:
-                new_avg_temperature = avg_temperature
-            
-            if avg_humidity is not None and existing_entry['device_humidity'] is not None:
-                new_avg_humidity = round((existing_entry['device_humidity'] * len(hourly_hums) + avg_humidity) / (len(hourly_hums) + 1), 2)
-            else:
-                new_avg_humidity = avg_humidity
-            
-            existing_df.loc[existing_df['time'] == formatted_timestamp, 
-                            ['device_temperature', 'device_humidity', 'climate_temperature', 'climate_humidity']] = [new_avg_temperature or existing_entry['device_temperature'],
-                                                                                                                   new_avg_humidity or existing_entry['device_humidity'],
-                                                                                                                   avg_climate_temperature or existing_entry['climate_temperature'],
-                                                                                                                   avg_climate_humidity or existing_entry['climate_humidity']]
-            existing_df.to_csv(current_csv_file, index=False)
-        else:
-            print(f"Adding new entry for {formatted_timestamp}.")
-            df.to_csv(current_csv_file, mode='a', header=False, index=False)
-    else:
-        print(f"CSV file {current_csv_file} does not exist. Creating new file and adding entry.")
-        df.to_csv(current_csv_file, mode='a', header=not os.path.exists(current_csv_file), index=False)
+def print(*args, **kwargs):
+    original_print(*args, **kwargs)
+    log_shipper.ship(' '.join(map(str, args)))
 
-    print(f"Hourly average temperature and humidity data saved to {current_csv_file} for device {device_name}")
-    device_data['hourly'].clear()  # Clear the hourly data after saving
+# Event-time windows: readings are assigned to the hour they were taken in (the device's last_seen)
+MAX_OUT_OF_ORDER = timedelta(minutes=2)  # How far behind the newest reading another reading may arrive
+ALLOWED_LATENESS = timedelta(hours=1)  # Readings for an hour saved less than this long ago still update it
+WINDOW_TICK_SECONDS = 60  # How often the watermark is moved on by wall-clock time when devices are quiet
 
-def save_all_devices(final_save=False, force_save=False):
-    global devices_data, last_save_time, climate_data
-    now = datetime.now()
-    if (now - last_save_time).seconds < 3600 and not final_save and not force_save:
-        print("Skipping save: Less than an hour since last save and not final save or force save.")
-        return  # Avoid multiple saves within the same hour unless forced
+# Ingest queue settings
+INGEST_QUEUE_SIZE = 10000  # Readings buffered between the MQTT thread and the writer thread
+INGEST_OVERFLOW_POLICY = "drop_oldest"  # One of "drop_oldest", "drop_newest", "block"
 
-    print("Saving data for all devices...")
-    print(f"Current devices_data: {devices_data}")
-    for device_name in devices_data.keys():
-        print(f"Saving data for device {device_name}...")
-        save_hourly_average(device_name, final_save)
-    save_devices(devices_data)  # Save devices data to the JSON file after saving all hourly averages
-    climate_data.clear()  # Clear climate data after saving
-    last_save_time = now
-    print("Data saved successfully.")
+# Hourly windows, write-ahead log, hourly stores and registry; only the ingest writer thread touches it
+worker = CaptureWorker(data_dir='.', wal_dir=WAL_DIR, registry_file=REGISTRY_FILE, devices_file=DEVICES_FILE,
+                       wal_commit_interval_ms=WAL_COMMIT_INTERVAL_MS, wal_segment_bytes=WAL_SEGMENT_BYTES, log=print,
+                       max_out_of_order=MAX_OUT_OF_ORDER, allowed_lateness=ALLOWED_LATENESS, rollup_dir=ROLLUP_DIR)
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -174,46 +75,18 @@ def on_disconnect(client, userdata, rc):
                 print(f"Reconnection failed: {e}")
                 time.sleep(5)  # Wait before retrying
 
+# Runs on paho's network thread: parse and enqueue only, never touch the disk here
 def on_message(client, userdata, msg):
-    global devices_data, current_hour
-    payload = msg.payload.decode('utf-8')
-    topic = msg.topic.split('/')
-    device_name = topic[1]  # Assumes topic format is zigbee2mqtt/<device_name>
-    
-    # Check if the topic is a device topic (not the bridge)
-    if device_name != 'bridge':
-        try:
-            data = json.loads(payload)
-            if 'temperature' in data and 'humidity' in data:
-                # Extract temperature, humidity, and current timestamp
-                temperature = round(data['temperature'], 2)
-                humidity = round(data['humidity'], 2)
-                timestamp = datetime.now()
-
-                # Initialize device data if not already present
-                if device_name not in devices_data:
-                    device_number = len(devices_data) + 1
-                    devices_data[device_name] = {
-                        'device_number': device_number,
-                        'hourly': [],
-                        'csv_file': get_csv_filename(device_number)
-                    }
-                    print(f"Device {device_name} has been added with device number {device_number}")
-                    save_devices(devices_data)  # Save devices data to the JSON file when a new device is added
-
-                device_data = devices_data[device_name]
-
-                print(f"Device {device_data['device_number']} is responding")
-
-                # Check if the timestamp is past the current hour
-                while timestamp >= current_hour + timedelta(hours=1):
-                    save_all_devices(force_save=True)  # Save the data for all devices for the current hour
-                    current_hour += timedelta(hours=1)  # Move to the next hour
+    try:
+        reading = reading_from_message(msg.topic, msg.payload, datetime.now())
+        if reading is not None:
+            ingest.submit(worker.record_reading, *reading)
+    except Exception as e:
+        print(f"Error parsing message on {msg.topic}: {e}")
 
-                # Append the current temperature and humidity to the hourly data list
-                device_data['hourly'].append({'temperature': temperature, 'humidity': humidity})
-        except Exception as e:
-            print(f"Error parsing message from {device_name}: {e}")
+# Start the writer thread before any message can arrive
+ingest = IngestPipeline(maxsize=INGEST_QUEUE_SIZE, overflow=INGEST_OVERFLOW_POLICY)
+ingest.start()
 
 client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
 client.on_connect = on_connect
@@ -222,9 +95,12 @@ client.on_message = on_message
 
 # Function to handle shutdown
 def shutdown():
-    save_all_devices(final_save=True)
     client.loop_stop()
     client.disconnect()
+    ingest.call(worker.save_all_devices, final_save=True, wait=True)
+    ingest.stop()
+    worker.close()
+    log_shipper.close()
     print("Shutdown complete")
 
 # Try connecting to the MQTT broker
@@ -240,31 +116,42 @@ while not connected:
 # Start the MQTT loop
 client.loop_start()
 
-# Timer to save data every hour
-def hourly_saver():
+# Timer that moves the watermark on, so an hour is saved even if no reading arrives after it,
+# and flushes the rollups
+def window_ticker():
+    last_hour = datetime.now().hour
     while True:
-        now = datetime.now()
-        # Calculate time to next hour
-        seconds_to_next_hour = (60 - now.minute) * 60 - now.second
-        time.sleep(seconds_to_next_hour)
-        save_all_devices(force_save=True)  # Force save to ensure data is saved at the hour mark
-
-# Start the hourly saver in a separate thread
-saver_thread = threading.Thread(target=hourly_saver)
+        time.sleep(WINDOW_TICK_SECONDS)
+        ingest.call(worker.tick, datetime.now())
+        if datetime.now().hour != last_hour:
+            last_hour = datetime.now().hour
+            print(f"Ingest queue stats: {ingest.stats()}, windows: {worker.windows.stats()}")
+
+# Start the window ticker in a separate thread
+saver_thread = threading.Thread(target=window_ticker)
 saver_thread.daemon = True  # Ensure the thread will close when the main program exits
 saver_thread.start()
 
+# Cached climate data, shared with device_monitor.py through the snapshot file
+climate = ClimateProvider(API_KEY, LAT, LON, ttl=CLIMATE_TTL)
+last_climate_time = None
+
+# Record the current climate sample, once per fetch
+def record_climate_sample():
+    global last_climate_time
+    sample = climate.get()
+    if sample is None:
+        print("Error fetching climate data")
+    elif sample.fetched_at != last_climate_time:
+        last_climate_time = sample.fetched_at
+        ingest.call(worker.record_climate, sample.temperature, sample.humidity, sample.fetched_at)
+        print(f"Successfully fetched climate data: Temperature={sample.temperature}, Humidity={sample.humidity}")
+
 # Fetch climate data every 3 minutes
 def climate_fetcher():
-    global climate_data
     while True:
-        climate_temperature, climate_humidity = fetch_climate_data(API_KEY, LAT, LON)
-        if climate_temperature is not None and climate_humidity is not None:
-            climate_data.append({'temperature': climate_temperature, 'humidity': climate_humidity})
-            print(f"Successfully fetched climate data: Temperature={climate_temperature}, Humidity={climate_humidity}")
-        else:
-            print("Error fetching climate data")
-        time.sleep(180)  # Fetch climate data every 3 minutes (180 seconds)
+        record_climate_sample()
+        time.sleep(CLIMATE_TTL)
 
 # Start the climate fetcher in a separate thread
 climate_thread = threading.Thread(target=climate_fetcher)
@@ -273,34 +160,12 @@ climate_thread.start()
 
 # Function to fetch and save climate data when Enter is pressed
 def fetch_and_save():
-    global climate_data
     print("Fetching climate data...")
-    climate_temperature, climate_humidity = fetch_climate_data(API_KEY, LAT, LON)
-    if climate_temperature is not None and climate_humidity is not None:
-        climate_data.append({'temperature': climate_temperature, 'humidity': climate_humidity})
-        print(f"Successfully fetched climate data: Temperature={climate_temperature}, Humidity={climate_humidity}")
-    else:
-        print("Error fetching climate data")
+    record_climate_sample()  # Served from the cache if it is recent enough
     print("Saving data for all devices after fetching climate data...")
-    save_all_devices(force_save=True)
+    ingest.call(worker.save_all_devices, force_save=True)
+    ingest.call(worker.export_csv_files, wait=True)
     print("Manual save completed.")
-def send_to_socket(message):
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('localhost', 9999))
-        sock.sendall(message.encode('utf-8'))
-        sock.close()
-    except Exception as e:
-        print(f"Socket error: {e}")
-
-original_print = print
-
-def print(*args, **kwargs):
-    original_print(*args, **kwargs)
-    message = ' '.join(map(str, args)) + '\n'
-    send_to_socket(message)
-
-    
 # Keep the main thread running to handle MQTT messages
 try:
     while True:
@@ -1,26 +1,66 @@
 import paho.mqtt.client as mqtt
-import tensorflow as tf
 import numpy as np
-import json
 import logging
-import joblib
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 import socket
 import sys
+import threading
 from tkinter import Tk, Label, Text, Scrollbar, VERTICAL, Y, RIGHT, LEFT, END
-from get_climate_data import fetch_climate_data  # Import the climate data fetching function
+from climate_provider import ClimateProvider
+from climate_series import ClimateSeries
+from batch_scheduler import MicroBatcher
+from zigbee_decode import decode_reading
+from inference_engine import load_engine, model_version, reconstruction_losses
+from feature_transform import load_feature_transform
+from device_windows import DeviceWindows, load_window_spec
+from loss_cache import LossCache
+from adaptive_threshold import AdaptiveThresholds, DEFAULT_THRESHOLD, SKETCH_FILE, load_fallback_threshold
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Load your trained model and scaler
-model = tf.keras.models.load_model('lstm_model_with_external_variables.h5')
-scaler = joblib.load('scaler.pkl')
+# How the model is run: 'numpy', 'keras', 'tf_function', 'tflite' or 'onnx' (see inference_engine.py; the
+# TFLite and ONNX files come from `python inference_engine.py convert`). 'numpy' reads the .h5 directly
+# and never imports TensorFlow.
+INFERENCE_BACKEND = 'numpy'
+MODEL_FILE = 'lstm_model_with_external_variables.h5'
 
-# Manually set the threshold
-best_threshold = 0.35
+# The model and scaler are loaded by load_model() on a background thread while MQTT connects; readings
+# wait in the batcher until it has warmed them up. 'remote' uses the process started by model_server.py
+# and skips the model load entirely.
+engine = None
+feature_transform = None  # scaler.pkl's MinMaxScaler as a NumPy affine transform
+# The model scores windows of each device's latest readings; the window length (timesteps) comes from the
+# model's input shape, so it follows whatever SEQUENCE_LENGTH setup.py trained with. A model of more than one
+# timestep was trained on hourly rows, so readings are averaged per hour (the cadence setup.py saved in
+# the model's .window.json) before they go into its windows
+device_windows = None
+model_input = None  # (readings, timesteps, features), reused by every batch
+
+# Losses of recently scored windows. Rounded readings and slow-moving climate repeat the same model input
+# often; load_model() empties the cache whenever the model or scaler file changes.
+LOSS_CACHE_SIZE = 65536
+loss_cache = LossCache(LOSS_CACHE_SIZE)
+model_ready = threading.Event()
+MODEL_LOAD_RETRY_SECONDS = 5
+
+# Each device is judged against THRESHOLD_MARGIN times a high quantile of its own losses, tracked in a
+# streaming sketch, once it has THRESHOLD_MIN_SAMPLES of them; never against less than best_threshold,
+# which load_model() reads from best_threshold.pkl when there is one
+best_threshold = DEFAULT_THRESHOLD
+THRESHOLD_QUANTILE = 0.99
+THRESHOLD_MARGIN = 1.25
+THRESHOLD_PER_HOUR = False  # Separate thresholds per hour of day, for sensors with a daily rhythm
+THRESHOLD_MIN_SAMPLES = 500
+THRESHOLD_CHECKPOINT_SECONDS = 300  # How often the sketches are saved for a warm restart
+thresholds = None
+
+# Readings are scored in batches: one forward pass per INFERENCE_BATCH_SIZE readings or per
+# INFERENCE_MAX_DELAY_MS, whichever comes first
+INFERENCE_BATCH_SIZE = 64
+INFERENCE_MAX_DELAY_MS = 20
+METRICS_INTERVAL = 60  # Seconds between batching metrics in the log
 
 # Define the feature names used during scaling
 feature_names = ['device_temperature', 'device_humidity', 'climate_temperature', 'climate_humidity', 'hour_of_day']
@@ -35,51 +75,74 @@ API_KEY = "446e884fa8fcaf1e943c89605dac07e5"  # Replace with your OpenWeatherMap
 LAT = 1.38  # Replace with your latitude
 LON = 103.85  # Replace with your longitude
 
-# Global variables to cache weather data
-cached_climate_temp = None
-cached_climate_humidity = None
-last_weather_update = datetime.min
+# Cached weather data, shared with device_capture.py through the snapshot file
+climate_source = ClimateProvider(API_KEY, LAT, LON, ttl=600)
+CLIMATE_REFRESH_SECONDS = 60  # How often the refresher thread checks the cache
+
+# Latest (climate temperature °C, climate humidity %). The refresher thread replaces the
+# whole tuple at once, so on_message never waits for the weather API or sees half an update.
+climate_snapshot = (None, None)
+
+# Fetched climate samples by time, so a reading is scored with the climate of the moment it was taken
+climate_series = ClimateSeries(capacity=4096, max_gap=3 * 3600)
 
-# Initialize GUI
-root = Tk()
-root.title("Anomaly Detection Logger")
 anomaly_count = 0
 
-# Create GUI elements
-label = Label(root, text="Anomaly Detection Log", font=("Helvetica", 16))
-label.pack()
+# GUI elements; created by build_gui() when run as a script, so replay.py can import the handlers
+root = None
+log_text = None
+counter_label = None
+
+def build_gui():
+    global root, log_text, counter_label
+    root = Tk()
+    root.title("Anomaly Detection Logger")
 
-scrollbar = Scrollbar(root, orient=VERTICAL)
-log_text = Text(root, wrap='word', yscrollcommand=scrollbar.set, height=20, width=50)
-scrollbar.config(command=log_text.yview)
-scrollbar.pack(side=RIGHT, fill=Y)
-log_text.pack(side=LEFT, fill='both', expand=True)
+    # Create GUI elements
+    label = Label(root, text="Anomaly Detection Log", font=("Helvetica", 16))
+    label.pack()
 
-counter_label = Label(root, text=f"Anomalies Detected: {anomaly_count}", font=("Helvetica", 14))
-counter_label.pack()
+    scrollbar = Scrollbar(root, orient=VERTICAL)
+    log_text = Text(root, wrap='word', yscrollcommand=scrollbar.set, height=20, width=50)
+    scrollbar.config(command=log_text.yview)
+    scrollbar.pack(side=RIGHT, fill=Y)
+    log_text.pack(side=LEFT, fill='both', expand=True)
+
+    counter_label = Label(root, text=f"Anomalies Detected: {anomaly_count}", font=("Helvetica", 14))
+    counter_label.pack()
 
 def update_log(message):
-    log_text.insert(END, message + '\n')
-    log_text.see(END)
+    if log_text is not None:
+        log_text.insert(END, message + '\n')
+        log_text.see(END)
 
 def update_counter():
     global anomaly_count
     anomaly_count += 1
-    counter_label.config(text=f"Anomalies Detected: {anomaly_count}")
-
-def fetch_and_cache_climate_data():
-    global cached_climate_temp, cached_climate_humidity, last_weather_update
-    now = datetime.now()
-    if now - last_weather_update > timedelta(minutes=10):
-        climate_temp, climate_humidity = fetch_climate_data(API_KEY, LAT, LON)
-        if climate_temp is not None and climate_humidity is not None:
-            cached_climate_temp = round(climate_temp, 2)
-            cached_climate_humidity = round(climate_humidity / 100, 2)  # Adjust humidity
-            last_weather_update = now
-            logging.info("Weather data updated")
-        else:
-            logging.error("Failed to fetch climate data")
-    return cached_climate_temp, cached_climate_humidity
+    if counter_label is not None:
+        counter_label.config(text=f"Anomalies Detected: {anomaly_count}")
+
+def refresh_climate():
+    global climate_snapshot
+    sample = climate_source.get()
+    if sample is not None:
+        climate_series.add(sample.fetched_at, sample.temperature, sample.humidity)
+        climate_snapshot = (sample.temperature, sample.humidity)
+    else:
+        logging.error("Failed to fetch climate data, keeping the last known values")
+
+def climate_refresher():
+    while True:
+        try:
+            refresh_climate()
+        except Exception as e:
+            logging.error(f"Climate refresh failed: {e}")
+        time.sleep(CLIMATE_REFRESH_SECONDS)
+
+def start_climate_refresher():
+    # The first refresh runs on the thread too: a cold start with no snapshot file waits on the API, and
+    # MQTT should connect meanwhile. reading_features skips readings until climate data is in.
+    threading.Thread(target=climate_refresher, name="climate-refresher", daemon=True).start()
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -102,81 +165,228 @@ def on_disconnect(client, userdata, rc):
 
 def on_message(client, userdata, msg):
     global feature_names
-    if "bridge/logging" not in msg.topic:
-        logging.info(f"Received message on {msg.topic}")
+    try:
+        # Bridge and command topics are rejected before the payload is looked at
+        reading = decode_reading(msg.topic, msg.payload)
+    except ValueError as e:
+        logging.error(f"Error decoding reading on {msg.topic}: {e}")
+        return
+    if reading is None:
+        return
+
+    logging.info(f"Received message on {msg.topic}")
+    device, temperature, humidity, _ = reading
+    batcher.submit((temperature, humidity, datetime.now(), None, device))
+
+# Feature row for one reading taken at `when`; climate is (temperature °C, humidity %) or None to use the climate
+# at that time. Humidities are given in percent everywhere and scaled to fractions only here.
+def reading_features(temperature, humidity, when, climate=None):
+    # Extract device temperature and humidity
+    device_temp = round(temperature, 2)
+    device_humidity = round(humidity / 100, 2)  # Adjust humidity
+    
+    # Align the climate to the reading's time; refreshing it is the refresher thread's job
+    if climate is None:
+        climate = climate_series.interpolate(when) or climate_snapshot
+    climate_temp, climate_humidity = climate
+    
+    if climate_temp is None or climate_humidity is None:
+        logging.error("No climate data yet, skipping reading.")
+        return None
+    climate_temp = round(climate_temp, 2)
+    climate_humidity = round(climate_humidity / 100, 2)  # Adjust humidity
+    
+    hour_of_day = when.hour
+    return [device_temp, device_humidity, climate_temp, climate_humidity, hour_of_day]
+
+# Score a batch of (temperature, humidity, when, climate, device) readings with one forward pass over each
+# device's latest window; called from one thread at a time
+def handle_readings(readings):
+    rows, positions = [], []
+    for i, (temperature, humidity, when, climate, device) in enumerate(readings):
+        # A reading that cannot be turned into features is dropped on its own, not with the batch
         try:
-            payload = msg.payload.decode('utf-8')
-            data = json.loads(payload)
-            
-            if 'temperature' in data and 'humidity' in data:
-                # Extract device temperature and humidity
-                device_temp = round(data['temperature'], 2)
-                device_humidity = round(data['humidity'] / 100, 2)  # Adjust humidity
-                
-                # Fetch cached climate data
-                climate_temp, climate_humidity = fetch_and_cache_climate_data()
-                
-                if climate_temp is None or climate_humidity is None:
-                    logging.error("Using last known climate data as fallback.")
-                    climate_temp = cached_climate_temp
-                    climate_humidity = cached_climate_humidity
-                
-                hour_of_day = datetime.now().hour
-
-                # Create input data with proper feature names
-                input_data = pd.DataFrame([[device_temp, device_humidity, climate_temp, climate_humidity, hour_of_day]], columns=feature_names)
-                input_data_scaled = scaler.transform(input_data)
-                input_data_scaled = input_data_scaled.reshape((1, 1, input_data_scaled.shape[1]))
-
-                # Perform anomaly detection
-                prediction = model.predict(input_data_scaled)
-                loss = np.mean(np.abs(prediction - input_data_scaled))
-
-                logging.info(f"Calculated loss: {loss}")
-                is_anomaly = loss > best_threshold
-
-                if is_anomaly:
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    log_message = f"Anomaly detected at {timestamp}, Loss: {loss}"
-                    update_log(log_message)
-                    update_counter()
-                    logging.info(log_message)
-                else:
-                    logging.info("Ping: No anomaly detected")
-
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decoding JSON: {e}")
-        except KeyError as e:
-            logging.error(f"Missing expected data in JSON: {e}")
-
-# Initialize MQTT client
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_message = on_message
-
-# Function to handle shutdown
-def shutdown():
-    client.loop_stop()
-    client.disconnect()
-    logging.info("Shutdown complete")
-
-# Try connecting to the MQTT broker
-connected = False
-while not connected:
+            features = reading_features(temperature, humidity, when, climate)
+        except (TypeError, ValueError) as e:
+            logging.error(f"Skipping malformed reading from {device}: {e}")
+            continue
+        if features is not None:
+            rows.append(features)
+            positions.append(i)
+    results = [None] * len(readings)
+    if not rows:
+        return results
+
+    # Add each reading to its device's window; windows scored before take their loss from the cache, the
+    # others are copied into the batch while they are current
+    input_data_scaled = feature_transform.transform(rows)
+    batch = input_batch(len(rows))
+    losses = [None] * len(readings)
+    missed = []  # (position, cache key) of the windows in the batch
+    for i, row in zip(positions, input_data_scaled):
+        window = device_windows.push(readings[i][4], row, readings[i][2])
+        if window is None:  # Until the device has filled a whole window
+            continue
+        key = window.tobytes()
+        losses[i] = loss_cache.get(key)
+        if losses[i] is None:
+            batch[len(missed)] = window
+            missed.append((i, key))
+
+    if missed:
+        for (i, key), loss in zip(missed, score_windows(len(missed))):
+            loss_cache.put(key, loss)
+            losses[i] = loss
+
+    # Fan the losses back out to the readings they belong to
+    for i, loss in enumerate(losses):
+        if loss is not None:
+            results[i] = report_loss(loss, readings[i][2], readings[i][4])
+    return results
+
+def input_batch(count):
+    global model_input
+    if count > len(model_input):
+        model_input = np.zeros((count,) + model_input.shape[1:], dtype=np.float32)
+    return model_input[:count]
+
+# Reconstruction loss of the first `count` windows in model_input, with one forward pass
+def score_windows(count):
+    # Perform anomaly detection; one reconstruction loss per reading
+    batch = model_input[:count]
+    prediction = engine.predict(batch)
+    return reconstruction_losses(prediction, batch)
+
+def report_loss(loss, when, device=None):
+    logging.info(f"Calculated loss: {loss}")
+    threshold, is_anomaly = thresholds.observe(device, when.hour, loss)
+
+    if is_anomaly:
+        timestamp = when.strftime('%Y-%m-%d %H:%M:%S')
+        log_message = f"Anomaly detected at {timestamp} on {device}, Loss: {loss:.4f} > {threshold:.4f}"
+        update_log(log_message)
+        update_counter()
+        logging.info(log_message)
+    else:
+        logging.info("Ping: No anomaly detected")
+    return loss, is_anomaly
+
+# Score one reading right away (replays and tools); returns (loss, is_anomaly) or None
+def handle_reading(temperature, humidity, when, climate=None, device=None):
+    return handle_readings([(temperature, humidity, when, climate, device)])[0]
+
+batcher = MicroBatcher(handle_readings, max_batch=INFERENCE_BATCH_SIZE, max_delay_ms=INFERENCE_MAX_DELAY_MS,
+                       name="inference-batcher")
+
+def load_model():
+    global engine, feature_transform, device_windows, model_input, best_threshold, thresholds
+    started = time.monotonic()
+    best_threshold = load_fallback_threshold('best_threshold.pkl', DEFAULT_THRESHOLD)
+    thresholds = AdaptiveThresholds(THRESHOLD_QUANTILE, THRESHOLD_PER_HOUR, THRESHOLD_MIN_SAMPLES, best_threshold,
+                                    SKETCH_FILE, THRESHOLD_MARGIN)
+    engine = load_engine(INFERENCE_BACKEND, MODEL_FILE)
+    feature_transform = load_feature_transform('scaler.pkl', feature_names, capacity=INFERENCE_BATCH_SIZE)
+    sequence_length = engine.input_shape[0] or 1
+    cadence, max_gap = window_cadence(engine, sequence_length)
+    device_windows = DeviceWindows(sequence_length, len(feature_names), cadence=cadence, max_gap=max_gap)
+    model_input = np.zeros((INFERENCE_BATCH_SIZE, sequence_length, len(feature_names)), dtype=np.float32)
+    loss_cache.set_version(loss_cache_version())
+    if INFERENCE_BACKEND == 'remote':
+        # A model server restarted with a new model: cached losses of the old one must not be served
+        engine.on_version_change = lambda version: loss_cache.set_version(loss_cache_version())
+    # Dummy batches at the sizes in use, so the first real readings do not pay for tracing and allocation
+    for batch_size in (1, INFERENCE_BATCH_SIZE):
+        for _ in range(2):
+            score_windows(batch_size)
+    model_ready.set()
+    logging.info(f"Model loaded and warmed up with the {INFERENCE_BACKEND} backend in {time.monotonic() - started:.2f}s, "
+                 f"windows of {sequence_length} " + (f"{cadence:.0f}s rows" if cadence else "readings"))
+
+# (cadence, max gap) in seconds for the model's windows, or (None, None) to window raw readings. Raises when
+# a multi-step model does not say how its windows were built, or its record belongs to another model: scoring
+# windows of 5-second readings with a model trained on hourly ones gives meaningless losses.
+def window_cadence(engine, sequence_length):
+    spec = engine.window if INFERENCE_BACKEND == 'remote' else load_window_spec(MODEL_FILE)
+    if sequence_length == 1:
+        return None, None  # One row per window: every reading is scored on its own, as before windows
+    if spec is None:
+        raise ValueError(f"{MODEL_FILE} takes windows of {sequence_length} rows but has no .window.json saying "
+                         f"at what cadence; retrain it with setup.py")
+    if spec['sequence_length'] != sequence_length:
+        raise ValueError(f"{MODEL_FILE} takes windows of {sequence_length} rows but its .window.json is for "
+                         f"{spec['sequence_length']}; it belongs to another model")
+    return spec['cadence_seconds'], spec.get('max_gap_seconds')
+
+def loss_cache_version():
+    return f"{getattr(engine, 'version', None) or model_version(MODEL_FILE)}|{model_version('scaler.pkl')}"
+
+def model_loader():
+    while True:
+        try:
+            load_model()
+            break
+        except Exception as e:
+            logging.error(f"Loading the model failed: {e}")
+            time.sleep(MODEL_LOAD_RETRY_SECONDS)
+    logging.info(f"Scoring {batcher.stats()['depth']} readings buffered during startup")
+    batcher.start()
+
+def metrics_reporter():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        logging.info(f"Inference batching: {batcher.stats()}")
+        logging.info(f"Loss cache: {loss_cache.stats()}")
+        if thresholds is not None:
+            logging.info(f"Adaptive thresholds: {thresholds.stats()}")
+
+def threshold_checkpointer():
+    while True:
+        time.sleep(THRESHOLD_CHECKPOINT_SECONDS)
+        try:
+            if thresholds is not None:
+                thresholds.save()
+        except OSError as e:
+            logging.error(f"Saving the threshold sketches failed: {e}")
+
+if __name__ == "__main__":
+    build_gui()
+    # Readings are buffered in the batcher from the first message; it starts once the model is ready
+    threading.Thread(target=model_loader, name="model-loader", daemon=True).start()
+    start_climate_refresher()
+    threading.Thread(target=metrics_reporter, name="metrics-reporter", daemon=True).start()
+    threading.Thread(target=threshold_checkpointer, name="threshold-checkpointer", daemon=True).start()
+
+    # Initialize MQTT client
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+
+    # Function to handle shutdown
+    def shutdown():
+        client.loop_stop()
+        client.disconnect()
+        batcher.stop()
+        if thresholds is not None:
+            thresholds.save()
+        logging.info("Shutdown complete")
+
+    # Try connecting to the MQTT broker
+    connected = False
+    while not connected:
+        try:
+            client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            connected = True
+        except Exception as e:
+            logging.info(f"Connection failed: {e}")
+            time.sleep(5)  # Wait before retrying
+
+    # Start the MQTT loop
+    client.loop_start()
+
+    # Run the GUI main loop
     try:
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        connected = True
-    except Exception as e:
-        logging.info(f"Connection failed: {e}")
-        time.sleep(5)  # Wait before retrying
-
-# Start the MQTT loop
-client.loop_start()
-
-# Run the GUI main loop
-try:
-    root.mainloop()
-except KeyboardInterrupt:
-    logging.info("\nExiting program...")
-    shutdown()
+        root.mainloop()
+    except KeyboardInterrupt:
+        logging.info("\nExiting program...")
+        shutdown()
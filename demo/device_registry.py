@@ -0,0 +1,88 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class DeviceRegistry:
+    """SQLite-backed map of device name -> device number.
+
+    The database runs in WAL mode and numbers are allocated by an AUTOINCREMENT
+    key inside an IMMEDIATE transaction, so several capture processes can
+    register devices concurrently without handing out the same number. Every
+    registration is a single-row insert; lookups are served from a local cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS devices ("
+            " device_number INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " name TEXT NOT NULL UNIQUE,"
+            " added_at TEXT NOT NULL)"
+        )
+        self.cache = dict(self.connection.execute("SELECT name, device_number FROM devices"))
+
+    def __len__(self):
+        return len(self.cache)
+
+    def lookup(self, name):
+        number = self.cache.get(name)
+        if number is None:
+            # Another process may have registered it since the cache was loaded
+            with self.lock:
+                row = self.connection.execute("SELECT device_number FROM devices WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                number = self.cache[name] = row[0]
+        return number
+
+    def register(self, name, device_number=None):
+        """Return (device_number, created) for name, allocating a new number if it is unknown."""
+        number = self.lookup(name)
+        if number is not None:
+            return number, False
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # The IMMEDIATE lock keeps other writers out between this check and the insert
+                row = self.connection.execute("SELECT device_number FROM devices WHERE name = ?", (name,)).fetchone()
+                created = row is None
+                if created:
+                    number = self.connection.execute(
+                        "INSERT INTO devices (device_number, name, added_at) VALUES (?, ?, ?)",
+                        (device_number, name, datetime.now().isoformat())).lastrowid
+                else:
+                    number = row[0]
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        self.cache[name] = number
+        return number, created
+
+    def devices(self):
+        return dict(self.cache)
+
+    def import_json(self, json_path):
+        """Register every device of an old devices.json, keeping its number. Returns the parsed file."""
+        with open(json_path, 'r') as file:
+            devices = json.load(file)
+        for name, info in sorted(devices.items(), key=lambda item: item[1]['device_number']):
+            self.register(name, info['device_number'])
+        return devices
+
+    def export_json(self, json_path):
+        devices = {name: {'device_number': number} for name, number in sorted(self.cache.items(), key=lambda item: item[1])}
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(devices, file, indent=4)
+        os.replace(tmp_path, json_path)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
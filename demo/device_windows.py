@@ -0,0 +1,128 @@
+import os
+import json
+
+import numpy as np
+
+
+def window_spec_path(model_path):
+    # Written by setup.py next to the model: model.window.json
+    return os.path.splitext(model_path)[0] + '.window.json'
+
+
+def save_window_spec(model_path, sequence_length, cadence_seconds, max_gap_seconds):
+    """Record how the model's training windows were built: rows per window, seconds between rows, and the
+    largest hole a window may span."""
+    with open(window_spec_path(model_path), 'w') as file:
+        json.dump({'sequence_length': int(sequence_length), 'cadence_seconds': float(cadence_seconds),
+                   'max_gap_seconds': float(max_gap_seconds)}, file)
+
+
+def load_window_spec(model_path):
+    """The model's window spec, or None for a model trained before setup.py recorded one."""
+    try:
+        with open(window_spec_path(model_path)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+class DeviceWindows:
+    """The latest `length` feature rows of every device, as model-ready (length, features) windows.
+
+    All devices share one preallocated float32 array with a row of 2 * length
+    slots per device. Like ClimateSeries, every row is written twice (at i and
+    i + length), so a device's latest window is always one contiguous view and
+    push() never copies history or allocates. Room for more devices is added
+    by doubling, so per-message cost and memory per device stay flat.
+
+    With a cadence (seconds), a row is the mean of the device's readings in
+    one cadence interval rather than a single reading, so windows have the
+    spacing the model was trained on (hourly) whatever the sensors report
+    at. The latest row is the interval still in progress and is updated in
+    place by every reading in it. A hole longer than max_gap starts the
+    device's window over, as setup.py never trains across one.
+
+    Not thread-safe; the monitor only touches it from the batcher thread.
+    """
+
+    def __init__(self, length, features, devices=1024, cadence=None, max_gap=None):
+        self.length = length
+        self.features = features
+        self.cadence = cadence
+        self.max_gap = max_gap
+        self.rows = np.zeros((devices, 2 * length, features), dtype=np.float32)
+        self.next_slot = np.zeros(devices, dtype=np.int64)  # Where each device's next row goes, 0..length-1
+        self.filled = np.zeros(devices, dtype=np.int64)  # Rows seen, capped at length
+        # With a cadence: the interval of each device's latest row, and the sum and count of its readings
+        self.interval = np.full(devices, -1, dtype=np.int64)
+        self.sums = np.zeros((devices, features), dtype=np.float64)
+        self.counts = np.zeros(devices, dtype=np.int64)
+        self.slots = {}  # device -> index into rows
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, device):
+        slot = self.slots.get(device)
+        if slot is None:
+            slot = len(self.slots)
+            if slot == len(self.rows):
+                self.rows = np.concatenate([self.rows, np.zeros_like(self.rows)])
+                self.next_slot = np.concatenate([self.next_slot, np.zeros_like(self.next_slot)])
+                self.filled = np.concatenate([self.filled, np.zeros_like(self.filled)])
+                self.interval = np.concatenate([self.interval, np.full_like(self.interval, -1)])
+                self.sums = np.concatenate([self.sums, np.zeros_like(self.sums)])
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.slots[device] = slot
+        return slot
+
+    def push(self, device, row, when=None):
+        """Add a scaled feature row taken at `when` (a datetime, needed with a cadence); returns the device's
+        latest window (a view), or None until it is full.
+
+        The view changes with the device's next push, so copy it (into the
+        model's input batch) before pushing again.
+        """
+        slot = self._slot(device)
+        if self.cadence:
+            interval = int(when.timestamp() // self.cadence)
+            latest = self.interval[slot]
+            if latest >= 0 and interval <= latest:
+                # Still the interval in progress (a late reading counts towards it too): update its mean
+                self.sums[slot] += row
+                self.counts[slot] += 1
+                position = (self.next_slot[slot] - 1) % self.length
+                rows = self.rows[slot]
+                rows[position] = rows[position + self.length] = self.sums[slot] / self.counts[slot]
+                return self._window(slot)
+            if latest >= 0 and self.max_gap and (interval - latest) * self.cadence > self.max_gap:
+                self.filled[slot] = 0
+                self.next_slot[slot] = 0
+            self.interval[slot] = interval
+            self.sums[slot] = row
+            self.counts[slot] = 1
+        position = self.next_slot[slot]
+        rows = self.rows[slot]
+        rows[position] = rows[position + self.length] = row
+        self.next_slot[slot] = (position + 1) % self.length
+        if self.filled[slot] < self.length:
+            self.filled[slot] += 1
+        return self._window(slot)
+
+    def _window(self, slot):
+        if self.filled[slot] < self.length:
+            return None
+        # The oldest row sits at next_slot, so the window in time order starts there
+        start = self.next_slot[slot]
+        return self.rows[slot][start:start + self.length]
+
+    def reset(self, device=None):
+        """Forget the history of one device, or of all of them."""
+        if device is None:
+            self.filled[:] = 0
+            self.next_slot[:] = 0
+            self.interval[:] = -1
+        elif device in self.slots:
+            self.filled[self.slots[device]] = 0
+            self.next_slot[self.slots[device]] = 0
+            self.interval[self.slots[device]] = -1
@@ -0,0 +1,95 @@
+import sys
+import argparse
+import numpy as np
+
+# The MinMaxScaler from setup.py as a plain affine transform. sklearn's transform() is X * scale_ + min_ in
+# float64; doing the same two operations here gives bit-identical results without building a DataFrame
+# or going through sklearn's input validation for every batch.
+SCALER_FILE = 'scaler.pkl'
+
+
+class FeatureTransform:
+    """scaler.transform() on preallocated buffers.
+
+    transform() returns a view of an internal buffer that the next call
+    overwrites, so it is meant for one caller at a time (the monitor's
+    batcher thread); copy the result to keep it.
+    """
+
+    def __init__(self, scale, offset, clip=None, feature_names=None, capacity=64):
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.clip = clip  # (low, high) when the scaler was fitted with clip=True
+        self.feature_names = list(feature_names) if feature_names is not None else None
+        self.features = len(self.scale)
+        self.buffer = np.empty((capacity, self.features), dtype=np.float64)
+
+    @classmethod
+    def from_scaler(cls, scaler, feature_names=None, capacity=64):
+        """Pull scale_/min_ out of a fitted MinMaxScaler; feature_names, if given, must be its column order."""
+        fitted_names = getattr(scaler, 'feature_names_in_', None)
+        if feature_names is not None and fitted_names is not None and list(fitted_names) != list(feature_names):
+            raise ValueError(f"The scaler was fitted on {list(fitted_names)}, not {list(feature_names)}")
+        clip = scaler.feature_range if getattr(scaler, 'clip', False) else None
+        return cls(scaler.scale_, scaler.min_, clip, feature_names if feature_names is not None else fitted_names,
+                   capacity)
+
+    def _rows(self, count):
+        if count > len(self.buffer):
+            self.buffer = np.empty((max(count, 2 * len(self.buffer)), self.features), dtype=np.float64)
+        return self.buffer[:count]
+
+    def transform(self, rows, out=None):
+        """Scale a (batch, features) array or list of rows; written to `out` (any float dtype) when given."""
+        scaled = self._rows(len(rows))
+        scaled[...] = rows
+        np.multiply(scaled, self.scale, out=scaled)
+        np.add(scaled, self.offset, out=scaled)
+        if self.clip is not None:
+            np.clip(scaled, self.clip[0], self.clip[1], out=scaled)
+        if out is None:
+            return scaled
+        out[...] = scaled
+        return out
+
+    def transform_one(self, row):
+        """Scale a single reading's feature row."""
+        return self.transform((row,))[0]
+
+
+def load_feature_transform(path=SCALER_FILE, feature_names=None, capacity=64):
+    import joblib
+
+    return FeatureTransform.from_scaler(joblib.load(path), feature_names, capacity)
+
+
+def check(path, rows, seed=0):
+    """Compare with scaler.transform on random rows spanning (and beyond) the fitted range; True if identical."""
+    import joblib
+    import pandas as pd
+
+    scaler = joblib.load(path)
+    transform = FeatureTransform.from_scaler(scaler)
+    rng = np.random.default_rng(seed)
+    span = scaler.data_max_ - scaler.data_min_
+    data = scaler.data_min_ - 0.5 * span + 2 * span * rng.random((rows, len(span)))
+    data = np.round(data, 2)  # Readings reach the monitor rounded to 2 decimals
+    expected = scaler.transform(pd.DataFrame(data, columns=getattr(scaler, 'feature_names_in_', None)))
+    batched = transform.transform(data).copy()
+    single = np.array([transform.transform_one(row).copy() for row in data])
+    identical = np.array_equal(batched, expected) and np.array_equal(single, expected)
+    print(f"{rows} rows: max |difference| {np.max(np.abs(batched - expected)):.1e}, "
+          f"{'identical' if identical else 'NOT identical'} to scaler.transform")
+    return identical
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the compiled feature transform against scaler.transform")
+    parser.add_argument('scaler', nargs='?', default=SCALER_FILE)
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args(argv)
+    return 0 if check(args.scaler, args.rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,18 @@
 import requests
 
-def fetch_climate_data(api_key, lat, lon):
+# One pooled session for the whole process, so repeated calls reuse the connection
+session = requests.Session()
+TIMEOUT = (3.05, 10)  # Connect and read timeouts in seconds
+
+def fetch_climate_data(api_key, lat, lon, session=session, timeout=TIMEOUT):
     url = f"http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-    
-    response = requests.get(url)
-    data = response.json()
+
+    try:
+        response = session.get(url, timeout=timeout)
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print("Error fetching climate data:", e)
+        return None, None
 
     if response.status_code == 200:
         climate_temperature = data['main']['temp']
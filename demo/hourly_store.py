@@ -0,0 +1,167 @@
+import os
+import csv
+import math
+import struct
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Same columns as the monthly device_N_temperature_data_YYYY-MM.csv files
+CSV_COLUMNS = ["time", "device_temperature", "device_humidity", "climate_temperature", "climate_humidity"]
+VALUE_COLUMNS = CSV_COLUMNS[1:]
+
+# Timestamps are written in Singapore local time
+LOCAL_TZ = timezone(timedelta(hours=8))
+
+# One fixed-width record per hour: epoch hour, then (mean, count) for every value column
+RECORD = struct.Struct('<q' + 'dI' * len(VALUE_COLUMNS))
+STORE_SUFFIX = ".hourly"
+
+
+def to_epoch_hour(hour):
+    # Naive datetimes are local (+08:00) times, as produced by datetime.now() in the capture script
+    if hour.tzinfo is None:
+        hour = hour.replace(tzinfo=LOCAL_TZ)
+    return int(hour.timestamp()) // 3600
+
+
+def from_epoch_hour(epoch_hour):
+    return datetime.fromtimestamp(epoch_hour * 3600, LOCAL_TZ)
+
+
+def format_hour(epoch_hour):
+    return from_epoch_hour(epoch_hour).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+08:00'
+
+
+def parse_hour(text):
+    return to_epoch_hour(datetime.fromisoformat(text.strip()))
+
+
+def merge_mean(old_mean, old_count, mean, count):
+    if count == 0:
+        return old_mean, old_count
+    if old_count == 0:
+        return mean, count
+    total = old_count + count
+    return (old_mean * old_count + mean * count) / total, total
+
+
+class HourlyStore:
+    """Append-only file of hourly records with an in-memory epoch hour -> offset index.
+
+    Upserting an hour that is already stored overwrites its record in place, so
+    saving the current hour never re-reads or rewrites the rest of the month.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.lock = threading.Lock()
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._build_index()
+
+    def _build_index(self):
+        self.file.seek(0)
+        offset = 0
+        while True:
+            chunk = self.file.read(RECORD.size)
+            if len(chunk) < RECORD.size:
+                break
+            self.index[RECORD.unpack(chunk)[0]] = offset
+            offset += RECORD.size
+        # Drop a torn record left behind by a crash in the middle of an append
+        self.file.truncate(offset)
+        self.end = offset
+
+    def _read(self, offset):
+        self.file.seek(offset)
+        fields = RECORD.unpack(self.file.read(RECORD.size))
+        return {column: (fields[1 + 2 * i], fields[2 + 2 * i]) for i, column in enumerate(VALUE_COLUMNS)}
+
+    def get(self, epoch_hour):
+        with self.lock:
+            offset = self.index.get(epoch_hour)
+            return None if offset is None else self._read(offset)
+
+    def upsert(self, epoch_hour, values):
+        """Merge {column: (mean, count)} into the record for epoch_hour."""
+        with self.lock:
+            self._put(self._merged(epoch_hour, values))
+
+    def merged(self, epoch_hour, values):
+        """The record fields upsert() would write, without writing them; put() them later."""
+        with self.lock:
+            return self._merged(epoch_hour, values)
+
+    def put(self, fields):
+        """Write a whole record as returned by merged(); writing it again changes nothing."""
+        with self.lock:
+            self._put(fields)
+
+    def _merged(self, epoch_hour, values):
+        offset = self.index.get(epoch_hour)
+        current = self._read(offset) if offset is not None else {}
+        fields = [epoch_hour]
+        for column in VALUE_COLUMNS:
+            old_mean, old_count = current.get(column, (math.nan, 0))
+            mean, count = values.get(column, (None, 0))
+            if mean is None:
+                mean, count = math.nan, 0
+            fields.extend(merge_mean(old_mean, old_count, mean, count))
+        return fields
+
+    def _put(self, fields):
+        epoch_hour = fields[0]
+        offset = self.index.get(epoch_hour)
+        if offset is None:
+            offset = self.end
+            self.end += RECORD.size
+            self.index[epoch_hour] = offset
+        self.file.seek(offset)
+        self.file.write(RECORD.pack(*fields))
+        self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def records(self):
+        """Yield (epoch_hour, {column: (mean, count)}) in time order."""
+        with self.lock:
+            for epoch_hour in sorted(self.index):
+                yield epoch_hour, self._read(self.index[epoch_hour])
+
+    def import_csv(self, csv_path):
+        with open(csv_path, newline='') as file:
+            for row in csv.DictReader(file):
+                values = {}
+                for column in VALUE_COLUMNS:
+                    if row.get(column):
+                        values[column] = (float(row[column]), 1)
+                self.upsert(parse_hour(row['time']), values)
+
+    def export_csv(self, csv_path):
+        rows = []
+        for epoch_hour, values in self.records():
+            row = [format_hour(epoch_hour)]
+            for column in VALUE_COLUMNS:
+                mean, count = values[column]
+                row.append(round(mean, 2) if count else '')
+            rows.append(row)
+        with open(csv_path, 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(CSV_COLUMNS)
+            writer.writerows(rows)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def open_store(csv_path):
+    """Open the store that backs csv_path, importing the existing CSV the first time."""
+    path = os.path.splitext(csv_path)[0] + STORE_SUFFIX
+    is_new = not os.path.exists(path)
+    store = HourlyStore(path)
+    if is_new and os.path.exists(csv_path):
+        store.import_csv(csv_path)
+    return store
@@ -0,0 +1,306 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+from numpy_lstm import NumpyAutoencoder
+
+# Interchangeable ways to run the LSTM autoencoder. Every engine takes a float32 batch of shape
+# (batch, timesteps, features) and returns the reconstruction of the same shape. TensorFlow, TFLite and
+# ONNX Runtime are only imported by the engines that need them; the numpy engine needs none of them.
+MODEL_FILE = "lstm_model_with_external_variables.h5"
+
+
+def artifact_path(model_path, backend):
+    # Converted models sit next to the .h5: model.tflite, model.onnx
+    return os.path.splitext(model_path)[0] + {'tflite': '.tflite', 'onnx': '.onnx'}[backend]
+
+
+def model_version(path):
+    # Changes whenever the file is replaced, so a reloaded model (or scaler) can be told apart
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def reconstruction_losses(reconstruction, batch):
+    """Mean absolute reconstruction error of every row of the batch."""
+    return np.mean(np.abs(reconstruction - batch), axis=tuple(range(1, batch.ndim)))
+
+
+def _load_keras(model_path):
+    import tensorflow as tf
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+class KerasEngine:
+    """model.predict, as the monitor always ran it; the reference for parity checks."""
+
+    name = 'keras'
+
+    def __init__(self, model_path):
+        self.model = _load_keras(model_path)
+        self.input_shape = tuple(self.model.input_shape[1:])
+
+    def predict(self, batch):
+        return self.model.predict(batch, batch_size=len(batch), verbose=0)
+
+
+class TFFunctionEngine:
+    """The Keras model called through one traced tf.function with a fixed (None, T, F) signature.
+
+    Skips predict()'s per-call data adapter and callbacks; the signature keeps
+    every batch size on the same graph instead of retracing.
+    """
+
+    name = 'tf_function'
+
+    def __init__(self, model_path):
+        import tensorflow as tf
+
+        self.tf = tf
+        self.model = _load_keras(model_path)
+        self.input_shape = tuple(self.model.input_shape[1:])
+        self.function = tf.function(lambda batch: self.model(batch, training=False),
+                                    input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+
+    def predict(self, batch):
+        return self.function(self.tf.convert_to_tensor(batch, dtype=self.tf.float32)).numpy()
+
+
+class TFLiteEngine:
+    """A converted .tflite model; uses tflite_runtime when installed, TensorFlow's interpreter otherwise."""
+
+    name = 'tflite'
+
+    def __init__(self, model_path):
+        path = model_path if model_path.endswith('.tflite') else artifact_path(model_path, 'tflite')
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(int(n) for n in self.input['shape'][1:])
+        self.batch_size = int(self.input['shape'][0])
+
+    def predict(self, batch):
+        # The interpreter has one fixed input shape; it is resized only when the batch size changes
+        if len(batch) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], (len(batch),) + self.input_shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(batch)
+        self.interpreter.set_tensor(self.input['index'], np.ascontiguousarray(batch, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index'])
+
+
+class OnnxEngine:
+    """An exported .onnx model run by ONNX Runtime on the CPU."""
+
+    name = 'onnx'
+
+    def __init__(self, model_path):
+        import onnxruntime
+
+        path = model_path if model_path.endswith('.onnx') else artifact_path(model_path, 'onnx')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_shape = tuple(self.session.get_inputs()[0].shape[1:])
+
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+
+class RemoteEngine:
+    """The model held by a running model_server.py; the model path is the server's business.
+
+    A server restarted with another model is noticed on reconnect: a new version
+    is passed to on_version_change, a different input shape or window spec is
+    refused, as the monitor's windows were built for the old one.
+    """
+
+    name = 'remote'
+
+    def __init__(self, model_path=None, address=None, authkey=None):
+        from model_server import ADDRESS, AUTHKEY_ENV, KEY_FILE, load_authkey
+
+        self.address = address or ADDRESS
+        self.authkey = authkey or load_authkey()
+        if not self.authkey:
+            raise RuntimeError(f"No model server auth key: set {AUTHKEY_ENV} or copy the server's {KEY_FILE} here")
+        self.lock = threading.Lock()
+        self.connection = None
+        self.info = None
+        self.on_version_change = None  # Called with the new version, on the thread that noticed it
+        self.info = self._request('info', None)
+        self.input_shape = tuple(self.info['input_shape'])
+        self.version = self.info['version']
+        self.window = self.info.get('window')  # The served model's window spec (device_windows.py)
+
+    def _connect(self):
+        from multiprocessing.connection import Client
+
+        connection = Client(self.address, authkey=self.authkey)
+        if self.info is not None:
+            # A reconnect: the server may have been restarted with another model
+            connection.send(('info', None))
+            status, info = connection.recv()
+            if status != 'ok':
+                connection.close()
+                raise RuntimeError(f"Model server error: {info}")
+            if tuple(info['input_shape']) != self.input_shape or info.get('window') != self.window:
+                connection.close()
+                raise RuntimeError(f"The model server now serves {info['version']} with input shape "
+                                   f"{tuple(info['input_shape'])} and window {info.get('window')}, not "
+                                   f"{self.input_shape} and {self.window}; restart the monitor to use it")
+            if info['version'] != self.version:
+                self.info, self.version = info, info['version']
+                if self.on_version_change is not None:
+                    self.on_version_change(self.version)
+        self.connection = connection
+
+    def _request(self, command, body):
+        with self.lock:
+            # One reconnect, so a restarted server is picked up without failing the batch
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self._connect()
+                    self.connection.send((command, body))
+                    status, reply = self.connection.recv()
+                    break
+                except (EOFError, OSError):
+                    self.connection = None
+                    if attempt:
+                        raise
+        if status != 'ok':
+            raise RuntimeError(f"Model server error: {reply}")
+        return reply
+
+    def predict(self, batch):
+        return self._request('predict', np.ascontiguousarray(batch, dtype=np.float32))
+
+
+BACKENDS = {
+    'keras': KerasEngine,
+    'tf_function': TFFunctionEngine,
+    'tflite': TFLiteEngine,
+    'onnx': OnnxEngine,
+    'numpy': NumpyAutoencoder,
+    'remote': RemoteEngine,
+}
+
+
+def load_engine(backend='keras', model_path=MODEL_FILE):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[backend](model_path)
+
+
+def warm_up(engine, batch_sizes=(1, 64), rounds=2):
+    """Run dummy batches through a freshly loaded engine so tracing, allocation and resizing for the usual
+    batch sizes happen before the first real reading."""
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size,) + tuple(engine.input_shape), dtype=np.float32)
+        for _ in range(rounds):
+            engine.predict(batch)
+
+
+def convert(model_path, targets):
+    """Write the .tflite and/or .onnx artifacts for model_path; returns their paths."""
+    import tensorflow as tf
+
+    model = _load_keras(model_path)
+    signature = tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name='input')
+    written = []
+    if 'tflite' in targets:
+        function = tf.function(lambda batch: model(batch, training=False), input_signature=[signature])
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()], model)
+        # Keras LSTMs with ReLU do not map onto the fused TFLite LSTM op; keep what does not as TF ops
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        converter._experimental_lower_tensor_list_ops = False
+        path = artifact_path(model_path, 'tflite')
+        with open(path, 'wb') as file:
+            file.write(converter.convert())
+        written.append(path)
+    if 'onnx' in targets:
+        import tf2onnx
+
+        path = artifact_path(model_path, 'onnx')
+        tf2onnx.convert.from_keras(model, input_signature=(signature,), opset=13, output_path=path)
+        written.append(path)
+    return written
+
+
+def sample_batch(input_shape, rows, seed=0):
+    # Scaled features are in [0, 1] (MinMaxScaler), so uniform samples cover the model's input range
+    return np.random.default_rng(seed).random((rows,) + tuple(input_shape), dtype=np.float32)
+
+
+def parity(model_path, backends, rows=512, tolerance=1e-4, reference='keras'):
+    """Compare every backend's reconstruction losses with the reference backend's; returns True if all match."""
+    expected_engine = load_engine(reference, model_path)
+    batch = sample_batch(expected_engine.input_shape, rows)
+    expected = reconstruction_losses(expected_engine.predict(batch), batch)
+    ok = True
+    for backend in backends:
+        engine = load_engine(backend, model_path)
+        losses = reconstruction_losses(engine.predict(batch), batch)
+        error = float(np.max(np.abs(losses - expected)))
+        passed = error <= tolerance
+        ok = ok and passed
+        print(f"{backend:<12} max |loss - {reference}| = {error:.2e}  {'ok' if passed else 'MISMATCH'}")
+    return ok
+
+
+def benchmark(model_path, backends, batch_sizes=(1, 64), repeats=200):
+    for backend in backends:
+        start = time.perf_counter()
+        engine = load_engine(backend, model_path)
+        load_time = time.perf_counter() - start
+        for batch_size in batch_sizes:
+            batch = sample_batch(engine.input_shape, batch_size)
+            engine.predict(batch)  # Warm up
+            start = time.perf_counter()
+            for _ in range(repeats):
+                engine.predict(batch)
+            elapsed = (time.perf_counter() - start) / repeats
+            print(f"{backend:<12} load {load_time:6.2f}s  batch {batch_size:>4}: {elapsed * 1e3:8.3f} ms/call  "
+                  f"{elapsed / batch_size * 1e6:8.1f} us/row")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert, check and benchmark the inference backends")
+    commands = parser.add_subparsers(dest='command', required=True)
+    conv = commands.add_parser('convert', help="Write the .tflite and .onnx artifacts next to the .h5")
+    conv.add_argument('model', nargs='?', default=MODEL_FILE)
+    conv.add_argument('--to', nargs='+', choices=['tflite', 'onnx'], default=['tflite', 'onnx'])
+    check = commands.add_parser('parity', help="Check that the backends' reconstruction losses match Keras")
+    check.add_argument('model', nargs='?', default=MODEL_FILE)
+    check.add_argument('--backends', nargs='+', default=['tf_function', 'tflite', 'onnx', 'numpy'])
+    check.add_argument('--rows', type=int, default=512)
+    check.add_argument('--tolerance', type=float, default=1e-4)
+    bench = commands.add_parser('bench', help="Time every backend")
+    bench.add_argument('model', nargs='?', default=MODEL_FILE)
+    bench.add_argument('--backends', nargs='+', default=list(BACKENDS))
+    bench.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64])
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        for path in convert(args.model, args.to):
+            print(f"Wrote {path}")
+        return 0
+    if args.command == 'parity':
+        return 0 if parity(args.model, args.backends, args.rows, args.tolerance) else 1
+    benchmark(args.model, args.backends, args.batch_sizes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
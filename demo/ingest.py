@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import deque
+
+# What submit() does when the queue already holds maxsize readings
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class _Task:
+    __slots__ = ('fn', 'args', 'kwargs', 'control', 'enqueued_at', 'done', 'result')
+
+    def __init__(self, fn, args, kwargs, control):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.control = control
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event() if control else None
+        self.result = None
+
+
+class IngestPipeline:
+    """Bounded queue drained by a single writer thread.
+
+    The MQTT callback only parses a message and submit()s it; the writer thread
+    runs every queued task in order and is the only place that touches the
+    device state or the disk. Readings are bounded by maxsize and handled with
+    the overflow policy, control tasks (saves, climate samples, shutdown) are
+    never dropped.
+    """
+
+    def __init__(self, maxsize=10000, overflow='drop_oldest', block_timeout=1.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.tasks = deque()
+        self.pending_readings = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.max_queue_time = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a reading. Returns False if the overflow policy dropped it."""
+        with self.condition:
+            if self.pending_readings >= self.maxsize:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                if self.overflow == 'drop_oldest':
+                    self._drop_oldest_reading()
+                else:
+                    deadline = time.monotonic() + self.block_timeout
+                    while self.pending_readings >= self.maxsize:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.dropped += 1
+                            return False
+                        self.condition.wait(remaining)
+            self._put(_Task(fn, args, kwargs, control=False))
+            return True
+
+    def call(self, fn, *args, wait=False, **kwargs):
+        """Queue a control task behind everything already queued, optionally waiting for its result."""
+        task = _Task(fn, args, kwargs, control=True)
+        with self.condition:
+            self._put(task)
+        if wait:
+            task.done.wait()
+        return task.result
+
+    def depth(self):
+        with self.condition:
+            return len(self.tasks)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'depth': len(self.tasks),
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'max_queue_time': round(self.max_queue_time, 3),
+            }
+
+    def stop(self, timeout=None):
+        # Let the writer drain what is already queued, then exit
+        self.call(self._halt)
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _halt(self):
+        self.running = False
+
+    def _put(self, task):
+        self.tasks.append(task)
+        self.enqueued += 1
+        if not task.control:
+            self.pending_readings += 1
+        self.max_depth = max(self.max_depth, len(self.tasks))
+        self.condition.notify_all()
+
+    def _drop_oldest_reading(self):
+        for i, task in enumerate(self.tasks):
+            if not task.control:
+                del self.tasks[i]
+                self.pending_readings -= 1
+                self.dropped += 1
+                return
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                while not self.tasks:
+                    self.condition.wait()
+                task = self.tasks.popleft()
+                if not task.control:
+                    self.pending_readings -= 1
+                self.max_queue_time = max(self.max_queue_time, time.monotonic() - task.enqueued_at)
+                self.condition.notify_all()
+            try:
+                task.result = task.fn(*task.args, **task.kwargs)
+            except Exception as e:
+                self.errors += 1
+                print(f"Ingest task {getattr(task.fn, '__name__', task.fn)} failed: {e}")
+            finally:
+                self.processed += 1
+                if task.done is not None:
+                    task.done.set()
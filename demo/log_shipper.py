@@ -0,0 +1,103 @@
+import socket
+import threading
+import time
+from collections import deque
+
+
+class LogShipper:
+    """Ships log lines to the DeviceMonitorApp log server over one persistent TCP connection.
+
+    ship() only appends to an in-memory ring buffer and never blocks. A background
+    thread sends the buffered lines in batches and reconnects with exponential
+    backoff. While the server is down the buffer keeps the newest `capacity`
+    lines and counts the ones it had to drop.
+    """
+
+    def __init__(self, host='localhost', port=9999, prefix='', capacity=10000, batch_lines=200,
+                 flush_interval=0.1, connect_timeout=2.0, max_backoff=30.0):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.batch_lines = batch_lines
+        self.flush_interval = flush_interval
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.buffer = deque(maxlen=capacity)
+        self.condition = threading.Condition()
+        self.sock = None
+        self.running = True
+
+        # Counters
+        self.shipped = 0
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+        self.thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self.thread.start()
+
+    def ship(self, line):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1  # The oldest line is overwritten
+            self.buffer.append(self.prefix + line.rstrip('\n') + '\n')
+            self.shipped += 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {'buffered': len(self.buffer), 'shipped': self.shipped, 'sent': self.sent,
+                    'dropped': self.dropped, 'reconnects': self.reconnects, 'connected': self.sock is not None}
+
+    def _take_batch(self):
+        with self.condition:
+            while self.running and not self.buffer:
+                self.condition.wait()
+            batch = []
+            while self.buffer and len(batch) < self.batch_lines:
+                batch.append(self.buffer.popleft())
+            return batch
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reconnects += 1
+
+    def _close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _run(self):
+        backoff = 0.5
+        batch = []
+        while self.running or batch or self.buffer:
+            if not batch:
+                batch = self._take_batch()
+                if not batch:
+                    continue
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(''.join(batch).encode('utf-8'))
+                self.sent += len(batch)
+                batch = []
+                backoff = 0.5
+                # Give more lines a moment to accumulate so they share one send
+                time.sleep(self.flush_interval)
+            except OSError:
+                self._close_socket()
+                if not self.running:
+                    break
+                # Hold on to the failed batch and retry; new lines keep filling the ring buffer meanwhile
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        self._close_socket()
+
+    def close(self, timeout=2.0):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+
+
+class LossCache:
+    """Bounded LRU of reconstruction losses keyed by the model's exact input.
+
+    Readings are rounded to 2 decimals and the climate changes every few
+    minutes, so the same window of features comes back again and again; its
+    loss is the same as long as the model and scaler are. Entries belong to one
+    model version: set_version() with a different version (or clear()) drops
+    them all, so a reloaded model or scaler never serves an old loss.
+
+    Not thread-safe; the monitor only touches it from the batcher thread.
+    """
+
+    def __init__(self, capacity=65536, version=None):
+        self.capacity = capacity
+        self.version = version
+        self.entries = OrderedDict()  # key -> loss, least recently used first
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clears = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        loss = self.entries.get(key)
+        if loss is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return loss
+
+    def put(self, key, loss):
+        self.entries[key] = loss
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.clears += 1
+
+    def set_version(self, version):
+        """Switch to a model version; the cache is emptied unless it is the version already cached."""
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None, 'clears': self.clears,
+                'version': self.version}
@@ -56,14 +56,18 @@ class DeviceMonitorApp:
         server_socket.close()
 
     def handle_client(self, client_socket):
+        # Senders keep the connection open and send batches of lines, so split the stream on newlines
+        pending = b''
         with client_socket:
             while self.running:
-                data = client_socket.recv(1024).decode('utf-8')
-                if data:
-                    print(f"Data received: {data}")
-                    self.update_gui(data)
-                else:
+                data = client_socket.recv(65536)
+                if not data:
                     break
+                *lines, pending = (pending + data).split(b'\n')
+                for line in lines:
+                    line = line.decode('utf-8', errors='replace') + '\n'
+                    print(f"Data received: {line}", end='')
+                    self.update_gui(line)
 
     def update_gui(self, data):
         if data.startswith('Capture:'):
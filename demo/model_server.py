@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import secrets
+import ipaddress
+import logging
+import argparse
+import threading
+from multiprocessing.connection import Listener
+
+from device_windows import load_window_spec
+from inference_engine import MODEL_FILE, load_engine, model_version, warm_up
+
+# A long-lived process that keeps the model loaded and warmed up, so monitor instances attach to it
+# (INFERENCE_BACKEND = 'remote') instead of loading the model on every restart.
+#
+# Protocol, over multiprocessing.connection with an auth key, one request and one reply at a time:
+#   ('predict', float32 array (batch, timesteps, features)) -> ('ok', reconstruction) | ('error', message)
+#   ('info', None)                                          -> ('ok', {backend, model, input_shape, version, window})
+#
+# Replies are unpickled by the client and requests by the server, so the auth key is all that keeps anyone
+# else from running code in either process. There is no built-in key: both ends read it from
+# $MODEL_SERVER_AUTHKEY or from the key file, which must not be readable by other users. A server on a
+# loopback address writes a fresh key file when there is neither; on any other address it refuses to start.
+ADDRESS = ('localhost', 6010)
+AUTHKEY_ENV = 'MODEL_SERVER_AUTHKEY'
+KEY_FILE = 'model_server.key'
+
+
+def load_authkey(key_file=KEY_FILE):
+    """The shared key from $MODEL_SERVER_AUTHKEY, else from key_file; None when neither is set."""
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode('utf-8')
+    try:
+        mode = os.stat(key_file).st_mode
+    except FileNotFoundError:
+        return None
+    if mode & 0o077:
+        raise PermissionError(f"{key_file} is accessible to other users; chmod 600 it")
+    with open(key_file, 'rb') as file:
+        key = file.read().strip()
+    if not key:
+        raise ValueError(f"{key_file} is empty")
+    return key
+
+
+def create_key_file(key_file=KEY_FILE):
+    # O_EXCL with mode 0600: never overwrites a key, never exists with looser permissions
+    key = secrets.token_hex(32).encode('ascii')
+    with os.fdopen(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as file:
+        file.write(key + b'\n')
+    return key
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+class ModelServer:
+    def __init__(self, backend, model_path, address, authkey):
+        if not authkey:
+            raise ValueError("The model server needs an auth key")
+        self.backend = backend
+        self.model_path = model_path
+        self.address = address
+        self.authkey = authkey
+        self.engine = None
+        self.info = None
+        self.lock = threading.Lock()  # One forward pass at a time; the engines are not all thread-safe
+        self.requests = 0
+        self.rows = 0
+
+    def load(self):
+        started = time.monotonic()
+        engine = load_engine(self.backend, self.model_path)
+        warm_up(engine)
+        self.engine = engine
+        self.info = {'backend': self.backend, 'model': self.model_path, 'input_shape': engine.input_shape,
+                     'version': model_version(self.model_path), 'window': load_window_spec(self.model_path)}
+        logging.info(f"Loaded {self.model_path} with the {self.backend} backend in {time.monotonic() - started:.2f}s")
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    command, body = connection.recv()
+                except (EOFError, OSError):
+                    return  # The client went away
+                try:
+                    if command == 'predict':
+                        with self.lock:
+                            reply = ('ok', self.engine.predict(body))
+                        self.requests += 1
+                        self.rows += len(body)
+                    elif command == 'info':
+                        reply = ('ok', self.info)
+                    else:
+                        reply = ('error', f"Unknown command {command!r}")
+                except Exception as e:
+                    logging.error(f"Error serving {command}: {e}")
+                    reply = ('error', str(e))
+                try:
+                    connection.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            logging.info(f"Model server listening on {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:  # A client with the wrong key, or one that hung up mid-handshake
+                    logging.error(f"Rejected a connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), name="model-client", daemon=True).start()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the anomaly model to device monitors")
+    parser.add_argument('model', nargs='?', default=MODEL_FILE)
+    parser.add_argument('--backend', default='numpy', help="Inference backend the server runs the model with")
+    parser.add_argument('--address', type=parse_address, default=ADDRESS, help="host:port to listen on")
+    parser.add_argument('--key-file', default=KEY_FILE,
+                        help=f"Auth key shared with the monitors, mode 600; ${AUTHKEY_ENV} takes precedence")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        authkey = load_authkey(args.key_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if authkey is None:
+        if not is_loopback(args.address[0]):
+            parser.error(f"refusing to listen on {args.address[0]} without an auth key: "
+                         f"set {AUTHKEY_ENV} or create {args.key_file} (mode 600)")
+        authkey = create_key_file(args.key_file)
+        logging.info(f"Wrote a new auth key to {args.key_file}")
+    server = ModelServer(args.backend, args.model, args.address, authkey)
+    server.load()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info(f"Model server stopped after {server.requests} requests, {server.rows} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# The LSTM autoencoder from setup.py run with NumPy alone: the layer stack and weights are read from the
+# Keras .h5 with h5py, so scoring needs neither TensorFlow nor a converted model file.
+MODEL_FILE = "lstm_model_with_external_variables.h5"
+
+
+def _sigmoid(z):
+    # Same values as 1 / (1 + exp(-z)) without overflowing for large negative z
+    return 0.5 * (np.tanh(0.5 * z) + 1)
+
+
+def _hard_sigmoid(z):
+    return np.clip(0.2 * z + 0.5, 0, 1)
+
+
+ACTIVATIONS = {
+    'linear': lambda z: z,
+    'relu': lambda z: np.maximum(z, 0),
+    'tanh': np.tanh,
+    'sigmoid': _sigmoid,
+    'hard_sigmoid': _hard_sigmoid,
+}
+
+
+def _activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError(f"Unsupported activation {name!r}")
+    return ACTIVATIONS[name]
+
+
+class LSTMLayer:
+    """A Keras LSTM layer; gates are packed i, f, c, o along the last axis of kernel, recurrent_kernel and bias."""
+
+    def __init__(self, config, weights):
+        if config.get('go_backwards') or config.get('stateful'):
+            raise ValueError(f"LSTM layer {config['name']} uses options the NumPy model does not support")
+        self.units = config['units']
+        self.activation = _activation(config['activation'])
+        self.recurrent_activation = _activation(config['recurrent_activation'])
+        self.return_sequences = config['return_sequences']
+        self.kernel, self.recurrent_kernel = weights[0], weights[1]
+        self.bias = weights[2] if len(weights) > 2 else np.zeros(4 * self.units, dtype=np.float32)
+
+    def __call__(self, x, repeat=None):
+        """x is (batch, steps, features), or (batch, features) fed at each of `repeat` steps (a RepeatVector)."""
+        units = self.units
+        if repeat is None:
+            batch, steps = x.shape[:2]
+            # The input projections of every step in one matrix product; only h @ U is left for the loop
+            inputs = (x.reshape(batch * steps, -1) @ self.kernel + self.bias).reshape(batch, steps, 4 * units)
+        else:
+            batch, steps = x.shape[0], repeat
+            inputs = x @ self.kernel + self.bias
+        h = np.zeros((batch, units), dtype=np.float32)
+        c = np.zeros((batch, units), dtype=np.float32)
+        outputs = np.empty((batch, steps, units), dtype=np.float32) if self.return_sequences else None
+        for step in range(steps):
+            z = inputs if repeat is not None else inputs[:, step]
+            if step:
+                z = z + h @ self.recurrent_kernel  # h is all zeros on the first step
+            i = self.recurrent_activation(z[:, :units])
+            f = self.recurrent_activation(z[:, units:2 * units])
+            g = self.activation(z[:, 2 * units:3 * units])
+            o = self.recurrent_activation(z[:, 3 * units:])
+            c = f * c + i * g
+            h = o * self.activation(c)
+            if outputs is not None:
+                outputs[:, step] = h
+        return outputs if outputs is not None else h
+
+
+class DenseLayer:
+    """A Dense layer, also used for TimeDistributed(Dense), which is the same product on the last axis."""
+
+    def __init__(self, config, weights):
+        self.activation = _activation(config['activation'])
+        self.kernel = weights[0]
+        self.bias = weights[1] if len(weights) > 1 else 0
+
+    def __call__(self, x):
+        return self.activation(x @ self.kernel + self.bias)
+
+
+def _layer_weights(group):
+    return [np.asarray(group[name], dtype=np.float32)
+            for name in (n.decode() if isinstance(n, bytes) else n for n in group.attrs['weight_names'])]
+
+
+class NumpyAutoencoder:
+    """A Sequential Keras model of LSTM, RepeatVector, Dropout and (TimeDistributed) Dense layers, run batched.
+
+    Has the inference engine interface: predict() takes a float32 batch of
+    shape (batch, timesteps, features) and returns its reconstruction.
+    """
+
+    name = 'numpy'
+
+    def __init__(self, model_path=MODEL_FILE):
+        import h5py
+
+        self.layers = []  # (kind, layer or RepeatVector's n)
+        self.input_shape = None
+        with h5py.File(model_path, 'r') as file:
+            config = file.attrs['model_config']
+            config = json.loads(config.decode() if isinstance(config, bytes) else config)
+            weights = file['model_weights'] if 'model_weights' in file else file
+            if config['class_name'] != 'Sequential':
+                raise ValueError(f"{model_path} holds a {config['class_name']} model, only Sequential is supported")
+            for layer in config['config']['layers']:
+                kind, layer_config = layer['class_name'], layer['config']
+                shape = layer_config.get('batch_input_shape') or layer_config.get('batch_shape')
+                if shape and self.input_shape is None:
+                    self.input_shape = tuple(shape[1:])
+                if kind in ('InputLayer', 'Dropout'):
+                    continue  # Dropout does nothing at inference time
+                if kind == 'RepeatVector':
+                    self.layers.append(('repeat', layer_config['n']))
+                elif kind == 'LSTM':
+                    self.layers.append(('lstm', LSTMLayer(layer_config, _layer_weights(weights[layer_config['name']]))))
+                elif kind == 'Dense' or (kind == 'TimeDistributed' and layer_config['layer']['class_name'] == 'Dense'):
+                    dense_config = layer_config['layer']['config'] if kind == 'TimeDistributed' else layer_config
+                    self.layers.append(('dense', DenseLayer(dense_config, _layer_weights(weights[layer_config['name']]))))
+                else:
+                    raise ValueError(f"Unsupported layer {kind} in {model_path}")
+
+    def predict(self, batch):
+        x = np.asarray(batch, dtype=np.float32)
+        repeat = None
+        for kind, layer in self.layers:
+            if kind == 'repeat':
+                repeat = layer  # Not materialised: the next LSTM reuses one input projection for every step
+            elif kind == 'lstm':
+                x = layer(x, repeat)
+                repeat = None
+            else:
+                if repeat is not None:
+                    x = np.repeat(x[:, None], repeat, axis=1)
+                    repeat = None
+                x = layer(x)
+        return x
+
+
+def measure(backend, model_path, batch_sizes, repeats):
+    """Import, load and latency figures of one backend plus this process's peak RSS, as a dict."""
+    import resource
+
+    start = time.perf_counter()
+    from inference_engine import load_engine, sample_batch
+    engine = load_engine(backend, model_path)
+    result = {'backend': backend, 'load_s': time.perf_counter() - start, 'latency_ms': {}}
+    for batch_size in batch_sizes:
+        batch = sample_batch(engine.input_shape, batch_size)
+        engine.predict(batch)  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            engine.predict(batch)
+        result['latency_ms'][batch_size] = (time.perf_counter() - start) / repeats * 1e3
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NumPy forward pass of the LSTM autoencoder")
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser('parity', help="Compare reconstruction losses with Keras (needs TensorFlow)")
+    check.add_argument('model', nargs='?', default=MODEL_FILE)
+    check.add_argument('--rows', type=int, default=512)
+    check.add_argument('--tolerance', type=float, default=1e-5)
+    bench = commands.add_parser('bench', help="Compare load time, latency and memory, one process per backend")
+    bench.add_argument('model', nargs='?', default=MODEL_FILE)
+    bench.add_argument('--backends', nargs='+', default=['numpy', 'keras'])
+    bench.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64])
+    bench.add_argument('--repeats', type=int, default=200)
+    single = commands.add_parser('measure', help=argparse.SUPPRESS)
+    single.add_argument('backend')
+    single.add_argument('model')
+    single.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64])
+    single.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.command == 'parity':
+        from inference_engine import parity
+        return 0 if parity(args.model, ['numpy'], args.rows, args.tolerance) else 1
+    if args.command == 'measure':
+        print(json.dumps(measure(args.backend, args.model, args.batch_sizes, args.repeats)))
+        return 0
+
+    # A fresh interpreter per backend, so TensorFlow's imports do not count against the NumPy model
+    for backend in args.backends:
+        command = [sys.executable, __file__, 'measure', backend, args.model, '--repeats', str(args.repeats),
+                   '--batch-sizes'] + [str(size) for size in args.batch_sizes]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"{backend:<12} failed: {completed.stderr.strip().splitlines()[-1:]}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        latency = "  ".join(f"batch {size}: {ms:.3f} ms" for size, ms in result['latency_ms'].items())
+        print(f"{backend:<12} import+load {result['load_s']:6.2f}s  peak RSS {result['peak_rss_mb']:7.1f} MB  {latency}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
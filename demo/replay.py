@@ -0,0 +1,283 @@
+import os
+import re
+import sys
+import time
+import struct
+import argparse
+from datetime import datetime, timedelta
+
+# Replay recorded zigbee2mqtt traffic through the capture and monitor handlers without a broker.
+#
+# Input is either a zigbee2mqtt (or device_simul.py) log, where every publish looks like
+#   [2024-07-01 10:00:00] info:     z2m:mqtt: MQTT publish: topic 'zigbee2mqtt/0xa4c1...', payload '{...}'
+# or a binary capture written by `replay.py record` / `replay.py convert`. Messages are handed to the
+# handlers with the time they were originally published, at 1x, Nx or maximum speed.
+
+LOG_LINE = re.compile(r"^\[(?P<time>[^\]]+)\].*?MQTT publish: topic '(?P<topic>[^']*)', payload '(?P<payload>.*)'\s*$")
+
+# Binary capture: a magic line, then one record per message: epoch seconds, topic length, payload length,
+# topic bytes, payload bytes
+CAPTURE_MAGIC = b"ZCAP1\n"
+CAPTURE_RECORD = struct.Struct('<dHI')
+
+TICK_INTERVAL = timedelta(minutes=1)  # Replayed time between CaptureWorker.tick() calls, as in device_capture.py
+
+# A replayed capture writes its stores, rollups, registry and WAL under REPLAY_DIR, apart from the live
+# capture's (device_capture.py's paths, below); writing into the live ones takes --into-live
+REPLAY_DIR = "replay"
+REPLAY_STORES = {'data_dir': REPLAY_DIR, 'wal_dir': os.path.join(REPLAY_DIR, 'wal'),
+                 'rollup_dir': os.path.join(REPLAY_DIR, 'rollups'), 'registry': os.path.join(REPLAY_DIR, 'devices.db')}
+LIVE_STORES = {'data_dir': '.', 'wal_dir': 'wal', 'rollup_dir': 'rollups', 'registry': 'devices.db'}
+
+
+def read_log(path):
+    """Yield (timestamp, topic, payload bytes) for every MQTT publish line of a zigbee2mqtt log."""
+    with open(path, encoding='utf-8', errors='replace') as file:
+        for line in file:
+            if "MQTT publish" not in line:
+                continue
+            match = LOG_LINE.match(line)
+            if match is None:
+                continue
+            try:
+                timestamp = datetime.fromisoformat(match.group('time').strip())
+            except ValueError:
+                continue
+            yield timestamp.replace(tzinfo=None), match.group('topic'), match.group('payload').encode('utf-8')
+
+
+def read_capture(path):
+    """Yield (timestamp, topic, payload bytes) from a binary capture file."""
+    with open(path, 'rb') as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = file.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            seconds, topic_length, payload_length = CAPTURE_RECORD.unpack(header)
+            body = file.read(topic_length + payload_length)
+            if len(body) < topic_length + payload_length:
+                return  # Torn tail of a capture that was still being written
+            yield datetime.fromtimestamp(seconds), body[:topic_length].decode('utf-8'), body[topic_length:]
+
+
+def read_messages(path):
+    with open(path, 'rb') as file:
+        is_capture = file.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+    return read_capture(path) if is_capture else read_log(path)
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def write(self, timestamp, topic, payload):
+        topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.file.write(CAPTURE_RECORD.pack(timestamp.timestamp(), len(topic), len(payload)) + topic + payload)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def paced(messages, speed):
+    """Yield the messages, sleeping so they come out `speed` times faster than recorded (None: no waiting)."""
+    start_wall = start_time = None
+    for message in messages:
+        if speed is not None:
+            if start_time is None:
+                start_wall, start_time = time.monotonic(), message[0]
+            delay = (message[0] - start_time).total_seconds() / speed - (time.monotonic() - start_wall)
+            if delay > 0:
+                time.sleep(delay)
+        yield message
+
+
+def parse_climate(text):
+    # 'temperature,humidity' in °C and percent, like the weather API and the climate CSV columns
+    try:
+        temperature, humidity = (float(value) for value in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected temperature,humidity, e.g. 28,80")
+    if not 1 < humidity <= 100:
+        raise argparse.ArgumentTypeError(f"humidity is in percent (1-100], got {humidity:g}; e.g. 28,80")
+    return temperature, humidity
+
+
+def parse_speed(text):
+    if text == 'max':
+        return None
+    speed = float(text.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+def replay(messages, worker=None, monitor=None, climate=None, speed=None, progress_every=100000):
+    """Feed messages to a CaptureWorker and/or the device_monitor module; returns counters."""
+    from capture_worker import reading_from_message
+    from zigbee_decode import decode_reading
+
+    counters = {'messages': 0, 'readings': 0, 'errors': 0}
+    next_tick = None
+    # At max speed the monitor scores readings in batches, as its MicroBatcher would under load
+    batch_size = monitor.INFERENCE_BATCH_SIZE if monitor is not None and speed is None else 1
+    pending = []
+    started = time.monotonic()
+    for timestamp, topic, payload in paced(messages, speed):
+        counters['messages'] += 1
+        try:
+            if worker is not None:
+                # Same path as device_capture.on_message, with the recorded time as the receive time
+                if next_tick is None:
+                    next_tick = timestamp + TICK_INTERVAL
+                while timestamp >= next_tick:
+                    worker.tick(next_tick)
+                    next_tick += TICK_INTERVAL
+                reading = reading_from_message(topic, payload, timestamp)
+                if reading is not None:
+                    worker.record_reading(*reading)
+                    counters['readings'] += 1
+            if monitor is not None:
+                reading = decode_reading(topic, payload)
+                if reading is not None:
+                    device, temperature, humidity, _ = reading
+                    pending.append((temperature, humidity, timestamp, climate, device))
+                    if len(pending) >= batch_size:
+                        batch, pending = pending, []
+                        monitor.handle_readings(batch)
+                    if worker is None:
+                        counters['readings'] += 1
+        except Exception as e:
+            counters['errors'] += 1
+            print(f"Error replaying message on {topic} at {timestamp}: {e}")
+        if progress_every and counters['messages'] % progress_every == 0:
+            elapsed = time.monotonic() - started
+            print(f"{counters['messages']} messages replayed, up to {timestamp}, {counters['messages'] / elapsed:,.0f} msg/s")
+    if pending:
+        monitor.handle_readings(pending)
+    counters['seconds'] = time.monotonic() - started
+    return counters
+
+
+def record(path, broker, port, topic):
+    import paho.mqtt.client as mqtt
+
+    writer = CaptureWriter(path)
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(topic)
+        else:
+            print(f"Failed to connect with result code {rc}")
+
+    def on_message(client, userdata, msg):
+        writer.write(datetime.now(), msg.topic, msg.payload)
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(broker, port, 60)
+    print(f"Recording {topic} to {path}, Ctrl+C to stop")
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    client.disconnect()
+    writer.close()
+    print(f"Recorded {writer.count} messages")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded zigbee2mqtt traffic without a broker")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Replay logs or captures through the capture and/or monitor handlers")
+    run.add_argument('inputs', nargs='+', help="zigbee2mqtt logs or capture files, replayed in the order given")
+    run.add_argument('--speed', type=parse_speed, default=None, help="1x, 10x, ... or max (default: max)")
+    run.add_argument('--capture', action='store_true', help="Feed device_capture's CaptureWorker")
+    run.add_argument('--monitor', action='store_true', help="Feed device_monitor's anomaly detection")
+    run.add_argument('--data-dir', help=f"Where the capture writes its hourly stores and CSVs (default: {REPLAY_DIR})")
+    run.add_argument('--wal-dir', help=f"default: {REPLAY_STORES['wal_dir']}")
+    run.add_argument('--rollup-dir', help=f"default: {REPLAY_STORES['rollup_dir']}")
+    run.add_argument('--registry', help=f"default: {REPLAY_STORES['registry']}")
+    run.add_argument('--into-live', action='store_true',
+                     help="Write into the live capture's stores, rollups and registry (never while it is running)")
+    run.add_argument('--climate', type=parse_climate, metavar='TEMP,HUMIDITY',
+                     help="Fixed climate for the monitor instead of the live weather: °C,percent, e.g. 28,80")
+    run.add_argument('--climate-from', nargs='+', metavar='CSV',
+                     help="Device CSV files whose climate columns are interpolated to each replayed reading")
+
+    convert = commands.add_parser('convert', help="Convert zigbee2mqtt logs to one binary capture file")
+    convert.add_argument('inputs', nargs='+')
+    convert.add_argument('output')
+
+    rec = commands.add_parser('record', help="Record live MQTT traffic to a capture file")
+    rec.add_argument('output')
+    rec.add_argument('--broker', default='localhost')
+    rec.add_argument('--port', type=int, default=1883)
+    rec.add_argument('--topic', default='zigbee2mqtt/#')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        writer = CaptureWriter(args.output)
+        for path in args.inputs:
+            for message in read_messages(path):
+                writer.write(*message)
+        writer.close()
+        print(f"Wrote {writer.count} messages to {args.output}")
+        return 0
+
+    if args.command == 'record':
+        record(args.output, args.broker, args.port, args.topic)
+        return 0
+
+    if not (args.capture or args.monitor):
+        parser.error("choose --capture and/or --monitor")
+    defaults = LIVE_STORES if args.into_live else REPLAY_STORES
+    for name, default in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    if not args.into_live:
+        # Two processes appending to one .hourly or .roll file, each with its own index, corrupt it
+        live = [name for name, path in LIVE_STORES.items()
+                if os.path.abspath(getattr(args, name)) == os.path.abspath(path)]
+        if args.capture and live:
+            parser.error(f"{', '.join('--' + name.replace('_', '-') for name in live)}: the live capture's files; "
+                         f"pass --into-live to write into them")
+    worker = monitor = None
+    if args.capture:
+        from capture_worker import CaptureWorker
+        os.makedirs(args.data_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(args.registry) or '.', exist_ok=True)
+        worker = CaptureWorker(data_dir=args.data_dir, wal_dir=args.wal_dir, registry_file=args.registry,
+                               rollup_dir=args.rollup_dir, log_readings=False)
+    if args.monitor:
+        import device_monitor as monitor
+        monitor.load_model()
+        if args.climate_from:
+            from climate_series import ClimateSeries
+            monitor.climate_series = ClimateSeries.from_csv(args.climate_from, max_gap=3 * 3600)
+        elif args.climate is None:
+            monitor.refresh_climate()  # The replay uses one climate snapshot throughout
+
+    messages = (message for path in args.inputs for message in read_messages(path))
+    try:
+        counters = replay(messages, worker, monitor, args.climate, args.speed)
+    finally:
+        if worker is not None:
+            worker.save_all_devices(final_save=True)
+            worker.close()
+    print(f"Replayed {counters['messages']} messages ({counters['readings']} readings, {counters['errors']} errors) "
+          f"in {counters['seconds']:.2f}s, {counters['messages'] / max(counters['seconds'], 1e-9):,.0f} msg/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
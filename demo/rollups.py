@@ -0,0 +1,261 @@
+import os
+import sys
+import math
+import struct
+import argparse
+import threading
+from datetime import datetime
+
+from aggregators import ReadingAggregate
+from hourly_store import LOCAL_TZ
+
+# Rollup levels, finest first; every level is built from the one before it
+RESOLUTIONS = (('1min', 60), ('1h', 3600), ('1d', 86400))
+ROLLUP_COLUMNS = ("temperature", "humidity")
+ROLLUP_ROOT = "rollups"
+ROLLUP_SUFFIX = ".roll"
+CLIMATE_SERIES = "_climate"  # Series name of the climate samples
+
+# One fixed-width record per bucket: bucket start (epoch seconds), then (count, sum, min, max) per column
+RECORD = struct.Struct('<q' + 'Iddd' * len(ROLLUP_COLUMNS))
+EMPTY = (0, 0.0, math.inf, -math.inf)
+
+# Buckets are aligned to local (+08:00) midnight, so a 1d bucket is a local calendar day
+LOCAL_OFFSET = int(LOCAL_TZ.utcoffset(None).total_seconds())
+
+
+def bucket_start(epoch_seconds, seconds):
+    return (int(epoch_seconds) + LOCAL_OFFSET) // seconds * seconds - LOCAL_OFFSET
+
+
+def to_epoch_seconds(timestamp):
+    # Naive datetimes are local (+08:00) times, as everywhere else in the capture pipeline
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=LOCAL_TZ)
+    return timestamp.timestamp()
+
+
+def merge_summary(old, new):
+    if new[0] == 0:
+        return old
+    if old[0] == 0:
+        return new
+    return old[0] + new[0], old[1] + new[1], min(old[2], new[2]), max(old[3], new[3])
+
+
+def summarize(stats):
+    return (stats.count, stats.total, stats.min, stats.max) if stats.count else EMPTY
+
+
+class RollupStore:
+    """Bucket records of one series at one resolution, with an in-memory bucket -> offset index.
+
+    Same layout idea as hourly_store.HourlyStore: records are appended, and
+    upserting a bucket that is already stored merges into it in place.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.index = {}
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self.file = open(path, 'rb' if readonly else 'r+b' if os.path.exists(path) else 'w+b')
+        self._build_index()
+
+    def _build_index(self):
+        self.file.seek(0)
+        offset = 0
+        while True:
+            chunk = self.file.read(RECORD.size)
+            if len(chunk) < RECORD.size:
+                break
+            self.index[RECORD.unpack(chunk)[0]] = offset
+            offset += RECORD.size
+        # Drop a torn record left behind by a crash in the middle of an append (or one being written, for a reader)
+        if not self.readonly:
+            self.file.truncate(offset)
+        self.end = offset
+
+    def _read(self, offset):
+        self.file.seek(offset)
+        fields = RECORD.unpack(self.file.read(RECORD.size))
+        return {column: fields[1 + 4 * i:5 + 4 * i] for i, column in enumerate(ROLLUP_COLUMNS)}
+
+    def upsert(self, start, values):
+        """Merge {column: (count, sum, min, max)} into the bucket starting at start."""
+        with self.lock:
+            self._put(self._merged(start, values))
+
+    def merged(self, start, values):
+        """The record fields upsert() would write, without writing them; put() them later."""
+        with self.lock:
+            return self._merged(start, values)
+
+    def put(self, fields):
+        """Write a whole record as returned by merged(); writing it again changes nothing."""
+        with self.lock:
+            self._put(fields)
+
+    def _merged(self, start, values):
+        offset = self.index.get(start)
+        current = self._read(offset) if offset is not None else {}
+        fields = [start]
+        for column in ROLLUP_COLUMNS:
+            fields.extend(merge_summary(current.get(column, EMPTY), values.get(column, EMPTY)))
+        return fields
+
+    def _put(self, fields):
+        start = fields[0]
+        offset = self.index.get(start)
+        if offset is None:
+            offset = self.end
+            self.end += RECORD.size
+            self.index[start] = offset
+        self.file.seek(offset)
+        self.file.write(RECORD.pack(*fields))
+        self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def range(self, start=None, end=None):
+        """Yield (bucket start, {column: (count, sum, min, max)}) for start <= bucket < end, in time order."""
+        with self.lock:
+            for key in sorted(self.index):
+                if (start is None or key >= start) and (end is None or key < end):
+                    yield key, self._read(self.index[key])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Rollups:
+    """Per-series 1 min / 1 h / 1 day count/sum/min/max rollups, maintained as readings arrive.
+
+    add() only updates the open 1 min bucket in memory. flush() cascades the
+    pending minute buckets into their hours and the hours into their days, then
+    merges each level into its store. Because every level merges, a flush in
+    the middle of a bucket and late readings for an old bucket both just add
+    to what is stored.
+    """
+
+    def __init__(self, root=ROLLUP_ROOT):
+        self.root = root
+        self.stores = {}
+        self.pending = {}  # (series, minute start) -> ReadingAggregate
+
+    def store(self, series, resolution):
+        key = (series, resolution)
+        if key not in self.stores:
+            directory = os.path.join(self.root, series)
+            os.makedirs(directory, exist_ok=True)
+            self.stores[key] = RollupStore(os.path.join(directory, resolution + ROLLUP_SUFFIX))
+        return self.stores[key]
+
+    def add(self, series, timestamp, temperature, humidity):
+        key = (series, bucket_start(to_epoch_seconds(timestamp), 60))
+        aggregate = self.pending.get(key)
+        if aggregate is None:
+            aggregate = self.pending[key] = ReadingAggregate()
+        aggregate.add(temperature, humidity)
+
+    def flush(self):
+        """Merge everything added since the last flush into the stores; returns the number of minute buckets."""
+        flushed = len(self.pending)
+        for store, fields in self.prepare():
+            store.put(fields)
+        return flushed
+
+    def prepare(self):
+        """Take everything added since the last flush and return [(store, record fields)]: what flush() would
+        write, merged with what is stored but not written yet, so the caller decides when it is applied."""
+        level = {key: {'temperature': summarize(aggregate.temperature), 'humidity': summarize(aggregate.humidity)}
+                 for key, aggregate in self.pending.items()}
+        self.pending = {}
+        writes = []
+        for i, (resolution, _) in enumerate(RESOLUTIONS):
+            for (series, start), values in level.items():
+                store = self.store(series, resolution)
+                writes.append((store, store.merged(start, values)))
+            if i + 1 == len(RESOLUTIONS):
+                break
+            # The next level is built from this level's buckets, not from the readings again
+            parent_seconds = RESOLUTIONS[i + 1][1]
+            coarser = {}
+            for (series, start), values in level.items():
+                parent = coarser.setdefault((series, bucket_start(start, parent_seconds)), {})
+                for column in ROLLUP_COLUMNS:
+                    parent[column] = merge_summary(parent.get(column, EMPTY), values[column])
+            level = coarser
+        return writes
+
+    def close(self):
+        # Pending buckets are not flushed here; they are still in the write-ahead log and come back on replay
+        for store in self.stores.values():
+            store.close()
+
+
+def query(root, series, resolution, start=None, end=None):
+    """Return [(bucket start, {column: {'count', 'mean', 'min', 'max'}})] for start <= bucket < end.
+
+    start and end are datetimes (naive ones are local time) or None for an open range.
+    """
+    path = os.path.join(root, series, resolution + ROLLUP_SUFFIX)
+    if not os.path.exists(path):
+        return []
+    store = RollupStore(path, readonly=True)
+    try:
+        rows = []
+        for key, values in store.range(None if start is None else to_epoch_seconds(start),
+                                       None if end is None else to_epoch_seconds(end)):
+            row = {}
+            for column, (count, total, low, high) in values.items():
+                row[column] = ({'count': count, 'mean': total / count, 'min': low, 'max': high} if count
+                               else {'count': 0, 'mean': None, 'min': None, 'max': None})
+            rows.append((datetime.fromtimestamp(key, LOCAL_TZ), row))
+        return rows
+    finally:
+        store.close()
+
+
+def list_series(root=ROLLUP_ROOT):
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the capture rollups")
+    parser.add_argument('--root', default=ROLLUP_ROOT)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="List the series that have rollups")
+    show = commands.add_parser('query', help="Print one series' buckets as CSV")
+    show.add_argument('series')
+    show.add_argument('--resolution', choices=[name for name, _ in RESOLUTIONS], default='1h')
+    show.add_argument('--start', type=datetime.fromisoformat)
+    show.add_argument('--end', type=datetime.fromisoformat)
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for series in list_series(args.root):
+            print(series)
+        return 0
+
+    header = ['time']
+    for column in ROLLUP_COLUMNS:
+        header += [f"{column}_{name}" for name in ('count', 'mean', 'min', 'max')]
+    print(','.join(header))
+    for start, row in query(args.root, args.series, args.resolution, args.start, args.end):
+        fields = [start.isoformat()]
+        for column in ROLLUP_COLUMNS:
+            stats = row[column]
+            fields.append(str(stats['count']))
+            fields += ['' if stats[name] is None else f"{stats[name]:.2f}" for name in ('mean', 'min', 'max')]
+        print(','.join(fields))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
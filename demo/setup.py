@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 import tensorflow as tf
@@ -7,14 +8,26 @@ from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import LSTM, RepeatVector, TimeDistributed, Dense, Dropout
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import EarlyStopping
+from columnar_history import HISTORY_ROOT, load_frame
+from device_windows import save_window_spec
+
+# Rows per training window. The monitor takes it from the saved model's input shape and keeps a
+# window of this many rows per device; 1 trains the original single-step model.
+SEQUENCE_LENGTH = 1
+MAX_WINDOW_GAP = pd.Timedelta(hours=2)  # Windows never span a hole in the data longer than this
+MODEL_FILE = 'lstm_model_with_external_variables.h5'
 
 # Set random seeds for reproducibility
 np.random.seed(42)
 tf.random.set_seed(42)
 
-# Load the dataset
+# Load the dataset, straight from the columnar history if it has been converted
+# (python columnar_history.py convert baseline_data.csv), otherwise by parsing the CSV
 file_path = 'baseline_data.csv'
-df = pd.read_csv(file_path, parse_dates=['time'], index_col='time')
+if os.path.isdir(os.path.join(HISTORY_ROOT, 'baseline_data')):
+    df = load_frame(HISTORY_ROOT, 'baseline_data')
+else:
+    df = pd.read_csv(file_path, parse_dates=['time'], index_col='time')
 
 # Feature engineering
 df['hour_of_day'] = df.index.hour
@@ -51,11 +64,22 @@ train, test = np.split(df_with_anomalies, [train_size])
 val_size = int(len(train) * 0.2)
 train, val = np.split(train, [len(train) - val_size])
 
+# Every run of `length` consecutive rows with no gap over MAX_WINDOW_GAP, as a (windows, length, features) array
+def make_windows(frame, features, length=SEQUENCE_LENGTH):
+    values = frame[features].to_numpy(dtype=np.float32)
+    if len(values) < length:
+        return np.empty((0, length, len(features)), dtype=np.float32)
+    # A strided view, window i being rows i..i+length-1; nothing is copied until the gap filter below
+    windows = np.lib.stride_tricks.sliding_window_view(values, length, axis=0).transpose(0, 2, 1)
+    gaps = np.concatenate([[0], np.cumsum(np.diff(frame.index) > MAX_WINDOW_GAP)])
+    contiguous = gaps[length - 1:] == gaps[:len(gaps) - length + 1]
+    return windows[contiguous]
+
 # Function to prepare data and train the model
 def train_and_save_model(features, train, val, test):
-    X_train = train[features].values.reshape((train.shape[0], 1, len(features)))
-    X_val = val[features].values.reshape((val.shape[0], 1, len(features)))
-    X_test = test[features].values.reshape((test.shape[0], 1, len(features)))
+    X_train = make_windows(train, features)
+    X_val = make_windows(val, features)
+    X_test = make_windows(test, features)
 
     model = Sequential([
         LSTM(64, activation='relu', input_shape=(X_train.shape[1], X_train.shape[2]), return_sequences=True),
@@ -75,8 +99,11 @@ def train_and_save_model(features, train, val, test):
 
     history = model.fit(X_train, X_train, epochs=20, batch_size=64, validation_data=(X_val, X_val), callbacks=[early_stopping])
 
-    # Save the model
-    model.save('lstm_model_with_external_variables.h5')
+    # Save the model, and next to it the spacing of the rows it was trained on: the baseline is hourly, and
+    # the monitor averages its raw readings into rows of the same cadence before windowing them
+    model.save(MODEL_FILE)
+    cadence = train.index.to_series().diff().median()
+    save_window_spec(MODEL_FILE, X_train.shape[1], cadence.total_seconds(), MAX_WINDOW_GAP.total_seconds())
 
     return model, history
 
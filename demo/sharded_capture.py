@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import wait as wait_ready
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+from capture_worker import CaptureWorker, reading_from_message
+from wal import is_drained
+from device_registry import DeviceRegistry
+from climate_provider import ClimateProvider
+
+# Sharded capture: one dispatcher process subscribes to MQTT and routes every reading to the worker
+# process that owns its device (crc32(device name) % workers). Each worker runs its own CaptureWorker
+# with its own WAL and writes only its own devices' hourly stores, so workers never share a file.
+#
+# MQTT v5 shared subscriptions ($share/...) are not used for the routing: the broker balances messages
+# per subscriber, not per device, so one device's readings would be split across workers.
+
+MQTT_BROKER = "localhost"
+MQTT_PORT = 1883
+MQTT_TOPIC_BASE = "zigbee2mqtt/#"
+
+DEVICES_FILE = "devices.json"
+REGISTRY_FILE = "devices.db"
+WAL_DIR = "wal"
+# The shard count the logs under WAL_DIR were written with. Which shard owns a device depends on it, so the
+# count may only change once every shard's log has been drained into the stores
+SHARDS_FILE = os.path.join(WAL_DIR, "shards.json")
+ROLLUP_DIR = "rollups"  # Shared by the workers; each writes only its own devices' series
+
+API_KEY = "446e884fa8fcaf1e943c89605dac07e5"  # Replace with your OpenWeatherMap API key
+LAT = 1.38
+LON = 103.85
+CLIMATE_TTL = 180
+
+SHARD_QUEUE_BATCHES = 1000  # Batches buffered per worker before readings are dropped
+BATCH_SIZE = 500  # Readings per batch sent to a worker
+BATCH_INTERVAL = 0.05  # Seconds a partial batch may wait before it is sent
+WINDOW_TICK_SECONDS = 60  # How often the workers' watermarks are moved on by wall-clock time
+REPLY_TIMEOUT = 120  # Seconds a broadcast waits for the workers' replies
+
+# Messages sent to the workers
+READINGS = 'readings'
+CLIMATE = 'climate'
+ADVANCE = 'advance'
+EXPORT = 'export'
+STOP = 'stop'
+
+# Reply statuses
+OK = 'ok'
+ERROR = 'error'
+DEAD = 'dead'  # Filled in by the dispatcher for a worker process that has exited
+TIMEOUT = 'timeout'
+
+
+def shard_of(device_name, shards):
+    return zlib.crc32(device_name.encode('utf-8')) % shards
+
+
+def shard_wal_dir(index):
+    return os.path.join(WAL_DIR, f"shard_{index}")
+
+
+def shard_worker(index, shards, data_dir, log):
+    return CaptureWorker(data_dir=data_dir, wal_dir=shard_wal_dir(index), registry_file=REGISTRY_FILE,
+                         rollup_dir=ROLLUP_DIR, log=log, log_readings=False,
+                         owns=lambda name: shard_of(name, shards) == index,
+                         rollup_climate=index == 0)  # Every worker gets the climate samples, one rolls them up
+
+
+def shard_log(index):
+    def log(message):
+        print(f"[shard {index}] {message}", flush=True)
+    return log
+
+
+def recorded_shards():
+    """The shard count the existing logs were written with, or None when there are none."""
+    try:
+        with open(SHARDS_FILE) as file:
+            return json.load(file)['shards']
+    except FileNotFoundError:
+        pass
+    # Logs from before the count was recorded: every run creates shard_0 .. shard_{count - 1}
+    indexes = [int(name[len('shard_'):]) for name in os.listdir(WAL_DIR)
+               if name.startswith('shard_') and name[len('shard_'):].isdigit()] if os.path.isdir(WAL_DIR) else []
+    return max(indexes) + 1 if indexes else None
+
+
+def shard_drained(index):
+    # A final save checkpoints the log down to nothing to replay
+    return is_drained(shard_wal_dir(index))
+
+
+def drain_shards(shards, data_dir):
+    """Replay every shard's log with the count it was written with and save it all, one shard at a time."""
+    for index in range(shards):
+        if shard_drained(index):
+            continue
+        worker = shard_worker(index, shards, data_dir, shard_log(index))
+        worker.save_all_devices(final_save=True)
+        worker.close()
+
+
+def claim_shard_count(shards, data_dir, drain=False):
+    """Record the shard count the workers are about to use. Refuses (SystemExit) a count different from
+    the one the logs were written with while those logs still hold data, as their devices would now be
+    replayed by the wrong shards, or by none; with drain, they are saved first."""
+    previous = recorded_shards()
+    if previous is not None and previous != shards:
+        if drain:
+            print(f"Draining the write-ahead logs of {previous} shards before switching to {shards}")
+            drain_shards(previous, data_dir)
+        undrained = [index for index in range(previous) if not shard_drained(index)]
+        if undrained:
+            raise SystemExit(f"The write-ahead logs in {WAL_DIR} were written by {previous} shards and shards "
+                             f"{undrained} still hold unsaved data: start with --workers {previous}, or add "
+                             f"--drain to save them first")
+        # Drained logs of shards that no longer exist would otherwise be counted as a layout next time
+        for index in range(shards, previous):
+            directory = shard_wal_dir(index)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+    os.makedirs(WAL_DIR, exist_ok=True)
+    with open(SHARDS_FILE + '.tmp', 'w') as file:
+        json.dump({'shards': shards}, file)
+    os.replace(SHARDS_FILE + '.tmp', SHARDS_FILE)
+
+
+def worker_main(index, shards, inbox, replies, data_dir):
+    log = shard_log(index)
+    worker = shard_worker(index, shards, data_dir, log)
+    # A failing reading or control message is logged and skipped, as in IngestPipeline; control messages
+    # are always answered, with their sequence number, so the dispatcher never waits on a live worker
+    while True:
+        kind, body, sequence = inbox.get()
+        if kind == READINGS:
+            for device_name, temperature, humidity, timestamp in body:
+                try:
+                    worker.record_reading(device_name, temperature, humidity, timestamp)
+                except Exception as e:
+                    log(f"Error recording a reading of {device_name} at {timestamp}: {e}")
+            continue
+        status, result = OK, None
+        try:
+            if kind == CLIMATE:
+                worker.record_climate(*body)
+            elif kind == ADVANCE:
+                worker.tick(body)
+                result = worker.windows.stats()
+            elif kind == EXPORT:
+                worker.export_csv_files()
+            elif kind == STOP:
+                worker.save_all_devices(final_save=True)
+                worker.close()
+        except Exception as e:
+            log(f"Error handling {kind}: {e}")
+            status, result = ERROR, str(e)
+        if sequence is not None:
+            replies.send((sequence, index, status, result))
+        if kind == STOP:
+            return
+
+
+class ShardDispatcher:
+    """Routes readings to worker processes in batches and moves their watermarks on together."""
+
+    def __init__(self, workers, data_dir='.'):
+        self.workers = workers
+        self.inboxes = [multiprocessing.Queue(SHARD_QUEUE_BATCHES) for _ in range(workers)]
+        # A reply pipe per worker, so a worker that dies mid-write cannot block the others' replies
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in range(workers)]
+        self.replies = [reader for reader, _ in pipes]
+        self.processes = [multiprocessing.Process(target=worker_main, name=f"capture-shard-{i}",
+                                                  args=(i, workers, self.inboxes[i], pipes[i][1], data_dir))
+                          for i in range(workers)]
+        self.pending = [[] for _ in range(workers)]
+        self.lock = threading.Lock()
+        # One broadcast at a time: the coordinator, the console and stop() all wait for replies
+        self.broadcast_lock = threading.Lock()
+        self.sequence = 0
+        self.running = True
+
+        # Counters
+        self.dispatched = [0] * workers
+        self.dropped = [0] * workers
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self._flush_loop, name="shard-flush", daemon=True).start()
+
+    def dispatch(self, device_name, temperature, humidity, timestamp):
+        shard = shard_of(device_name, self.workers)
+        with self.lock:
+            self.pending[shard].append((device_name, temperature, humidity, timestamp))
+            if len(self.pending[shard]) >= BATCH_SIZE:
+                self._send_batch(shard)
+
+    def _send_batch(self, shard):
+        batch, self.pending[shard] = self.pending[shard], []
+        try:
+            self.inboxes[shard].put_nowait((READINGS, batch, None))
+            self.dispatched[shard] += len(batch)
+        except queue.Full:
+            self.dropped[shard] += len(batch)
+
+    def _flush_loop(self):
+        while self.running:
+            time.sleep(BATCH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            for shard in range(self.workers):
+                if self.pending[shard]:
+                    self._send_batch(shard)
+
+    def broadcast(self, kind, body=None, wait=False, timeout=REPLY_TIMEOUT):
+        """Send a control message to every worker; with wait, returns [(index, status, result)] by worker.
+
+        A worker that has exited is reported as DEAD and one that does not
+        answer within timeout as TIMEOUT, instead of blocking the caller.
+        """
+        with self.broadcast_lock:
+            self.sequence += 1
+            sequence = self.sequence if wait else None
+            # Pending readings go first so every worker sees the control message after them
+            self.flush()
+            for index, inbox in enumerate(self.inboxes):
+                if self.processes[index].is_alive():
+                    inbox.put((kind, body, sequence))
+            if not wait:
+                return None
+            return self._collect(sequence, timeout)
+
+    def _collect(self, sequence, timeout):
+        replies = {}
+        waiting = set(range(self.workers))
+        deadline = time.monotonic() + timeout
+        while waiting:
+            remaining = deadline - time.monotonic()
+            # Wakes up on a reply or on a worker exiting (its sentinel), whichever comes first
+            if remaining <= 0 or not wait_ready([self.replies[i] for i in waiting]
+                                                + [self.processes[i].sentinel for i in waiting], remaining):
+                break
+            for index in list(waiting):
+                while index in waiting and self.replies[index].poll():
+                    reply_sequence, _, status, result = self.replies[index].recv()
+                    if reply_sequence == sequence:  # Late replies to an earlier, timed-out broadcast are dropped
+                        replies[index] = (index, status, result)
+                        waiting.discard(index)
+                if index in waiting and self.processes[index].exitcode is not None:
+                    replies[index] = (index, DEAD, self.processes[index].exitcode)
+                    waiting.discard(index)
+        for index in waiting:
+            replies[index] = (index, TIMEOUT, None)
+        failed = {index: (status, result) for index, status, result in replies.values() if status != OK}
+        if failed:
+            print(f"Workers that did not complete the broadcast: {failed}")
+        return [replies[index] for index in range(self.workers)]
+
+    def stats(self):
+        return {'dispatched': list(self.dispatched), 'dropped': list(self.dropped),
+                'queued_batches': [inbox.qsize() for inbox in self.inboxes],
+                'alive': [process.is_alive() for process in self.processes]}
+
+    def stop(self):
+        self.running = False
+        self.broadcast(STOP, wait=True)
+        for process in self.processes:
+            process.join(REPLY_TIMEOUT)
+            if process.is_alive():
+                print(f"{process.name} did not exit, terminating it")
+                process.terminate()
+        # Batches queued for a worker that died can never be delivered; do not wait for them at exit
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Capture zigbee2mqtt readings with one worker process per shard")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--drain', action='store_true',
+                        help="When --workers changed, first save the logs written with the old count")
+    args = parser.parse_args(argv)
+
+    # Import the old devices.json once, here, before the workers open the registry
+    registry = DeviceRegistry(REGISTRY_FILE)
+    if len(registry) == 0 and os.path.exists(DEVICES_FILE):
+        registry.import_json(DEVICES_FILE)
+    registry.close()
+    claim_shard_count(args.workers, args.data_dir, args.drain)
+
+    dispatcher = ShardDispatcher(args.workers, args.data_dir)
+    dispatcher.start()
+    print(f"Started {args.workers} capture workers")
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            print(f"Connected to MQTT broker with result code {rc}")
+            client.subscribe(MQTT_TOPIC_BASE)
+        else:
+            print(f"Failed to connect with result code {rc}")
+
+    def on_message(client, userdata, msg):
+        try:
+            reading = reading_from_message(msg.topic, msg.payload, datetime.now())
+            if reading is not None:
+                dispatcher.dispatch(*reading)
+        except Exception as e:
+            print(f"Error parsing message on {msg.topic}: {e}")
+
+    client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    while True:
+        try:
+            client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            break
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            time.sleep(5)
+    client.loop_start()
+
+    # The coordinator moves every worker's watermark on by wall-clock time, so an hour is saved even
+    # when a shard's devices go quiet; each worker saves the hours its watermark has passed
+    stopping = threading.Event()
+
+    def window_coordinator():
+        while not stopping.wait(WINDOW_TICK_SECONDS):
+            replies = dispatcher.broadcast(ADVANCE, datetime.now(), wait=True)
+            windows = {index: stats for index, status, stats in replies if status == OK}
+            print(f"Windows: {windows}, stats: {dispatcher.stats()}")
+
+    # Climate samples are fetched once and sent to every worker
+    climate = ClimateProvider(API_KEY, LAT, LON, ttl=CLIMATE_TTL)
+
+    def climate_fetcher():
+        last_time = None
+        while not stopping.is_set():
+            sample = climate.get()
+            if sample is not None and sample.fetched_at != last_time:
+                last_time = sample.fetched_at
+                dispatcher.broadcast(CLIMATE, tuple(sample))
+            stopping.wait(CLIMATE_TTL)
+
+    coordinator = threading.Thread(target=window_coordinator, name="window-coordinator", daemon=True)
+    coordinator.start()
+    threading.Thread(target=climate_fetcher, name="climate-fetcher", daemon=True).start()
+
+    try:
+        while True:
+            if input() == "":
+                dispatcher.broadcast(EXPORT, wait=True)
+                print(f"Exported CSV files, stats: {dispatcher.stats()}")
+    except (KeyboardInterrupt, EOFError):
+        print("\nExiting program...")
+    client.loop_stop()
+    client.disconnect()
+    # The coordinator must not be mid-ADVANCE when STOP goes out; a broadcast in progress finishes first
+    stopping.set()
+    coordinator.join(REPLY_TIMEOUT)
+    dispatcher.stop()
+    print("Shutdown complete")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
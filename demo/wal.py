@@ -0,0 +1,208 @@
+import os
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+# Record kinds
+READING = 1   # One device reading
+CLIMATE = 2   # One climate sample
+SNAPSHOT = 3  # An hour's aggregate of one device (or of the climate samples), as ReadingAggregate.to_dict()
+# A checkpoint segment starts with CHECKPOINT_BEGIN, holds the snapshots and ends them with CHECKPOINT_COMMIT.
+# Once the commit is on disk every older segment is superseded, whether or not it has been deleted yet; a
+# checkpoint segment without its commit is ignored, as the older segments still hold everything.
+CHECKPOINT_BEGIN = 4
+CHECKPOINT_COMMIT = 5
+
+# Every record is framed as (payload length, crc32 of payload) so a torn tail can be detected
+FRAME = struct.Struct('<II')
+SAMPLE = struct.Struct('<Bddd')  # kind, epoch seconds, temperature, humidity; the device name follows
+SEGMENT_PREFIX = "wal-"
+SEGMENT_SUFFIX = ".log"
+
+
+def _encode_value(value):
+    return math.nan if value is None else value
+
+
+def _decode_value(value):
+    return None if math.isnan(value) else value
+
+
+def _segments(directory):
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            sequence = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            segments.append((sequence, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def _payloads(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size:offset + FRAME.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            print(f"Stopping WAL replay of {path} at a torn record (offset {offset})")
+            return
+        offset += FRAME.size + length
+        yield payload
+
+
+def _checkpoint_state(path):
+    """None for a segment that is not a checkpoint, else whether the checkpoint was committed."""
+    with open(path, 'rb') as file:
+        head = file.read(FRAME.size + 1)
+    if len(head) < FRAME.size + 1 or head[FRAME.size] != CHECKPOINT_BEGIN:
+        return None
+    return any(payload[0] == CHECKPOINT_COMMIT for payload in _payloads(path))
+
+
+def _live_payloads(segments):
+    # The records a replay restores: from the latest committed checkpoint on, minus the checkpoint markers
+    states = {sequence: _checkpoint_state(path) for sequence, path in segments}
+    latest = max((sequence for sequence, state in states.items() if state), default=0)
+    for sequence, path in segments:
+        if sequence < latest or states[sequence] is False:
+            continue  # Superseded by a committed checkpoint, or a checkpoint that never committed
+        for payload in _payloads(path):
+            if payload[0] not in (CHECKPOINT_BEGIN, CHECKPOINT_COMMIT):
+                yield payload
+
+
+def is_drained(directory):
+    """True when a replay of the log in directory would restore nothing, e.g. after a final save."""
+    if not os.path.isdir(directory):
+        return True
+    return next(_live_payloads(_segments(directory)), None) is None
+
+
+class WriteAheadLog:
+    """Segmented append-only log of raw readings with group commit.
+
+    append() only buffers the record; a background thread flushes and fsyncs the
+    active segment every commit_interval_ms, so a burst of readings costs one
+    fsync. checkpoint() is called once the buffered data has been saved
+    elsewhere and drops every older segment. checkpointed is the sequence of
+    the latest committed checkpoint segment (0 when there is none).
+    """
+
+    def __init__(self, directory, commit_interval_ms=200, segment_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.commit_interval = commit_interval_ms / 1000
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.running = True
+        os.makedirs(directory, exist_ok=True)
+
+        # Never append after an existing (possibly torn) segment, always start a new one
+        existing = self._segments()
+        self.checkpointed = max((sequence for sequence, path in existing if _checkpoint_state(path)), default=0)
+        self.sequence = existing[-1][0] + 1 if existing else 1
+        self.file = self._open_segment(self.sequence)
+
+        self.committer = threading.Thread(target=self._commit_loop, name="wal-commit", daemon=True)
+        self.committer.start()
+
+    def _segments(self):
+        return _segments(self.directory)
+
+    def _open_segment(self, sequence):
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{sequence:08d}{SEGMENT_SUFFIX}")
+        return open(path, 'ab')
+
+    def _write(self, payload, rotate=True):
+        with self.lock:
+            self.file.write(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.dirty = True
+            if rotate and self.file.tell() >= self.segment_bytes:
+                self._sync()
+                self.file.close()
+                self.sequence += 1
+                self.file = self._open_segment(self.sequence)
+
+    def append_reading(self, device_name, timestamp, temperature, humidity):
+        self._write(SAMPLE.pack(READING, timestamp.timestamp(), _encode_value(temperature),
+                                _encode_value(humidity)) + device_name.encode('utf-8'))
+
+    def append_climate(self, timestamp, temperature, humidity):
+        self._write(SAMPLE.pack(CLIMATE, timestamp.timestamp(), _encode_value(temperature),
+                                _encode_value(humidity)))
+
+    def append_snapshot(self, device_name, aggregate, hour=None, rotate=True):
+        body = {'device': device_name, 'hourly': aggregate.to_dict()}
+        if hour is not None:
+            body['hour'] = hour.isoformat()
+        self._write(bytes([SNAPSHOT]) + json.dumps(body).encode('utf-8'), rotate)
+
+    def replay(self):
+        """Yield (kind, device_name, timestamp, temperature, humidity) for readings and climate
+        samples, and (SNAPSHOT, device_name, hour, aggregate_dict, None) for snapshots."""
+        with self.lock:
+            self._sync()
+            segments = self._segments()
+        for payload in _live_payloads(segments):
+            if payload[0] == SNAPSHOT:
+                body = json.loads(payload[1:].decode('utf-8'))
+                hour = datetime.fromisoformat(body['hour']) if 'hour' in body else None
+                yield SNAPSHOT, body['device'], hour, body['hourly'], None
+            else:
+                kind, seconds, temperature, humidity = SAMPLE.unpack_from(payload)
+                device_name = payload[SAMPLE.size:].decode('utf-8') or None
+                yield (kind, device_name, datetime.fromtimestamp(seconds),
+                       _decode_value(temperature), _decode_value(humidity))
+
+    def checkpoint(self, snapshot=()):
+        """Start a new segment and delete all older ones; their data is now saved elsewhere.
+
+        snapshot yields (hour, device_name, aggregate) for state that is still unsaved;
+        it is written to the new segment first so replay can restore it. The checkpoint
+        takes effect when its commit record is synced, before anything is deleted.
+        """
+        with self.lock:
+            self._sync()
+            self.file.close()
+            self.sequence += 1
+            self.file = self._open_segment(self.sequence)
+            first_kept = self.sequence
+        # The whole checkpoint stays in its own segment, so its commit is found where it began
+        self._write(bytes([CHECKPOINT_BEGIN]), rotate=False)
+        for hour, device_name, aggregate in snapshot:
+            self.append_snapshot(device_name, aggregate, hour, rotate=False)
+        self._write(bytes([CHECKPOINT_COMMIT]), rotate=False)
+        with self.lock:
+            self._sync()
+            self.checkpointed = first_kept
+            for sequence, path in self._segments():
+                if sequence < first_kept:
+                    os.remove(path)
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def _commit_loop(self):
+        while self.running:
+            time.sleep(self.commit_interval)
+            with self.lock:
+                if not self.file.closed:
+                    self._sync()
+
+    def close(self):
+        self.running = False
+        with self.lock:
+            self._sync()
+            self.file.close()
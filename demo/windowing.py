@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+
+from aggregators import ReadingAggregate
+
+# Watermark before any reading has been seen
+NO_WATERMARK = datetime(1970, 1, 1)
+
+# add() results
+ON_TIME = 'on_time'
+LATE = 'late'        # The hour was already saved; the reading goes into a delta that is saved on the next flush
+DROPPED = 'dropped'  # Later than the allowed lateness
+
+
+def hour_of(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def parse_device_time(value):
+    """Turn a zigbee2mqtt last_seen value (epoch ms or ISO 8601) into a naive local datetime."""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000)
+        timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except (ValueError, OverflowError, OSError):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+def choose_event_time(device_time, received_at, max_clock_skew=timedelta(minutes=5)):
+    # Trust the device's own timestamp unless it is missing or from the future
+    if device_time is None or device_time > received_at + max_clock_skew:
+        return received_at
+    return device_time
+
+
+class HourlyWindows:
+    """Hourly tumbling windows of per-device and climate aggregates, assigned by event time.
+
+    The watermark trails the newest event time by max_out_of_order. An hour is
+    due once the watermark passes its end; after it has been saved its
+    aggregates start empty again, so readings that arrive late (up to
+    allowed_lateness after the end of the hour) only form a small delta that
+    the next flush merges into the stored hour. Anything later is dropped and
+    counted.
+    """
+
+    def __init__(self, max_out_of_order=timedelta(minutes=2), allowed_lateness=timedelta(hours=1)):
+        self.max_out_of_order = max_out_of_order
+        self.allowed_lateness = allowed_lateness
+        self.devices = {}   # hour -> {device_name: ReadingAggregate}
+        self.climate = {}   # hour -> ReadingAggregate
+        self.fired = set()  # Hours that have been saved at least once and are kept for late data
+        self.watermark = NO_WATERMARK
+
+        # Counters
+        self.on_time = 0
+        self.late = 0
+        self.dropped = 0
+
+    def _accepts(self, hour):
+        return hour + timedelta(hours=1) + self.allowed_lateness > self.watermark
+
+    def _status(self, hour):
+        if not self._accepts(hour):
+            self.dropped += 1
+            return DROPPED
+        if hour in self.fired:
+            self.late += 1
+            return LATE
+        self.on_time += 1
+        return ON_TIME
+
+    def add(self, device_name, timestamp, temperature, humidity):
+        hour = hour_of(timestamp)
+        status = self._status(hour)
+        if status != DROPPED:
+            window = self.devices.setdefault(hour, {})
+            aggregate = window.get(device_name)
+            if aggregate is None:
+                aggregate = window[device_name] = ReadingAggregate()
+            aggregate.add(temperature, humidity)
+            self.advance(timestamp - self.max_out_of_order)
+        return status
+
+    def add_climate(self, timestamp, temperature, humidity):
+        hour = hour_of(timestamp)
+        if self._accepts(hour):
+            self.climate.setdefault(hour, ReadingAggregate()).add(temperature, humidity)
+
+    def merge(self, hour, device_name, aggregate):
+        # Restore a snapshot taken at a checkpoint
+        if device_name is None:
+            self.climate.setdefault(hour, ReadingAggregate()).merge(aggregate)
+        else:
+            self.devices.setdefault(hour, {}).setdefault(device_name, ReadingAggregate()).merge(aggregate)
+
+    def advance(self, watermark):
+        if watermark > self.watermark:
+            self.watermark = watermark
+
+    def has_due(self, include_late=True):
+        cutoff = self.watermark - timedelta(hours=1)
+        return any(hour <= cutoff and window and (include_late or hour not in self.fired)
+                   for hour, window in self.devices.items())
+
+    def take(self, everything=False):
+        """Remove and return [(hour, {device: aggregate}, climate aggregate)] that should be saved now.
+
+        Normally that is every hour the watermark has passed; with everything=True
+        (manual and final saves) the still-open hours are included too.
+        """
+        cutoff = self.watermark - timedelta(hours=1)
+        due = []
+        for hour in sorted(self.devices):
+            if not everything and hour > cutoff:
+                continue
+            window = self.devices.pop(hour)
+            if window:
+                due.append((hour, window, self.climate.get(hour) or ReadingAggregate()))
+            if hour <= cutoff:
+                self.fired.add(hour)
+        for hour, _, _ in due:
+            # The climate samples are saved with the devices; later saves of the hour only add newer samples
+            if hour in self.climate:
+                self.climate[hour] = ReadingAggregate()
+        self._expire()
+        return due
+
+    def _expire(self):
+        for hour in [hour for hour in self.fired if not self._accepts(hour)]:
+            self.fired.discard(hour)
+            self.devices.pop(hour, None)
+            self.climate.pop(hour, None)
+        for hour in [hour for hour in self.climate if not self._accepts(hour)]:
+            del self.climate[hour]
+
+    def snapshot(self):
+        """Yield (hour, device_name or None for climate, aggregate) for everything not saved yet."""
+        for hour, window in self.devices.items():
+            for device_name, aggregate in window.items():
+                if not aggregate.is_empty():
+                    yield hour, device_name, aggregate
+        for hour, aggregate in self.climate.items():
+            if not aggregate.is_empty():
+                yield hour, None, aggregate
+
+    def stats(self):
+        return {'watermark': self.watermark.isoformat(timespec='seconds') if self.watermark > NO_WATERMARK else None,
+                'open_hours': len(self.devices), 'on_time': self.on_time, 'late': self.late, 'dropped': self.dropped}
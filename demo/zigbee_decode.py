@@ -0,0 +1,71 @@
+import json
+import math
+
+# Use the fastest JSON parser that is installed; the stdlib one is always there as a fallback
+try:
+    import orjson
+    _loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson
+        _loads = ujson.loads
+        JSON_BACKEND = "ujson"
+    except ImportError:
+        _loads = json.loads
+        JSON_BACKEND = "json"
+
+TOPIC_PREFIX = "zigbee2mqtt/"
+# Sub-topics that are commands or status, never sensor state
+NON_SENSOR_SUFFIXES = ("/set", "/get", "/availability")
+MAX_CACHED_TOPICS = 100000
+
+_topic_cache = {}
+
+
+def topic_device(topic):
+    """Return the device name for a zigbee2mqtt sensor state topic, or None for bridge/command topics."""
+    try:
+        return _topic_cache[topic]
+    except KeyError:
+        pass
+    device_name = None
+    if topic.startswith(TOPIC_PREFIX):
+        name = topic[len(TOPIC_PREFIX):]
+        if name and not name.startswith("bridge") and not name.endswith(NON_SENSOR_SUFFIXES):
+            device_name = name
+    if len(_topic_cache) >= MAX_CACHED_TOPICS:
+        _topic_cache.clear()
+    _topic_cache[topic] = device_name
+    return device_name
+
+
+def decode_reading(topic, payload):
+    """Return (device_name, temperature, humidity, last_seen) for a sensor message, or None if it is not one.
+
+    last_seen is the device's own timestamp as zigbee2mqtt sent it (epoch ms or
+    ISO 8601), or None when the bridge does not include it.
+
+    Non-sensor topics and payloads without both fields are rejected before any
+    JSON parsing. Raises ValueError for a sensor payload that is not valid JSON
+    or whose temperature or humidity is not a finite number.
+    """
+    device_name = topic_device(topic)
+    if device_name is None:
+        return None
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if b'"temperature"' not in payload or b'"humidity"' not in payload:
+        return None
+    data = _loads(payload)
+    if not isinstance(data, dict):
+        return None
+    temperature = data.get('temperature')
+    humidity = data.get('humidity')
+    if temperature is None or humidity is None:
+        return None
+    # Strings such as 'n/a' would otherwise only fail at round() on the consumer's thread
+    for name, value in (('temperature', temperature), ('humidity', humidity)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{device_name} sent a non-numeric {name}: {value!r}")
+    return device_name, temperature, humidity, data.get('last_seen')
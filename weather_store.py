@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import csv
+import struct
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+# All historical hourly weather in one binary file: a header, then the columns one after the other, every
+# column sorted by hour. Hours are int64 epoch hours; values are float64 with NaN for missing data.
+#   magic (8 bytes) | rows (uint64) | hour int64[rows] | temperature float64[rows] | humidity float64[rows]
+STORE_FILE = 'weather_store.bin'
+MAGIC = b'WXSTORE1'
+HEADER = struct.Struct('<8sQ')
+COLUMNS = ('temperature', 'humidity')
+
+# Timestamps are Singapore local time
+LOCAL_TZ = timezone(timedelta(hours=8))
+
+DAY_FILE_PATTERN = re.compile(r'(\d{8})\.csv$')  # hourly_weather_data_DDMMYYYY.csv
+
+
+def to_epoch_hour(hour):
+    # Naive datetimes are local (+08:00) times
+    if hour.tzinfo is None:
+        hour = hour.replace(tzinfo=LOCAL_TZ)
+    return int(hour.timestamp()) // 3600
+
+
+def from_epoch_hour(epoch_hour):
+    return datetime.fromtimestamp(int(epoch_hour) * 3600, LOCAL_TZ)
+
+
+def parse_number(text):
+    # '28 °C' -> 28.0, '84%' -> 84.0, '' -> NaN
+    match = re.search(r'-?\d+(?:\.\d+)?', str(text))
+    return float(match.group()) if match else np.nan
+
+
+class WeatherStore:
+    """Hourly temperature and humidity keyed by epoch hour, with memory-mapped range reads.
+
+    ingest() is idempotent: an hour that is ingested again is replaced, so the
+    same scrape or import can be repeated safely, and the file is only
+    rewritten when something actually changed.
+    """
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.hours = np.empty(0, dtype=np.int64)
+        self.columns = {name: np.empty(0) for name in COLUMNS}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            magic, rows = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a weather store")
+        if rows == 0:
+            return
+        self.hours = np.memmap(self.path, dtype=np.int64, mode='r', offset=HEADER.size, shape=(rows,))
+        for i, name in enumerate(COLUMNS):
+            self.columns[name] = np.memmap(self.path, dtype=np.float64, mode='r',
+                                           offset=HEADER.size + 8 * rows * (i + 1), shape=(rows,))
+
+    def __len__(self):
+        return len(self.hours)
+
+    def ingest(self, hours, temperature, humidity):
+        """Merge hourly rows (datetimes or epoch hours); returns the number of hours added or changed."""
+        hours = np.asarray([h if isinstance(h, (int, np.integer)) else to_epoch_hour(h) for h in hours],
+                           dtype=np.int64)
+        new = {'temperature': np.asarray(temperature, dtype=np.float64),
+               'humidity': np.asarray(humidity, dtype=np.float64)}
+        if not len(hours):
+            return 0
+
+        # The last row for an hour wins, within the batch and against the store
+        order = np.argsort(hours, kind='stable')
+        is_last = np.append(hours[order][1:] != hours[order][:-1], True)
+        order = order[is_last]
+        hours = hours[order]
+        new = {name: values[order] for name, values in new.items()}
+
+        position = np.searchsorted(self.hours, hours)
+        exists = position < len(self.hours)
+        exists[exists] = self.hours[position[exists]] == hours[exists]
+        changed = ~exists
+        for name in COLUMNS:
+            old = np.asarray(self.columns[name])[position[exists]]
+            same = (old == new[name][exists]) | (np.isnan(old) & np.isnan(new[name][exists]))
+            changed[exists] |= ~same
+        if not changed.any():
+            return 0
+
+        keep = np.ones(len(self.hours), dtype=bool)
+        keep[position[exists]] = False
+        merged_hours = np.concatenate([np.asarray(self.hours)[keep], hours])
+        order = np.argsort(merged_hours, kind='stable')
+        merged = {name: np.concatenate([np.asarray(self.columns[name])[keep], new[name]])[order] for name in COLUMNS}
+        self._write(merged_hours[order], merged)
+        return int(changed.sum())
+
+    def _write(self, hours, columns):
+        # Write next to the final name and swap it in, so readers never see a half-written file
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, len(hours)))
+            file.write(hours.astype('<i8').tobytes())
+            for name in COLUMNS:
+                file.write(columns[name].astype('<f8').tobytes())
+        self.hours = self.columns = None  # Release the memory maps before the file is replaced
+        os.replace(temp_path, self.path)
+        self._open()
+
+    def range(self, start=None, end=None):
+        """(epoch hours, {column: values}) for start <= hour < end; datetimes, naive ones local time."""
+        low = 0 if start is None else np.searchsorted(self.hours, to_epoch_hour(start))
+        high = len(self.hours) if end is None else np.searchsorted(self.hours, to_epoch_hour(end))
+        return self.hours[low:high], {name: values[low:high] for name, values in self.columns.items()}
+
+    def frame(self, start=None, end=None):
+        """The range as a pandas DataFrame indexed by +08:00 time, for building training sets."""
+        import pandas as pd
+
+        hours, columns = self.range(start, end)
+        index = pd.to_datetime(np.asarray(hours) * 3600, unit='s', utc=True).tz_convert(LOCAL_TZ)
+        return pd.DataFrame({name: np.asarray(values) for name, values in columns.items()},
+                            index=pd.DatetimeIndex(index, name='time'))
+
+
+def read_legacy_csv(path, date=None):
+    """Rows of any of the old weather CSVs as (hour datetimes, temperatures, humidities).
+
+    Handles ISO timestamps (reformatted_*, cleaned_reformatted_*, scraper output),
+    device CSVs (their climate_* columns), and 'HH:MM' times, whose day comes
+    from the DDMMYYYY in the file name or from `date`. Files that hold several
+    days of 'HH:MM' rows (combined_*) move to the next day whenever the time
+    goes backwards. Repeated header rows are skipped, and so are rows that are
+    too short to hold the columns or whose time cannot be read; their number is
+    returned as the fourth item.
+    """
+    match = DAY_FILE_PATTERN.search(os.path.basename(path))
+    day = datetime.strptime(match.group(1), '%d%m%Y') if match else date
+    readings = {}  # hour -> [(temperature, humidity)]; half-hourly observations are averaged
+    previous = None
+    skipped = 0
+    with open(path, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError(f"{path} is empty")
+        header = [name.strip().lower() for name in header]
+        if 'climate_temperature' in header:
+            columns = header.index('time'), header.index('climate_temperature'), header.index('climate_humidity')
+        else:
+            columns = header.index('time'), header.index('temperature'), header.index('humidity')
+        width = max(columns) + 1
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                skipped += 1  # Truncated rows, e.g. device CSVs whose empty climate columns were cut off
+                continue
+            if row[columns[0]].strip().lower() == 'time':
+                continue  # A header repeated by concatenating files
+            text = row[columns[0]].strip()
+            if not text:
+                continue  # Some reformatted_* rows lost their time and cannot be placed
+            if 'T' in text or '-' in text:
+                try:
+                    hour = datetime.fromisoformat(text)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if hour.tzinfo is not None:
+                    hour = hour.astimezone(LOCAL_TZ).replace(tzinfo=None)
+            else:
+                if day is None:
+                    raise ValueError(f"{path} has times without dates; pass the first day with --date")
+                try:
+                    clock = datetime.strptime(text, '%H:%M')
+                except ValueError:
+                    skipped += 1
+                    continue
+                if previous is not None and (clock.hour, clock.minute) < previous:
+                    day += timedelta(days=1)
+                previous = (clock.hour, clock.minute)
+                hour = day + timedelta(hours=clock.hour, minutes=clock.minute)
+            readings.setdefault(hour.replace(minute=0, second=0, microsecond=0), []).append(
+                (parse_number(row[columns[1]]), parse_number(row[columns[2]])))
+    hours = sorted(readings)
+    temperatures = [np.nanmean([t for t, _ in readings[hour]]) if any(not np.isnan(t) for t, _ in readings[hour])
+                    else np.nan for hour in hours]
+    humidities = [np.nanmean([h for _, h in readings[hour]]) if any(not np.isnan(h) for _, h in readings[hour])
+                  else np.nan for hour in hours]
+    return hours, temperatures, humidities, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consolidated hourly weather store")
+    parser.add_argument('--store', default=STORE_FILE)
+    commands = parser.add_subparsers(dest='command', required=True)
+    imports = commands.add_parser('import', help="Import old weather CSVs (safe to repeat)")
+    imports.add_argument('files', nargs='+')
+    imports.add_argument('--date', type=lambda text: datetime.strptime(text, '%d%m%Y'),
+                         help="First day (DDMMYYYY) of files whose rows only have HH:MM times")
+    commands.add_parser('info', help="Print the hours covered")
+    export = commands.add_parser('export', help="Print a range as CSV")
+    export.add_argument('--start', type=datetime.fromisoformat)
+    export.add_argument('--end', type=datetime.fromisoformat)
+    args = parser.parse_args(argv)
+
+    store = WeatherStore(args.store)
+    if args.command == 'import':
+        for path in args.files:
+            # One unreadable file (missing columns, bad encoding, gone) does not stop the others
+            try:
+                *rows, skipped = read_legacy_csv(path, args.date)
+            except Exception as e:
+                print(f"Skipping {path}: {type(e).__name__}: {e}")
+                continue
+            print(f"{path}: {len(rows[0])} hours, {store.ingest(*rows)} added or changed"
+                  + (f", {skipped} malformed rows skipped" if skipped else ""))
+    elif args.command == 'info':
+        if len(store):
+            print(f"{len(store)} hours from {from_epoch_hour(store.hours[0]):%Y-%m-%d %H:00} "
+                  f"to {from_epoch_hour(store.hours[-1]):%Y-%m-%d %H:00}")
+        else:
+            print("The store is empty")
+    else:
+        hours, columns = store.range(args.start, args.end)
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(('time',) + COLUMNS)
+        for i, hour in enumerate(hours):
+            writer.writerow([from_epoch_hour(hour).strftime('%Y-%m-%dT%H:%M:%S.%f') + '+08:00']
+                            + ['' if np.isnan(columns[name][i]) else columns[name][i] for name in COLUMNS])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())